@@ -3,26 +3,62 @@
 import os
 import signal
 import sys
+import threading
+import time
 
+from bridge.shard_pool import get_shard_pool
 from channel import channel_factory
+from common import metrics, tokenizer
 from common.log import logger
-from config import conf, load_config
+from config import conf, get_channel_types, load_config
 from plugins import *
 
+_channels = []  # 当前运行的channel，退出前用于等待处理中的消息
+
 
 def sigterm_handler_wrap(_signo):
     old_handler = signal.getsignal(_signo)
 
-    def func(_signo, _stack_frame):
-        logger.info("signal {} received, exiting...".format(_signo))
+    def exit_now(_signo, _stack_frame):
         conf().save_user_datas()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
 
+    def func(_signo, _stack_frame):
+        logger.info("signal {} received, exiting...".format(_signo))
+        # 等待结束后或等待过程中再次收到信号时直接退出
+        channels = [channel for channel in _channels if hasattr(channel, "drain")]
+        if not channels or not conf().get("drain_timeout", 30) or channels[0].draining:
+            return exit_now(_signo, _stack_frame)
+        # 在单独的线程中等待，主线程继续运行channel的消息循环，保证处理中的消息可以正常发送
+        thread = threading.Thread(target=drain_and_exit, args=(_signo,), name="drain")
+        thread.setDaemon(True)
+        thread.start()
+
     signal.signal(_signo, func)
 
 
+def drain_and_exit(_signo):
+    channels = [channel for channel in _channels if hasattr(channel, "drain")]
+    reports = []
+    threads = [threading.Thread(target=lambda c: reports.append(c.drain(conf().get("drain_timeout", 30))), args=(channel,)) for channel in channels]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = {key: sum(r[key] for r in reports) for key in reports[0]}
+    logger.info(
+        "[Drain] completed {completed} messages, abandoned {abandoned_queued} queued, {abandoned_running} running, {abandoned_retries} send retries, rejected {rejected} new messages".format(
+            **report
+        )
+    )
+    if report["durable"]:
+        logger.info("[Drain] unfinished text messages are kept in durable queue and will be replayed after restart")
+    # 再次发送信号，由主线程按原来的逻辑退出
+    os.kill(os.getpid(), _signo)
+
+
 def run():
     try:
         # load config
@@ -32,26 +68,61 @@ def run():
         # kill signal
         sigterm_handler_wrap(signal.SIGTERM)
 
+        # 提前启动工作进程
+        get_shard_pool()
+        tokenizer.warmup()
+
+        if conf().get("metrics_port"):
+            metrics.start_http_server(conf().get("metrics_port"))
+
         # create channel
-        channel_name = conf().get("channel_type", "wx")
+        channel_names = get_channel_types()
 
         if "--cmd" in sys.argv:
-            channel_name = "terminal"
+            channel_names = ["terminal"]
 
-        if channel_name == "wxy":
+        if "wechatmp" in channel_names and "wechatmp_service" in channel_names:
+            raise RuntimeError("wechatmp and wechatmp_service can not run in one process")
+
+        if "wxy" in channel_names:
             os.environ["WECHATY_LOG"] = "warn"
             # os.environ['WECHATY_PUPPET_SERVICE_ENDPOINT'] = '127.0.0.1:9001'
 
-        channel = channel_factory.create_channel(channel_name)
-        if channel_name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app", "wework", "ntchat"]:
+        # 多个channel在同一进程中运行，共享Bridge、bot、插件和线程池
+        for channel_name in channel_names:
+            _channels.append(channel_factory.create_channel(channel_name))
+        if any(name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app", "wework", "ntchat"] for name in channel_names):
             PluginManager().load_plugins()
 
         # startup channel
-        channel.startup()
+        if len(_channels) == 1:
+            _channels[0].startup()
+        else:
+            start_channels(channel_names)
     except Exception as e:
         logger.error("App startup failed!")
         logger.exception(e)
 
 
+def start_channels(channel_names):
+    threads = []
+    for channel_name, channel in zip(channel_names, _channels):
+        thread = threading.Thread(target=startup_channel, args=(channel_name, channel), name="channel-{}".format(channel_name))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    # 主线程只负责等待和处理退出信号
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)
+
+
+def startup_channel(channel_name, channel):
+    try:
+        channel.startup()
+    except Exception as e:
+        logger.error("Channel {} startup failed!".format(channel_name))
+        logger.exception(e)
+
+
 if __name__ == "__main__":
     run()
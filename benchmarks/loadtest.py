@@ -0,0 +1,311 @@
+"""
+离线的端到端压测：启动本地的OpenAI兼容接口模拟服务，由合成的TerminalChannel模拟多个用户和群聊发送消息，
+经过完整的触发匹配、排队、插件、bot、装饰和发送流程，最后输出吞吐量、端到端延迟、排队长度和内存峰值
+
+用法: python benchmarks/loadtest.py --users 200 --groups 20 --rate 200 --duration 30 --latency-ms 800
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bridge.context import ContextType  # noqa: E402
+from bridge.reply import Reply, ReplyType  # noqa: E402
+from channel.chat_message import ChatMessage  # noqa: E402
+from channel.terminal.terminal_channel import TerminalChannel  # noqa: E402
+from channel.trigger_index import reset_trigger_index  # noqa: E402
+from common import metrics  # noqa: E402
+from common.log import logger  # noqa: E402
+from config import conf, load_config  # noqa: E402
+from plugins import PluginManager  # noqa: E402
+
+BOT_NAME = "bot"
+WORDS = ["今天", "天气", "怎么样", "帮我", "写一段", "代码", "翻译", "总结", "一下", "这篇", "文章", "为什么", "如何", "学习", "Python", "hello", "world"]
+
+
+class MockOpenAIServer(ThreadingMixIn, HTTPServer):
+    """
+    模拟OpenAI的/v1/chat/completions接口，按配置的延迟和token数返回回复
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency, jitter, completion_tokens):
+        super().__init__(("127.0.0.1", 0), _MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.requests = 0
+
+    @property
+    def api_base(self):
+        return "http://127.0.0.1:{}/v1".format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="mock-openai")
+        thread.setDaemon(True)
+        thread.start()
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server: MockOpenAIServer = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._write(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        server.requests += 1
+        time.sleep(max(server.latency + random.uniform(-server.jitter, server.jitter), 0))
+        prompt_tokens = sum(len(message.get("content", "")) for message in body.get("messages", []))
+        content = " ".join(random.choice(WORDS) for _ in range(server.completion_tokens))
+        self._write(
+            200,
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": server.completion_tokens, "total_tokens": prompt_tokens + server.completion_tokens},
+            },
+        )
+
+    def _write(self, status, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyntheticMessage(ChatMessage):
+    def __init__(self, msg_id, content, user_id, group=None, is_at=False):
+        super().__init__(None)
+        self.msg_id = msg_id
+        self.create_time = time.time()
+        self.ctype = ContextType.TEXT
+        self.content = content
+        self.from_user_id = group or user_id
+        self.from_user_nickname = user_id
+        self.to_user_id = BOT_NAME
+        self.to_user_nickname = BOT_NAME
+        self.other_user_id = group or user_id
+        self.other_user_nickname = group or user_id
+        self.is_group = group is not None
+        self.is_at = is_at
+        self.actual_user_id = user_id
+        self.actual_user_nickname = user_id
+        self.at_list = [BOT_NAME] if is_at else []
+
+
+class SyntheticChannel(TerminalChannel):
+    """
+    按照设定的速率模拟多个用户私聊和群聊发送消息，记录每条消息从收到到回复发送的耗时
+    """
+
+    NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE]
+
+    def __init__(self, users, groups):
+        super().__init__()
+        self.name = BOT_NAME
+        self.user_id = BOT_NAME
+        self.users = ["user{}".format(i) for i in range(users)]
+        self.groups = ["group{}".format(i) for i in range(groups)]
+        self.stats_lock = threading.Lock()
+        self.receive_times = {}  # msg_id -> 收到消息的时间
+        self.latencies = []
+        self.produced = 0
+        self.ignored = 0
+
+    def send(self, reply: Reply, context):
+        msg_id = context["msg"].msg_id
+        with self.stats_lock:
+            receive_time = self.receive_times.pop(msg_id, None)
+            if receive_time is not None:
+                self.latencies.append(time.time() - receive_time)
+
+    def generate(self, msg_id):
+        """
+        随机生成一条消息：私聊大部分带触发前缀，群聊混合@机器人、前缀、关键词和普通闲聊
+        """
+        question = "".join(random.choice(WORDS) for _ in range(random.randint(2, 12)))
+        user = random.choice(self.users)
+        if not self.groups or random.random() < 0.5:
+            content = random.choice(["bot ", "@bot ", "bot ", ""]) + question
+            return SyntheticMessage(msg_id, content, user), False
+        group = random.choice(self.groups)
+        kind = random.random()
+        if kind < 0.4:
+            return SyntheticMessage(msg_id, "@{} {}".format(BOT_NAME, question), user, group, is_at=True), True
+        if kind < 0.6:
+            return SyntheticMessage(msg_id, "@bot " + question, user, group), True
+        if kind < 0.7:
+            return SyntheticMessage(msg_id, "机器人" + question, user, group), True
+        return SyntheticMessage(msg_id, question, user, group), True
+
+    def send_message(self, msg_id):
+        cmsg, isgroup = self.generate(msg_id)
+        receive_time = time.time()
+        context = self._compose_context(ContextType.TEXT, cmsg.content, isgroup=isgroup, msg=cmsg)
+        if context is None:
+            self.ignored += 1
+            return
+        with self.stats_lock:
+            self.receive_times[msg_id] = receive_time
+        self.produced += 1
+        self.produce(context)
+
+
+def peak_rss_mb():
+    # linux下单位为KB，macOS下为字节
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / unit
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run(args):
+    os.chdir(ROOT)  # 配置文件和插件目录使用相对路径
+    load_config()
+    server = MockOpenAIServer(args.latency_ms / 1000, args.jitter_ms / 1000, args.completion_tokens)
+    server.start()
+    overrides = {
+        "open_ai_api_key": "sk-mock",
+        "open_ai_api_base": server.api_base,
+        "proxy": "",
+        "model": "gpt-3.5-turbo",
+        "use_azure_chatgpt": False,
+        "use_linkai": False,
+        "single_chat_prefix": ["bot", "@bot"],
+        "group_chat_prefix": ["@bot"],
+        "group_chat_keyword": ["机器人"],
+        "group_name_white_list": ["ALL_GROUP"],
+        "image_create_prefix": [],
+        "rate_limit_chatgpt": 1000000,
+        "async_mode": args.async_mode,
+        "worker_processes": args.worker_processes,
+    }
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            overrides.update(json.load(f))
+    for key, value in overrides.items():
+        conf()[key] = value
+    reset_trigger_index()
+    logger.setLevel("WARN")
+    if not args.no_plugins:
+        PluginManager().load_plugins()
+
+    channel = SyntheticChannel(args.users, args.groups)
+    depth_samples = []
+    stop = threading.Event()
+
+    def sample_depth():
+        while not stop.is_set():
+            stats = channel.get_queue_stats()
+            lanes = channel.get_lane_stats()
+            depth_samples.append((time.time() - start_time, stats["queued"], sum(lane["pending"] for lane in lanes)))
+            stop.wait(args.sample_interval)
+
+    start_time = time.time()
+    threading.Thread(target=sample_depth, name="depth-sampler", daemon=True).start()
+    total = int(args.rate * args.duration)
+    for msg_id in range(total):
+        # 按固定速率发送，落后时不等待
+        delay = start_time + msg_id / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        channel.send_message(msg_id)
+    send_end = time.time()
+
+    # 等待已发送的消息处理完成
+    deadline = send_end + args.drain_timeout
+    while channel.receive_times and time.time() < deadline:
+        time.sleep(0.05)
+    end_time = time.time()
+    stop.set()
+
+    latencies = channel.latencies
+    report = {
+        "generated": total,
+        "ignored": channel.ignored,
+        "produced": channel.produced,
+        "replied": len(latencies),
+        "unfinished": len(channel.receive_times),
+        "llm_requests": server.requests,
+        "elapsed": end_time - start_time,
+        "throughput": len(latencies) / (end_time - start_time),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies) if latencies else 0.0,
+        "max_queue_depth": max((depth for _, depth, _ in depth_samples), default=0),
+        "max_lane_pending": max((pending for _, _, pending in depth_samples), default=0),
+        "queue_depth": [[round(t, 2), depth, pending] for t, depth, pending in depth_samples],
+        "queue_stats": channel.get_queue_stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def print_report(report):
+    print("messages: generated={generated} ignored={ignored} produced={produced} replied={replied} unfinished={unfinished} llm_requests={llm_requests}".format(**report))
+    print("throughput: {throughput:.1f} msg/s in {elapsed:.1f}s".format(**report))
+    print(
+        "latency: p50={:.0f}ms p90={:.0f}ms p99={:.0f}ms max={:.0f}ms".format(
+            report["latency_p50"] * 1000, report["latency_p90"] * 1000, report["latency_p99"] * 1000, report["latency_max"] * 1000
+        )
+    )
+    print("queue: max_depth={max_queue_depth} max_lane_pending={max_lane_pending} stats={queue_stats}".format(**report))
+    step = max(len(report["queue_depth"]) // 10, 1)
+    print("queue depth over time (s, queued, lane pending): {}".format(report["queue_depth"][::step]))
+    print("peak rss: {:.1f}MB".format(report["peak_rss_mb"]))
+    print("stages:\n" + metrics.render_text())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline end-to-end load test with a mock OpenAI backend")
+    parser.add_argument("--users", type=int, default=100, help="number of private chat users")
+    parser.add_argument("--groups", type=int, default=10, help="number of group chats")
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to generate messages")
+    parser.add_argument("--latency-ms", type=float, default=500, help="mock LLM latency")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="mock LLM latency jitter")
+    parser.add_argument("--completion-tokens", type=int, default=50, help="tokens in each mock reply")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for replies after generating")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="seconds between queue depth samples")
+    parser.add_argument("--async-mode", action="store_true", help="enable async_mode")
+    parser.add_argument("--worker-processes", type=int, default=0, help="worker_processes setting")
+    parser.add_argument("--no-plugins", action="store_true", help="do not load plugins")
+    parser.add_argument("--config", help="json file with extra config overrides")
+    parser.add_argument("--json", help="write the report to this json file")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+"""
+核心数据结构和常用函数的微基准测试，结果保存为json，可与之前的结果对比发现性能回退
+
+用法:
+    python benchmarks/microbench.py --output before.json
+    python benchmarks/microbench.py --output after.json --compare before.json
+    python benchmarks/microbench.py --quick --filter expired_dict
+"""
+
+import argparse
+import gc
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCHMARKS = []  # (名称, 参数列表, 快速模式下的参数列表, setup函数)
+
+
+def bench(name, params, quick_params=None):
+    """
+    注册一个基准测试，setup(param)返回每次执行一个操作的无参函数
+    """
+
+    def decorator(setup):
+        BENCHMARKS.append((name, params, quick_params or params[:1], setup))
+        return setup
+
+    return decorator
+
+
+def random_text(length, rng):
+    return "".join(chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(length))
+
+
+# ExpiredDict
+
+
+def _expired_dict(size):
+    from common.expired_dict import ExpiredDict
+
+    d = ExpiredDict(3600)
+    for i in range(size):
+        d["key{}".format(i)] = i
+    return d
+
+
+@bench("expired_dict.get", [10_000, 100_000, 1_000_000], [10_000])
+def bench_expired_dict_get(size):
+    d = _expired_dict(size)
+    keys = itertools.cycle(["key{}".format(i) for i in range(0, size, max(size // 1000, 1))])
+    return lambda: d.get(next(keys))
+
+
+@bench("expired_dict.set", [10_000, 100_000, 1_000_000], [10_000])
+def bench_expired_dict_set(size):
+    d = _expired_dict(size)
+    keys = itertools.cycle(["key{}".format(i) for i in range(0, size, max(size // 1000, 1))])
+
+    def op():
+        d[next(keys)] = 0
+
+    return op
+
+
+@bench("expired_dict.contains", [10_000, 100_000, 1_000_000], [10_000])
+def bench_expired_dict_contains(size):
+    d = _expired_dict(size)
+    keys = itertools.cycle(["key{}".format(i) for i in range(0, size * 2, max(size // 500, 1))])  # 一半不存在
+    return lambda: next(keys) in d
+
+
+@bench("expired_dict.keys", [10_000, 100_000, 1_000_000], [10_000])
+def bench_expired_dict_keys(size):
+    d = _expired_dict(size)
+    return lambda: d.keys()
+
+
+# TTLCache
+
+
+def _ttl_cache(size):
+    from common.ttl_cache import TTLCache
+
+    cache = TTLCache(ttl=3600, max_size=size)
+    for i in range(size):
+        cache["key{}".format(i)] = i
+    return cache
+
+
+@bench("ttl_cache.get", [10_000, 100_000, 1_000_000], [10_000])
+def bench_ttl_cache_get(size):
+    cache = _ttl_cache(size)
+    keys = itertools.cycle(["key{}".format(i) for i in range(0, size, max(size // 1000, 1))])
+    return lambda: cache.get(next(keys))
+
+
+@bench("ttl_cache.set_evict", [10_000, 100_000, 1_000_000], [10_000])
+def bench_ttl_cache_set_evict(size):
+    cache = _ttl_cache(size)
+    counter = itertools.count(size)
+
+    def op():
+        cache["key{}".format(next(counter))] = 0  # 每次写入淘汰一个条目
+
+    return op
+
+
+@bench("ttl_cache.keys", [10_000, 100_000, 1_000_000], [10_000])
+def bench_ttl_cache_keys(size):
+    cache = _ttl_cache(size)
+    return lambda: cache.keys()
+
+
+# SortedDict
+
+
+@bench("sorted_dict.update", [1_000, 10_000, 100_000], [1_000])
+def bench_sorted_dict_update(size):
+    from common.sorted_dict import SortedDict
+
+    rng = random.Random(0)
+    d = SortedDict(sort_func=lambda k, v: v, init_dict={i: rng.random() for i in range(size)}, reverse=True)
+    keys = itertools.cycle(rng.sample(range(size), min(size, 1000)))
+
+    def op():
+        d[next(keys)] = rng.random()
+
+    return op
+
+
+@bench("sorted_dict.insert_and_iterate", [1_000, 10_000], [1_000])
+def bench_sorted_dict_insert_and_iterate(size):
+    from common.sorted_dict import SortedDict
+
+    rng = random.Random(0)
+    d = SortedDict(sort_func=lambda k, v: v, init_dict={i: rng.random() for i in range(size)})
+    counter = itertools.count(size)
+
+    def op():
+        d[next(counter)] = rng.random()
+        next(iter(d.items()))  # 插入后第一次遍历需要重新排序
+
+    return op
+
+
+# Dequeue
+
+
+@bench("dequeue.put_get", [10_000])
+def bench_dequeue_put_get(size):
+    from common.dequeue import Dequeue
+
+    q = Dequeue()
+    for i in range(size):
+        q.put(i)
+
+    def op():
+        q.put(0)
+        q.get()
+
+    return op
+
+
+@bench("dequeue.putleft_get", [10_000])
+def bench_dequeue_putleft_get(size):
+    from common.dequeue import Dequeue
+
+    q = Dequeue()
+    for i in range(size):
+        q.put(i)
+
+    def op():
+        q.putleft(0)
+        q.get()
+
+    return op
+
+
+# WordsSearch
+
+
+def _words(size):
+    rng = random.Random(0)
+    return [random_text(rng.randint(2, 6), rng) for _ in range(size)]
+
+
+def _load_words_search():
+    # 直接按文件加载，导入plugins.banwords包会触发插件注册
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("WordsSearch", os.path.join(ROOT, "plugins", "banwords", "lib", "WordsSearch.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.WordsSearch
+
+
+def _words_search(size):
+    WordsSearch = _load_words_search()
+    search = WordsSearch()
+    search.SetKeywords(_words(size))
+    return search
+
+
+@bench("words_search.set_keywords", [10_000, 100_000], [10_000])
+def bench_words_search_set_keywords(size):
+    WordsSearch = _load_words_search()
+    words = _words(size)
+    return lambda: WordsSearch().SetKeywords(words)
+
+
+@bench("words_search.find_first", [10_000, 100_000], [10_000])
+def bench_words_search_find_first(size):
+    search = _words_search(size)
+    text = random_text(1000, random.Random(1))
+    return lambda: search.FindFirst(text)
+
+
+@bench("words_search.replace", [10_000, 100_000], [10_000])
+def bench_words_search_replace(size):
+    search = _words_search(size)
+    text = random_text(1000, random.Random(1))
+    return lambda: search.Replace(text)
+
+
+# token计算
+
+
+def _history(size):
+    from bot.session_manager import Message
+
+    rng = random.Random(0)
+    messages = [Message(role="system", content="你是ChatGPT, 一个由OpenAI训练的大型语言模型")]
+    for i in range(size):
+        messages.append(Message(role="user" if i % 2 == 0 else "assistant", content=random_text(rng.randint(20, 200), rng)))
+    return messages
+
+
+@bench("num_tokens_from_messages", [10, 100, 1000], [100])
+def bench_num_tokens_from_messages(size):
+    from bot.chatgpt.chat_gpt_session import num_tokens_from_messages
+    from common import tokenizer
+
+    messages = _history(size)
+    tokenizer.get_encoding("gpt-3.5-turbo", wait=True)  # 预先加载编码
+    num_tokens_from_messages(messages, "gpt-3.5-turbo")
+    return lambda: num_tokens_from_messages(messages, "gpt-3.5-turbo")
+
+
+@bench("tokenizer.count_tokens", [1, 100], [100])
+def bench_tokenizer_count_tokens(size):
+    from common import tokenizer
+
+    if tokenizer.get_encoding("gpt-3.5-turbo", wait=True) is None:
+        raise ImportError("tiktoken encoding not available")
+    texts = [message["content"] for message in _history(size)]
+    return lambda: tokenizer.count_tokens(texts, "gpt-3.5-turbo")
+
+
+@bench("chatgpt_session.discard_exceeding", [100, 1000], [100])
+def bench_discard_exceeding(size):
+    from bot.chatgpt.chat_gpt_session import ChatGPTSession
+
+    messages = _history(size)
+    session = ChatGPTSession("bench")
+    session.calc_tokens()
+
+    def op():
+        session.messages = list(messages)
+        session.discard_exceeding(1000)
+
+    return op
+
+
+# 工具函数
+
+
+@bench("split_string_by_utf8_length", [10_000, 100_000], [10_000])
+def bench_split_string_by_utf8_length(size):
+    from common.utils import split_string_by_utf8_length
+
+    text = random_text(size, random.Random(0))
+    return lambda: split_string_by_utf8_length(text, 2048)
+
+
+@bench("compress_imgfile", [1024], [512])
+def bench_compress_imgfile(size):
+    from PIL import Image
+
+    from common.utils import compress_imgfile
+
+    rng = random.Random(0)
+    image = Image.frombytes("RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    max_size = buf.getbuffer().nbytes // 4
+    return lambda: compress_imgfile(buf, max_size)
+
+
+# 消息触发匹配
+
+
+@bench("chat_channel.compose_context", [100, 10_000], [100])
+def bench_compose_context(size):
+    from benchmarks.loadtest import SyntheticMessage
+    from bridge.context import ContextType
+    from channel.chat_channel import ChatChannel
+    from channel.trigger_index import reset_trigger_index
+    from config import conf, load_config
+
+    os.chdir(ROOT)
+    load_config()
+    groups = ["group{}".format(i) for i in range(size)]
+    conf()["group_name_white_list"] = groups
+    conf()["group_chat_in_one_session"] = groups[::2]
+    conf()["group_name_keyword_white_list"] = ["keyword{}".format(i) for i in range(size)]
+    conf()["group_chat_prefix"] = ["@bot", "bot"] + ["prefix{}".format(i) for i in range(100)]
+    conf()["group_chat_keyword"] = ["kw{}".format(i) for i in range(size)]
+    reset_trigger_index()
+    channel = ChatChannel()
+    channel.name = "bot"
+    channel.user_id = "bot"
+    rng = random.Random(0)
+    messages = []
+    for i in range(1000):
+        group = rng.choice(groups) if i % 4 else "unknown{}".format(i)
+        content = rng.choice(["@bot 你好", "bot 今天天气", "闲聊" + random_text(20, rng), "prefix50 问题"])
+        messages.append(SyntheticMessage(i, content, "user{}".format(i % 50), group, is_at=i % 3 == 0))
+    messages = itertools.cycle(messages)
+
+    def op():
+        cmsg = next(messages)
+        channel._compose_context(ContextType.TEXT, cmsg.content, isgroup=True, msg=cmsg)
+
+    return op
+
+
+def measure(op, repeats, min_time):
+    """
+    自动确定每轮执行次数使单轮耗时不少于min_time，执行repeats轮，返回每次操作的耗时列表(秒)
+    """
+    number = 1
+    while True:
+        elapsed = _timeit(op, number)
+        if elapsed >= min_time or number >= 10_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    return number, [_timeit(op, number) / number for _ in range(repeats)]
+
+
+def _timeit(op, number):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            op()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    random.seed(0)
+    results = {}
+    for name, params, quick_params, setup in BENCHMARKS:
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        for param in quick_params if args.quick else params:
+            key = "{}[{}]".format(name, param)
+            try:
+                op = setup(param)
+            except ImportError as e:
+                print("{:<48} skipped: {}".format(key, e))
+                results[key] = {"skipped": str(e)}
+                continue
+            number, timings = measure(op, args.repeats, args.min_time)
+            results[key] = {
+                "number": number,
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "ops_per_sec": 1 / min(timings),
+            }
+            print("{:<48} {:>12} {:>14.0f} ops/s".format(key, format_duration(min(timings)), 1 / min(timings)))
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+
+def format_duration(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "{:.2f}{}".format(seconds / scale, unit)
+    return "{:.0f}ns".format(seconds / 1e-9)
+
+
+def compare(report, baseline, threshold):
+    """
+    与基准结果对比，耗时增加超过threshold的标记为回退
+    :return: 回退的测试数
+    """
+    print("\ncompare with {} ({}):".format(baseline["meta"].get("commit"), baseline["meta"].get("time")))
+    regressions = 0
+    for key, result in report["results"].items():
+        base = baseline["results"].get(key)
+        if not base or "min" not in base or "min" not in result:
+            continue
+        ratio = result["min"] / base["min"]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = "  improved"
+        print("{:<48} {:>12} -> {:>12} {:>7.2f}x{}".format(key, format_duration(base["min"]), format_duration(result["min"]), ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="microbenchmarks for core data structures and helpers")
+    parser.add_argument("--filter", action="append", help="only run benchmarks whose name contains this, can be repeated")
+    parser.add_argument("--quick", action="store_true", help="only run the small sizes")
+    parser.add_argument("--repeats", type=int, default=5, help="timing rounds for each benchmark, the fastest one is reported")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds of each round")
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--compare", help="baseline json file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown ratio reported as regression")
+    args = parser.parse_args()
+
+    # 日志只输出警告，避免影响计时
+    from common.log import logger
+
+    logger.setLevel("WARN")
+    report = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 # encoding:utf-8
 
-import requests, json
+import asyncio
+import json
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
+from common.access_token import BAIDU_TOKEN_ERRORS, baidu_access_token, get_baidu_token_cache
+from common.async_loop import get_http_session
 from common.log import logger
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
@@ -24,30 +28,11 @@ class BaiduWenxinBot(Bot):
             if context.type == ContextType.TEXT:
                 logger.info("[BAIDU] query={}".format(query))
                 session_id = context["session_id"]
-                reply = None
-                if query == "#清除记忆":
-                    self.sessions.clear_session(session_id)
-                    reply = Reply(ReplyType.INFO, "记忆已清除")
-                elif query == "#清除所有":
-                    self.sessions.clear_all_session()
-                    reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-                else:
+                reply = self._command_reply(query, session_id)
+                if not reply:
                     session = self.sessions.session_query(query, session_id)
                     result = self.reply_text(session)
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"],
-                        result["completion_tokens"],
-                        result["content"],
-                    )
-                    logger.debug(
-                        "[BAIDU] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(session.messages, session_id, reply_content, completion_tokens)
-                    )
-
-                    if total_tokens == 0:
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else:
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
+                    reply = self._build_reply(session_id, session, result)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -58,47 +43,127 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
+    async def areply(self, query, context=None):
+        if not context or context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        logger.info("[BAIDU] query={}".format(query))
+        session_id = context["session_id"]
+        # 会话存储的读写在线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        reply = await loop.run_in_executor(None, self._command_reply, query, session_id)
+        if not reply:
+            session = await loop.run_in_executor(None, self.sessions.session_query, query, session_id)
+            result = await self.areply_text(session)
+            reply = await loop.run_in_executor(None, self._build_reply, session_id, session, result)
+        return reply
+
+    def _command_reply(self, query, session_id):
+        reply = None
+        if query == "#清除记忆":
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        return reply
+
+    def _build_reply(self, session_id, session, result) -> Reply:
+        total_tokens, completion_tokens, reply_content = (
+            result["total_tokens"],
+            result["completion_tokens"],
+            result["content"],
+        )
+        logger.debug(
+            "[BAIDU] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(session.messages, session_id, reply_content, completion_tokens)
+        )
+
+        if total_tokens == 0:
+            reply = Reply(ReplyType.ERROR, reply_content)
+        else:
+            self.sessions.session_reply(reply_content, session_id, total_tokens)
+            reply = Reply(ReplyType.TEXT, reply_content)
+        return reply
+
     def reply_text(self, session: BaiduWenxinSession, retry_count=0):
         try:
             logger.info("[BAIDU] model={}".format(session.model))
             access_token = self.get_access_token()
-            if access_token == 'None':
-                logger.warn("[BAIDU] access token 获取失败")
+            if access_token is None:
                 return {
                     "total_tokens": 0,
                     "completion_tokens": 0,
                     "content": 0,
                     }
-            url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/" + session.model + "?access_token=" + access_token
             headers = {
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", self._chat_url(session, access_token), headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
-            logger.info(f"[BAIDU] response text={response_text}")
-            res_content = response_text["result"]
-            total_tokens = response_text["usage"]["total_tokens"]
-            completion_tokens = response_text["usage"]["completion_tokens"]
-            logger.info("[BAIDU] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
+            if self._token_expired(response_text, access_token) and retry_count < 1:
+                return self.reply_text(session, retry_count + 1)
+            return self._parse_response(response_text)
         except Exception as e:
-            need_retry = retry_count < 2
-            logger.warn("[BAIDU] Exception: {}".format(e))
-            need_retry = False
-            self.sessions.clear_session(session.session_id)
-            result = {"completion_tokens": 0, "content": "出错了: {}".format(e)}
-            return result
+            return self._handle_error(e, session)
+
+    async def areply_text(self, session: BaiduWenxinSession, retry_count=0):
+        """
+        reply_text的异步版本，通过全局共享的aiohttp连接池发送请求
+        """
+        try:
+            logger.info("[BAIDU] model={}".format(session.model))
+            # token通常已在缓存中，只有需要重新获取时才会阻塞
+            access_token = await asyncio.get_running_loop().run_in_executor(None, self.get_access_token)
+            if access_token is None:
+                return {
+                    "total_tokens": 0,
+                    "completion_tokens": 0,
+                    "content": 0,
+                    }
+            payload = {'messages': session.messages}
+            async with get_http_session().post(self._chat_url(session, access_token), json=payload) as res:
+                response_text = json.loads(await res.text())
+            if self._token_expired(response_text, access_token) and retry_count < 1:
+                return await self.areply_text(session, retry_count + 1)
+            return self._parse_response(response_text)
+        except Exception as e:
+            return await asyncio.get_running_loop().run_in_executor(None, self._handle_error, e, session)
+
+    def _chat_url(self, session: BaiduWenxinSession, access_token):
+        return "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/" + session.model + "?access_token=" + access_token
+
+    def _parse_response(self, response_text) -> dict:
+        logger.info(f"[BAIDU] response text={response_text}")
+        res_content = response_text["result"]
+        total_tokens = response_text["usage"]["total_tokens"]
+        completion_tokens = response_text["usage"]["completion_tokens"]
+        logger.info("[BAIDU] reply={}".format(res_content))
+        return {
+            "total_tokens": total_tokens,
+            "completion_tokens": completion_tokens,
+            "content": res_content,
+        }
+
+    def _handle_error(self, e, session: BaiduWenxinSession) -> dict:
+        logger.warn("[BAIDU] Exception: {}".format(e))
+        self.sessions.clear_session(session.session_id)
+        result = {"total_tokens": 0, "completion_tokens": 0, "content": "出错了: {}".format(e)}
+        return result
 
     def get_access_token(self):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
+        使用 AK，SK 生成鉴权签名（Access Token），token有效期30天，缓存后在过期前自动刷新
         :return: access_token，或是None(如果错误)
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        try:
+            return baidu_access_token(BAIDU_API_KEY, BAIDU_SECRET_KEY)
+        except Exception as e:
+            logger.warn("[BAIDU] access token 获取失败: {}".format(e))
+            return None
+
+    def _token_expired(self, response_text, access_token) -> bool:
+        if response_text.get("error_code") in BAIDU_TOKEN_ERRORS:
+            logger.warn("[BAIDU] access token expired: {}".format(response_text.get("error_msg")))
+            get_baidu_token_cache().invalidate(BAIDU_API_KEY, access_token)
+            return True
+        return False
@@ -1,4 +1,4 @@
-from bot.session_manager import Session
+from bot.session_manager import Session, count_message_tokens
 from common.log import logger
 
 """
@@ -26,17 +26,19 @@ class BaiduWenxinSession(Session):
             if cur_tokens is None:
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        # 每条消息的token数已缓存，先算出需要丢弃的消息数，最后一次性删除
+        discard = 0
         while cur_tokens > max_tokens:
-            if len(self.messages) >= 2:
-                self.messages.pop(0)
-                self.messages.pop(0)
+            if len(self.messages) - discard >= 2:
+                if precise:
+                    cur_tokens -= num_tokens_from_messages(self.messages[discard : discard + 2], self.model)
+                else:
+                    cur_tokens = cur_tokens - max_tokens
+                discard += 2
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages) - discard))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
+        del self.messages[:discard]
         return cur_tokens
 
     def calc_tokens(self):
@@ -45,9 +47,10 @@ class BaiduWenxinSession(Session):
 
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-    tokens = 0
-    for msg in messages:
-        # 官方token计算规则暂不明确： "大约为 token数为 "中文字 + 其他语种单词数 x 1.3"
-        # 这里先直接根据字数粗略估算吧，暂不影响正常使用，仅在判断是否丢弃历史会话的时候会有偏差
-        tokens += len(msg["content"])
-    return tokens
+    # 官方token计算规则暂不明确： "大约为 token数为 "中文字 + 其他语种单词数 x 1.3"
+    # 这里先直接根据字数粗略估算吧，暂不影响正常使用，仅在判断是否丢弃历史会话的时候会有偏差
+    return sum(count_message_tokens(msg, "character", _count_by_character) for msg in messages)
+
+
+def _count_by_character(msg):
+    return len(msg["content"])
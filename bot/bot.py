@@ -3,6 +3,8 @@ Auto-replay chat robot abstract class
 """
 
 
+import asyncio
+
 from bridge.context import Context
 from bridge.reply import Reply
 
@@ -15,3 +17,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def areply(self, query, context: Context = None) -> Reply:
+        """
+        bot auto-reply content in async mode, bots without a native async implementation run reply() in a worker thread
+        :param req: received message
+        :return: reply content
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.reply, query, context)
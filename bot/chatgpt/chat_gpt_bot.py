@@ -1,10 +1,10 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
 import openai.error
-import requests
 
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -12,7 +12,10 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client, tokenizer
+from common.async_loop import get_http_session
 from common.log import logger
+from common.retry import GiveUp, RetryPolicy, RetryRule
 from common.token_bucket import TokenBucket
 from config import conf, load_config
 
@@ -42,6 +45,17 @@ class ChatGPTBot(Bot, OpenAIImage):
             "request_timeout": conf().get("request_timeout", None),  # 请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
             "timeout": conf().get("request_timeout", None),  # 重试超时时间，在这个时间内，将会自动重试
         }
+        # 请求失败后的重试规则，超出retry_deadline的等待不再重试
+        self.retry_policy = RetryPolicy(
+            "chatgpt",
+            [
+                RetryRule(openai.error.RateLimitError, base_delay=10, max_delay=40),
+                RetryRule(openai.error.Timeout, base_delay=5, max_delay=20),
+                RetryRule(openai.error.APIError, base_delay=10, max_delay=40),
+            ],
+            max_attempts=3,
+            deadline=conf().get("retry_deadline", 60),
+        )
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -49,50 +63,19 @@ class ChatGPTBot(Bot, OpenAIImage):
             logger.info("[CHATGPT] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._command_reply(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[CHATGPT] session query={}".format(session.messages))
 
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
+            api_key, new_args = self._request_args(context)
+            if context.get("stream_callback"):
+                # reply in stream, the channel sends each chunk as it arrives
+                reply_content = self.reply_text_stream(session, context["stream_callback"], api_key, args=new_args)
             else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+                reply_content = self.reply_text(session, api_key, args=new_args)
+            return self._build_reply(session_id, session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -106,60 +89,175 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        session_id = context["session_id"]
+        # 会话存储的读写(SQLite、Redis)在线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        reply = await loop.run_in_executor(None, self._command_reply, query, session_id)
+        if reply:
+            return reply
+        session = await loop.run_in_executor(None, self.sessions.session_query, query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        api_key, new_args = self._request_args(context)
+        reply_content = await self.areply_text(session, api_key, args=new_args)
+        return await loop.run_in_executor(None, self._build_reply, session_id, session, reply_content)
+
+    def _command_reply(self, query, session_id):
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    def _request_args(self, context):
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return api_key, new_args
+
+    def _build_reply(self, session_id, session, reply_content) -> Reply:
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
         """
-        call openai's ChatCompletion to get the answer
+        call openai's ChatCompletion to get the answer, failed requests are retried according to self.retry_policy
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            return self.retry_policy.call(self._reply_text_once, session, api_key, args)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+            return self._handle_error(e, session)
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+    def _reply_text_once(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
+        if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        # if api_key == None, the default openai.api_key will be used
+        if args is None:
+            args = self.args
+        response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+        # logger.debug("[CHATGPT] response={}".format(response))
+        # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+        return self._parse_response(response)
+
+    def reply_text_stream(self, session: ChatGPTSession, stream_callback, api_key=None, args=None) -> dict:
+        """
+        call openai's ChatCompletion in stream mode, each piece of content is passed to stream_callback as it arrives
+        :return: the full answer, same as reply_text
+        """
+        try:
+            return self.retry_policy.call(self._reply_text_stream_once, session, stream_callback, api_key, args)
+        except Exception as e:
+            return self._handle_error(e, session)
+
+    def _reply_text_stream_once(self, session: ChatGPTSession, stream_callback, api_key=None, args=None) -> dict:
+        if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        if args is None:
+            args = self.args
+        content = []
+        try:
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, stream=True, **args)
+            for chunk in response:
+                if not chunk.choices:  # azure returns the content filter results first
+                    continue
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    content.append(delta)
+                    stream_callback(delta)
+        except Exception as e:
+            if content:  # 已经发出部分内容后不再重试，避免重复发送
+                raise GiveUp(e)
+            raise
+        return self._stream_result(session, "".join(content), args["model"])
+
+    def _stream_result(self, session: ChatGPTSession, content, model) -> dict:
+        # 流式接口不返回usage，按本地计数估算
+        completion_tokens = tokenizer.num_tokens(content, model) if content else 0
+        try:
+            prompt_tokens = session.calc_tokens()
+        except Exception:
+            prompt_tokens = 0
+        return {"total_tokens": prompt_tokens + completion_tokens, "completion_tokens": completion_tokens, "content": content}
+
+    async def areply_text(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
+        """
+        async version of reply_text, the request is sent through the shared aiohttp connection pool
+        and the backoff between retries does not occupy a thread
+        """
+        try:
+            return await self.retry_policy.acall(self._areply_text_once, session, api_key, args)
+        except Exception as e:
+            return await asyncio.get_running_loop().run_in_executor(None, self._handle_error, e, session)
+
+    async def _areply_text_once(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
+        if conf().get("rate_limit_chatgpt"):
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(None, self.tb4chatgpt.get_token):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        if args is None:
+            args = self.args
+        openai.aiosession.set(get_http_session())
+        response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+        return self._parse_response(response)
+
+    def _parse_response(self, response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_error(self, e, session: ChatGPTSession) -> dict:
+        """
+        :return: 不再重试时的返回结果
+        """
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            self.sessions.clear_session(session.session_id)
+        return result
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -176,7 +274,7 @@ class AzureChatGPTBot(ChatGPTBot):
         headers = {"api-key": api_key, "Content-Type": "application/json"}
         try:
             body = {"caption": query, "resolution": conf().get("image_create_size", "256x256")}
-            submission = requests.post(url, headers=headers, json=body)
+            submission = http_client.post(url, headers=headers, json=body)
             operation_location = submission.headers["Operation-Location"]
             retry_after = submission.headers["Retry-after"]
             status = ""
@@ -184,7 +282,7 @@ class AzureChatGPTBot(ChatGPTBot):
             while status != "Succeeded":
                 logger.info("waiting for image create..., " + status + ",retry after " + retry_after + " seconds")
                 time.sleep(int(retry_after))
-                response = requests.get(operation_location, headers=headers)
+                response = http_client.get(operation_location, headers=headers)
                 status = response.json()["status"]
             image_url = response.json()["result"]["contentUrl"]
             return True, image_url
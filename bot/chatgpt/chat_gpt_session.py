@@ -1,4 +1,5 @@
-from bot.session_manager import Session
+from bot.session_manager import Session, count_message_tokens
+from common import tokenizer
 from common.log import logger
 
 """
@@ -26,75 +27,89 @@ class ChatGPTSession(Session):
             if cur_tokens is None:
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        # 每条消息的token数已缓存，先算出需要丢弃的消息数，最后一次性删除
+        discard = 0
         while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+            remain = len(self.messages) - discard
+            if remain > 2 or (remain == 2 and self.messages[1 + discard]["role"] == "assistant"):
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens -= num_tokens_from_message(self.messages[1 + discard], self.model)
                 else:
                     cur_tokens = cur_tokens - max_tokens
-                break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
+                discard += 1
+                if remain == 2:
+                    break
+            elif remain == 2 and self.messages[1 + discard]["role"] == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, remain))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
+        del self.messages[1 : 1 + discard]
         return cur_tokens
 
     def calc_tokens(self):
         return num_tokens_from_messages(self.messages, self.model)
 
 
+_warned_models = set()
+
+
+def _token_model(model):
+    """
+    按计数规则归类模型
+    """
+    if model in ["wenxin", "xunfei"]:
+        return "character"
+    if model in ["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-35-turbo"]:
+        return "gpt-3.5-turbo"
+    if model in ["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                 "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k"]:
+        return "gpt-4"
+    if model not in _warned_models:
+        _warned_models.add(model)
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
+
+
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-
-    if model in ["wenxin", "xunfei"]:
+    model = _token_model(model)
+    if model == "character":
         return num_tokens_by_character(messages)
-
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo"]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k"]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    num_tokens = sum(num_tokens_from_message(message, model) for message in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, cached on Message objects."""
+    model = _token_model(model)
+    if model == "character":
+        return count_message_tokens(message, model, _count_by_character)
+    key = model if tokenizer.is_exact(model) else model + ":estimate"  # 编码加载完成后重新精确计算
+    return count_message_tokens(message, key, _TIKTOKEN_COUNTERS[model])
+
+
+def _count_by_tiktoken(message, model, tokens_per_message, tokens_per_name):
+    num_tokens = tokens_per_message + sum(tokenizer.count_tokens(list(message.values()), model))
+    if "name" in message:
+        num_tokens += tokens_per_name
+    return num_tokens
+
+
+_TIKTOKEN_COUNTERS = {
+    # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-3.5-turbo": lambda message: _count_by_tiktoken(message, "gpt-3.5-turbo", 4, -1),
+    "gpt-4": lambda message: _count_by_tiktoken(message, "gpt-4", 3, 1),
+}
+
+
+def _count_by_character(message):
+    return len(message["content"])
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["content"])
-    return tokens
+    return sum(count_message_tokens(message, "character", _count_by_character) for message in messages)
@@ -1,17 +1,19 @@
 # access LinkAI knowledge base platform
 # docs: https://link-ai.tech/platform/link-app/wechat
 
-import time
-
-import requests
+import asyncio
+import json
 
 from bot.bot import Bot
-from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_from_messages
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client, tokenizer
+from common.async_loop import get_http_session
 from common.log import logger
+from common.retry import GiveUp, RetryableError, RetryPolicy, RetryRule, network_errors
 from config import conf, pconf
 
 
@@ -24,6 +26,16 @@ class LinkAIBot(Bot, OpenAIImage):
         super().__init__()
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
+        # 网络错误和服务端5xx错误重试一次，请求或响应格式错误等其他异常直接失败
+        self.retry_policy = RetryPolicy(
+            "linkai",
+            [
+                RetryRule(network_errors(), base_delay=2, max_delay=10),
+                RetryRule(RetryableError, base_delay=2, max_delay=10),
+            ],
+            max_attempts=2,
+            deadline=conf().get("retry_deadline", 60),
+        )
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
@@ -39,99 +51,168 @@ class LinkAIBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    async def areply(self, query, context: Context = None) -> Reply:
+        if context.type == ContextType.TEXT:
+            return await self._achat(query, context)
+        return await super().areply(query, context)
+
+    def _chat(self, query, context) -> Reply:
         """
-        发起对话请求
+        发起对话请求，失败时按self.retry_policy重试
         :param query: 请求提示词
         :param context: 对话上下文
-        :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count >= 2:
-            # exit from retry 2 times
+        try:
+            session_id, body, headers = self._build_chat_request(query, context)
+
+            # do http request
+            base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
+            if context.get("stream_callback"):
+                return self.retry_policy.call(self._chat_stream, base_url, body, headers, session_id, context["stream_callback"])
+            return self.retry_policy.call(self._chat_once, base_url, body, headers, session_id)
+        except Exception as e:
+            logger.exception(e)
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.ERROR, "请再问我一次吧")
 
-        try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                app_code = context.kwargs.get("app_code") or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
+    def _chat_once(self, base_url, body, headers, session_id) -> Reply:
+        res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                               timeout=conf().get("request_timeout", 180))
+        return self._handle_chat_response(res.status_code, res.json(), session_id, res.headers)
 
-            session_id = context["session_id"]
+    async def _achat(self, query, context) -> Reply:
+        """
+        异步发起对话请求，通过全局共享的aiohttp连接池发送，重试前的等待不占用线程
+        """
+        try:
+            # 会话存储的读写在线程池中执行，不阻塞事件循环
+            session_id, body, headers = await asyncio.get_running_loop().run_in_executor(None, self._build_chat_request, query, context)
+            base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
+            return await self.retry_policy.acall(self._achat_once, base_url, body, headers, session_id)
+        except Exception as e:
+            logger.exception(e)
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
 
-            session = self.sessions.session_query(query, session_id)
-            model = conf().get("model") or "gpt-3.5-turbo"
-            # remove system message
-            if session.messages[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session.messages.pop(0)
+    async def _achat_once(self, base_url, body, headers, session_id) -> Reply:
+        import aiohttp
 
-            body = {
-                "app_code": app_code,
-                "messages": session.messages,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-            }
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, mode={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
+        timeout = aiohttp.ClientTimeout(total=conf().get("request_timeout", 180))
+        async with get_http_session().post(base_url + "/v1/chat/completions", json=body, headers=headers, timeout=timeout) as res:
+            status_code = res.status
+            response_headers = res.headers
+            response = await res.json(content_type=None)
+        return await asyncio.get_running_loop().run_in_executor(None, self._handle_chat_response, status_code, response, session_id, response_headers)
 
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
-                self.sessions.session_reply(reply_content, session_id, total_tokens)
-                suffix = self._fecth_knowledge_search_suffix(response)
-                if suffix:
-                    reply_content += suffix
-                return Reply(ReplyType.TEXT, reply_content)
+    def _build_chat_request(self, query, context):
+        """
+        构造对话请求
+        :return: (session_id, 请求体, 请求头)
+        """
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            app_code = context.kwargs.get("app_code") or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
+        session_id = context["session_id"]
 
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+        session = self.sessions.session_query(query, session_id)
+        model = conf().get("model") or "gpt-3.5-turbo"
+        # remove system message
+        if session.messages[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session.messages.pop(0)
 
-                return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        body = {
+            "app_code": app_code,
+            "messages": session.messages,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+        }
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, mode={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+        return session_id, body, headers
 
+    def _chat_stream(self, base_url, body, headers, session_id, stream_callback):
+        """
+        以SSE流式接收回复，每段内容到达后交给stream_callback，会话只在结束后更新一次
+        :return: 回复，还没收到任何内容时出错会抛出异常，可以重试
+        """
+        content = []
+        try:
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=dict(body, stream=True), headers=headers,
+                                   timeout=conf().get("request_timeout", 180), stream=True)
+            if res.status_code != 200:
+                return self._handle_chat_response(res.status_code, res.json(), session_id, res.headers)
+            last = {}
+            for line in res.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                last = json.loads(data)
+                if not last.get("choices"):
+                    continue
+                delta = last["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    content.append(delta)
+                    stream_callback(delta)
         except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
-
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return {
-                "total_tokens": 0,
-                "completion_tokens": 0,
-                "content": "请再问我一次吧"
-            }
+            if content:  # 已经发出部分内容，不再重试，避免重复发送
+                raise GiveUp(e)
+            raise
+
+        reply_content = "".join(content)
+        if last.get("usage"):
+            total_tokens = last["usage"]["total_tokens"]
+        else:
+            # 流式响应可能不带usage，按本地计数估算
+            total_tokens = num_tokens_from_messages(body["messages"], body["model"]) + tokenizer.num_tokens(reply_content, body["model"])
+        logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+        self.sessions.session_reply(reply_content, session_id, total_tokens)
+        suffix = self._fecth_knowledge_search_suffix(last)
+        if suffix:
+            reply_content += suffix
+        return Reply(ReplyType.TEXT, reply_content)
+
+    def _handle_chat_response(self, status_code, response, session_id, headers=None):
+        """
+        处理对话响应
+        :return: 回复，服务端错误时抛出RetryableError
+        """
+        if status_code == 200:
+            # execute success
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+            self.sessions.session_reply(reply_content, session_id, total_tokens)
+            suffix = self._fecth_knowledge_search_suffix(response)
+            if suffix:
+                reply_content += suffix
+            return Reply(ReplyType.TEXT, reply_content)
+
+        error = response.get("error")
+        logger.error(f"[LINKAI] chat failed, status_code={status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        if status_code >= 500:
+            # server error, need retry
+            raise RetryableError(f"server error, status_code={status_code}", headers.get("Retry-After") if headers else None)
 
+        return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+
+    def reply_text(self, session: ChatGPTSession, app_code="") -> dict:
         try:
             body = {
                 "app_code": app_code,
@@ -145,48 +226,47 @@ class LinkAIBot(Bot, OpenAIImage):
             if self.args.get("max_tokens"):
                 body["max_tokens"] = self.args.get("max_tokens")
             headers = {"Authorization": "Bearer " +  conf().get("linkai_api_key")}
+            return self.retry_policy.call(self._reply_text_once, body, headers)
+        except Exception as e:
+            logger.exception(e)
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return {
+                "total_tokens": 0,
+                "completion_tokens": 0,
+                "content": "请再问我一次吧"
+            }
 
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
-                return {
-                    "total_tokens": total_tokens,
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": reply_content,
-                }
+    def _reply_text_once(self, body, headers) -> dict:
+        # do http request
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.chat")
+        res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                               timeout=conf().get("request_timeout", 180))
+        if res.status_code == 200:
+            # execute success
+            response = res.json()
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+            return {
+                "total_tokens": total_tokens,
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": reply_content,
+            }
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
-
-                return {
-                    "total_tokens": 0,
-                    "completion_tokens": 0,
-                    "content": "提问太快啦，请休息一下再问我吧"
-                }
+        response = res.json()
+        error = response.get("error")
+        logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+        if res.status_code >= 500:
+            # server error, need retry
+            raise RetryableError(f"server error, status_code={res.status_code}", res.headers.get("Retry-After"))
 
+        return {
+            "total_tokens": 0,
+            "completion_tokens": 0,
+            "content": "提问太快啦，请休息一下再问我吧"
+        }
 
     def _fecth_knowledge_search_suffix(self, response) -> str:
         try:
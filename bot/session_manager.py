@@ -1,8 +1,59 @@
-from common.expired_dict import ExpiredDict
+from bot.session_store import get_session_store
 from common.log import logger
+from common.ttl_cache import TTLCache
 from config import conf
 
 
+class Message(dict):
+    """
+    会话中的一条消息，缓存按模型计算的token数，避免每次裁剪会话都重新计算全部历史消息
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = {}  # 计数方式 -> token数
+        self.seq = None  # 在会话存储中的序号，未保存时为None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.tokens.clear()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.tokens.clear()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.tokens.clear()
+
+    def pop(self, *args):
+        self.tokens.clear()
+        return super().pop(*args)
+
+    def __reduce__(self):
+        # 序列化时不带缓存，跨进程传递后重新计算
+        return Message, (dict(self),)
+
+    def count_tokens(self, key, counter):
+        """
+        :param key: 计数方式，如模型名称
+        :param counter: 计算token数的函数 counter(message)
+        """
+        tokens = self.tokens.get(key)
+        if tokens is None:
+            tokens = self.tokens[key] = counter(self)
+        return tokens
+
+
+def count_message_tokens(message, key, counter):
+    """
+    计算单条消息的token数，Message会缓存结果，插件等直接放入的普通dict每次重新计算
+    """
+    if isinstance(message, Message):
+        return message.count_tokens(key, counter)
+    return counter(message)
+
+
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
@@ -14,7 +65,7 @@ class Session(object):
 
     # 重置会话
     def reset(self):
-        system_item = {"role": "system", "content": self.system_prompt}
+        system_item = Message(role="system", content=self.system_prompt)
         self.messages = [system_item]
 
     def set_system_prompt(self, system_prompt):
@@ -22,11 +73,11 @@ class Session(object):
         self.reset()
 
     def add_query(self, query):
-        user_item = {"role": "user", "content": query}
+        user_item = Message(role="user", content=query)
         self.messages.append(user_item)
 
     def add_reply(self, reply):
-        assistant_item = {"role": "assistant", "content": reply}
+        assistant_item = Message(role="assistant", content=reply)
         self.messages.append(assistant_item)
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
@@ -38,11 +89,16 @@ class Session(object):
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        self.store = get_session_store()
+        self.namespace = sessioncls.__name__ + ":"  # 不同bot的会话在存储中互不影响
+        self.sessions = TTLCache(
+            # 持久化存储时内存中只保留活跃的会话，会话本身的过期由存储判断
+            ttl=conf().get("session_idle_seconds", 600) if self.store.persistent else conf().get("expires_in_seconds"),
+            max_size=conf().get("session_max_count"),
+            max_bytes=conf().get("session_max_bytes"),
+            sizeof=session_size,
+            on_evict=self.on_evict,
+        )
         self.sessioncls = sessioncls
         self.session_args = session_args
 
@@ -54,13 +110,63 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+        session = None if self.store.shared else self.sessions.get(session_id)  # 共享存储中的会话可能已被其他实例修改
+        if session is None:
+            session = self._load_session(session_id)
+        if session is None:
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            self._save_session(session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+            session.set_system_prompt(system_prompt)
+            self._save_session(session)
         return session
 
+    def _load_session(self, session_id):
+        data = self.store.load(self.namespace + str(session_id))
+        if data is None:
+            return None
+        system_prompt, rows, next_seq = data
+        session = self.sessioncls(session_id, system_prompt, **self.session_args)
+        messages = []
+        for seq, role, content in rows:
+            message = Message(role=role, content=content)
+            message.seq = seq
+            messages.append(message)
+        session.messages = [message for message in session.messages if message.get("role") == "system"] + messages
+        session.next_seq = next_seq
+        self.sessions[session_id] = session
+        logger.debug("[SessionManager] session {} loaded, {} messages".format(session_id, len(messages)))
+        return session
+
+    def _save_session(self, session):
+        """
+        重新写入缓存以更新会话大小，并把新增的消息追加到存储中
+        """
+        self.sessions[session.session_id] = session
+        if not self.store.persistent:
+            return
+        messages = session.messages
+        new_messages = []
+        for i in range(len(messages) - 1, -1, -1):  # 从末尾向前找到上次保存的位置
+            message = messages[i]
+            if message.get("role") == "system":
+                break
+            if not isinstance(message, Message):
+                message = messages[i] = Message(message)
+            if message.seq is not None:
+                break
+            new_messages.append(message)
+        next_seq = getattr(session, "next_seq", 0)
+        rows = []
+        for message in reversed(new_messages):
+            message.seq = next_seq
+            next_seq += 1
+            rows.append((message.seq, message["role"], message["content"]))
+        session.next_seq = next_seq
+        first = next((message for message in messages[:2] if message.get("role") != "system"), None)
+        start_seq = first.seq if first is not None else next_seq
+        self.store.append(self.namespace + str(session.session_id), session.system_prompt, start_seq, rows)
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
@@ -70,6 +176,8 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        if session_id is not None:
+            self._save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +189,24 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        if session_id is not None:
+            self._save_session(session)
         return session
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        self.sessions.pop(session_id, None)
+        self.store.delete(self.namespace + str(session_id))
 
     def clear_all_session(self):
         self.sessions.clear()
+        self.store.clear(self.namespace)
+
+    def on_evict(self, session_id, session, reason):
+        logger.debug("[SessionManager] session {} evicted: {}".format(session_id, reason))
+
+
+def session_size(session):
+    """
+    会话中消息内容的字节数，用于限制会话占用的总内存
+    """
+    return sum(len(str(message.get("content", "")).encode("utf-8")) for message in session.messages)
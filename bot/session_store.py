@@ -0,0 +1,263 @@
+"""
+会话历史的存储后端，SessionManager在内存中只保留活跃的会话，其余会话按需从存储中加载
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore:
+    """
+    默认的内存存储，会话只保存在SessionManager的缓存中，过期或重启后丢失
+    """
+
+    persistent = False
+    shared = False  # 是否由多个实例共享，共享时每次都从存储中读取最新的会话
+
+    def load(self, session_id):
+        """
+        :return: (system_prompt, [(seq, role, content)], next_seq)，不存在或已过期返回None
+        """
+        return None
+
+    def append(self, session_id, system_prompt, start_seq, rows):
+        """
+        追加新消息并更新会话头
+        :param start_seq: 会话中第一条保留的消息序号，之前的消息已被裁剪或重置
+        :param rows: 新消息 [(seq, role, content)]
+        """
+        pass
+
+    def delete(self, session_id):
+        pass
+
+    def clear(self, prefix):
+        """
+        删除session_id以prefix开头的所有会话
+        """
+        pass
+
+    def flush(self, timeout=5):
+        return True
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    WAL模式的SQLite存储，消息按序号追加写入，由后台线程批量提交
+    """
+
+    persistent = True
+
+    def __init__(self, path, expires_in_seconds=None, flush_interval=0.05):
+        self.path = path
+        self.expires_in_seconds = expires_in_seconds
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        self.ops = []  # 等待提交的操作
+        self.flushed_seq = 0  # 已提交到磁盘的操作序号
+        self.pending_seq = 0  # 最新的操作序号
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, system_prompt TEXT, start_seq INTEGER, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS messages (session_id TEXT, seq INTEGER, role TEXT, content TEXT, PRIMARY KEY (session_id, seq)) WITHOUT ROWID")
+        self._purge_expired(conn)
+        conn.close()
+        thread = threading.Thread(target=self._run, name="session-store")
+        thread.setDaemon(True)
+        thread.start()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # 多个工作进程共用同一个文件
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _purge_expired(self, conn):
+        if not self.expires_in_seconds:
+            return
+        deadline = time.time() - self.expires_in_seconds
+        with conn:
+            conn.execute("DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE updated < ?)", (deadline,))
+            cnt = conn.execute("DELETE FROM sessions WHERE updated < ?", (deadline,)).rowcount
+        if cnt:
+            logger.info("[SessionStore] purged {} expired sessions".format(cnt))
+
+    def load(self, session_id):
+        # 该会话可能还有未提交的写入
+        with self.cond:
+            has_pending = self.pending_seq > self.flushed_seq
+        if has_pending:
+            self.flush()
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT system_prompt, start_seq, updated FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            system_prompt, start_seq, updated = row
+            if self.expires_in_seconds and time.time() - updated > self.expires_in_seconds:
+                self.delete(session_id)
+                return None
+            rows = conn.execute("SELECT seq, role, content FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq", (session_id, start_seq)).fetchall()
+        finally:
+            conn.close()
+        next_seq = rows[-1][0] + 1 if rows else start_seq
+        return system_prompt, rows, next_seq
+
+    def append(self, session_id, system_prompt, start_seq, rows):
+        self._add_op(("append", session_id, system_prompt, start_seq, rows, time.time()))
+
+    def delete(self, session_id):
+        self._add_op(("delete", session_id))
+
+    def clear(self, prefix):
+        self._add_op(("clear", prefix))
+
+    def _add_op(self, op):
+        with self.cond:
+            self.ops.append(op)
+            self.pending_seq += 1
+            self.cond.notify()
+
+    def flush(self, timeout=5):
+        """
+        等待已有的写入提交到磁盘
+        """
+        with self.cond:
+            seq = self.pending_seq
+            self.cond.notify()
+            return self.cond.wait_for(lambda: self.flushed_seq >= seq, timeout)
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            with self.cond:
+                while not self.ops:
+                    self.cond.wait()
+            time.sleep(self.flush_interval)  # 攒一批再提交
+            with self.cond:
+                ops, self.ops = self.ops, []
+                seq = self.pending_seq
+            try:
+                self._commit(conn, ops)
+            except Exception as e:
+                logger.exception("[SessionStore] commit {} ops failed: {}".format(len(ops), e))
+            with self.cond:
+                self.flushed_seq = seq
+                self.cond.notify_all()
+
+    def _commit(self, conn, ops):
+        # 按顺序执行，整批在同一个事务中提交
+        with conn:
+            for op in ops:
+                if op[0] == "append":
+                    _, session_id, system_prompt, start_seq, rows, updated = op
+                    if rows:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                            [(session_id, seq, role, content) for seq, role, content in rows],
+                        )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sessions (session_id, system_prompt, start_seq, updated) VALUES (?, ?, ?, ?)",
+                        (session_id, system_prompt, start_seq, updated),
+                    )
+                    conn.execute("DELETE FROM messages WHERE session_id = ? AND seq < ?", (session_id, start_seq))  # 清理已裁剪的消息
+                elif op[0] == "delete":
+                    conn.execute("DELETE FROM messages WHERE session_id = ?", (op[1],))
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (op[1],))
+                elif op[0] == "clear":
+                    # session_id范围查询可以使用主键索引
+                    bounds = (op[1], op[1] + "\U0010ffff")
+                    conn.execute("DELETE FROM messages WHERE session_id >= ? AND session_id < ?", bounds)
+                    conn.execute("DELETE FROM sessions WHERE session_id >= ? AND session_id < ?", bounds)
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis存储，多个实例共享会话，每次读写都是一次pipeline往返
+    会话头保存在hash中，消息保存在以序号为分数的有序集合中，追加、裁剪都是幂等操作，过期由Redis处理
+    """
+
+    persistent = True
+    shared = True
+
+    def __init__(self, client, prefix="cow:", expires_in_seconds=None):
+        self.client = client
+        self.prefix = prefix
+        self.expires_in_seconds = expires_in_seconds
+
+    def _keys(self, session_id):
+        return self.prefix + "session:" + session_id, self.prefix + "messages:" + session_id
+
+    def load(self, session_id):
+        head_key, messages_key = self._keys(session_id)
+        head, members = self.client.execute_many([("HMGET", head_key, "system_prompt", "start_seq"), ("ZRANGE", messages_key, 0, -1)])
+        system_prompt, start_seq = head
+        if start_seq is None:
+            return None
+        start_seq = int(start_seq)
+        rows = [tuple(row) for row in map(json.loads, members) if row[0] >= start_seq]
+        next_seq = rows[-1][0] + 1 if rows else start_seq
+        return system_prompt, rows, next_seq
+
+    def append(self, session_id, system_prompt, start_seq, rows):
+        head_key, messages_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        if rows:
+            args = []
+            for row in rows:
+                args += [row[0], json.dumps(row, ensure_ascii=False)]
+            pipe.command("ZADD", messages_key, *args)
+        pipe.command("HSET", head_key, "system_prompt", system_prompt, "start_seq", start_seq)
+        pipe.command("ZREMRANGEBYSCORE", messages_key, "-inf", "({}".format(start_seq))  # 清理已裁剪的消息
+        if self.expires_in_seconds:
+            pipe.command("EXPIRE", head_key, self.expires_in_seconds)
+            pipe.command("EXPIRE", messages_key, self.expires_in_seconds)
+        pipe.execute()
+
+    def delete(self, session_id):
+        self.client.execute("DEL", *self._keys(session_id))
+
+    def clear(self, prefix):
+        for key_type in ["session:", "messages:"]:
+            cursor = "0"
+            while True:
+                cursor, keys = self.client.execute("SCAN", cursor, "MATCH", self.prefix + key_type + prefix + "*", "COUNT", 1000)
+                if keys:
+                    self.client.execute("DEL", *keys)
+                if cursor == "0":
+                    break
+
+
+_store = None
+_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """
+    按session_backend配置返回当前进程共用的会话存储
+    """
+    global _store
+    with _lock:
+        if _store is None:
+            backend = conf().get("session_backend", "memory")
+            if backend == "sqlite":
+                path = os.path.join(get_appdata_dir(), "sessions.db")
+                _store = SqliteSessionStore(path, conf().get("expires_in_seconds"))
+                logger.info("[SessionStore] open {}".format(path))
+            elif backend == "redis":
+                from common.redis_client import get_redis_client
+
+                _store = RedisSessionStore(get_redis_client(), conf().get("redis_prefix", "cow:"), conf().get("expires_in_seconds"))
+            else:
+                if backend != "memory":
+                    logger.warning("[SessionStore] unknown session_backend {}, use memory".format(backend))
+                _store = SessionStore()
+        return _store
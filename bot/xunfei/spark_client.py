@@ -0,0 +1,192 @@
+# encoding:utf-8
+
+"""
+讯飞星火的websocket客户端，所有请求在全局事件循环中执行，不再为每个请求创建线程
+空闲时预先建立少量连接，请求到来时省去TCP和websocket握手；服务端没有关闭的连接在请求结束后放回连接池复用
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import time
+from collections import deque
+from datetime import datetime
+from time import mktime
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+from common.async_loop import get_http_session
+from common.log import logger
+
+
+class SparkError(Exception):
+    def __init__(self, code, message):
+        super().__init__("spark error {}: {}".format(code, message))
+        self.code = code
+
+
+class SparkClient:
+    CONNECT_TIMEOUT = 10  # 建立连接的超时时间(秒)
+    IDLE_TIMEOUT = 50  # 预先建立的连接空闲超过该时间后不再使用，url中的签名只在5分钟内有效，服务端也会关闭长时间空闲的连接
+
+    def __init__(self, app_id, api_key, api_secret, spark_url, domain, pool_size=2, timeout=30, max_reply_chars=16384):
+        """
+        :param pool_size: 最多保持的空闲连接数
+        :param timeout: 单个请求从发送到收完回复的超时时间(秒)
+        :param max_reply_chars: 单个回复最多保留的字符数，超出后截断并结束请求
+        """
+        self.app_id = app_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.spark_url = spark_url
+        self.host = urlparse(spark_url).netloc
+        self.path = urlparse(spark_url).path
+        self.domain = domain
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_reply_chars = max_reply_chars
+        # 以下状态只在全局事件循环中访问，不需要加锁
+        self.idle = deque()  # 空闲连接 (websocket, 放入时间)
+        self.connecting = 0  # 正在后台建立的连接数
+
+    async def achat(self, messages, temperature=0.5):
+        """
+        发送对话请求，必须在全局事件循环中调用
+        :return: (回复内容, usage)
+        """
+        try:
+            return await asyncio.wait_for(self._chat(messages, temperature), self.timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("spark request timeout after {}s".format(self.timeout))
+
+    async def _chat(self, messages, temperature):
+        ws, reused = await self._acquire()
+        completed = False
+        try:
+            try:
+                result = await self._request(ws, messages, temperature)
+            except ConnectionResetError:
+                if not reused:
+                    raise
+                # 空闲的连接已被服务端关闭，换一个新连接重试
+                logger.debug("[XunFei] idle connection closed by server, reconnect")
+                ws = await self._connect()
+                result = await self._request(ws, messages, temperature)
+            completed = True
+            return result
+        finally:
+            # 超时或出错时连接上可能还有未读完的回复，不能再复用
+            self._release(ws, completed)
+            self._fill()
+
+    async def _request(self, ws, messages, temperature):
+        import aiohttp
+
+        await ws.send_str(json.dumps(self.gen_params(messages, temperature)))
+        parts = []
+        size = 0
+        while True:
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                if not parts and msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED):
+                    raise ConnectionResetError("websocket closed before reply")
+                raise ConnectionError("unexpected websocket message: {}".format(msg.type))
+            data = json.loads(msg.data)
+            code = data["header"]["code"]
+            if code != 0:
+                await ws.close()
+                raise SparkError(code, data["header"].get("message"))
+            choices = data["payload"]["choices"]
+            content = choices["text"][0]["content"]
+            if size + len(content) > self.max_reply_chars:
+                logger.warn("[XunFei] reply exceeds {} chars, truncated".format(self.max_reply_chars))
+                parts.append(content[: self.max_reply_chars - size])
+                await ws.close()
+                return "".join(parts), {}
+            parts.append(content)
+            size += len(content)
+            if choices["status"] == 2:
+                return "".join(parts), data["payload"].get("usage", {}).get("text", {})
+
+    async def _acquire(self):
+        """
+        :return: (websocket, 是否为之前建立的空闲连接)
+        """
+        now = time.monotonic()
+        while self.idle:
+            ws, idle_since = self.idle.popleft()
+            if not ws.closed and now - idle_since < self.IDLE_TIMEOUT:
+                return ws, True
+            asyncio.ensure_future(ws.close())
+        return await self._connect(), False
+
+    def _release(self, ws, reusable=True):
+        if not reusable or ws.closed or len(self.idle) >= self.pool_size:
+            asyncio.ensure_future(ws.close())
+            return
+        self.idle.append((ws, time.monotonic()))
+
+    def _fill(self):
+        """
+        在后台补充空闲连接，下一个请求不用等待建立连接
+        """
+        for _ in range(self.pool_size - len(self.idle) - self.connecting):
+            self.connecting += 1
+            asyncio.ensure_future(self._preconnect())
+
+    async def _preconnect(self):
+        try:
+            ws = await self._connect()
+            self.idle.append((ws, time.monotonic()))
+        except Exception as e:
+            logger.warn("[XunFei] preconnect failed: {}".format(e))
+        finally:
+            self.connecting -= 1
+
+    async def _connect(self):
+        return await asyncio.wait_for(get_http_session().ws_connect(self.create_url()), self.CONNECT_TIMEOUT)
+
+    # 生成url
+    def create_url(self):
+        # 生成RFC1123格式的时间戳
+        now = datetime.now()
+        date = format_date_time(mktime(now.timetuple()))
+
+        # 拼接字符串
+        signature_origin = "host: " + self.host + "\n"
+        signature_origin += "date: " + date + "\n"
+        signature_origin += "GET " + self.path + " HTTP/1.1"
+
+        # 进行hmac-sha256进行加密
+        signature_sha = hmac.new(self.api_secret.encode("utf-8"), signature_origin.encode("utf-8"), digestmod=hashlib.sha256).digest()
+
+        signature_sha_base64 = base64.b64encode(signature_sha).decode(encoding="utf-8")
+
+        authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", ' f'signature="{signature_sha_base64}"'
+
+        authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode(encoding="utf-8")
+
+        # 将请求的鉴权参数组合为字典
+        v = {"authorization": authorization, "date": date, "host": self.host}
+        # 拼接鉴权参数，生成url
+        return self.spark_url + "?" + urlencode(v)
+
+    def gen_params(self, messages, temperature=0.5):
+        """
+        通过appid和用户的提问来生成请参数
+        """
+        return {
+            "header": {"app_id": self.app_id, "uid": "1234"},
+            "parameter": {
+                "chat": {
+                    "domain": self.domain,
+                    "temperature": temperature,
+                    "random_threshold": 0.5,
+                    "max_tokens": 2048,
+                    "auditing": "default",
+                }
+            },
+            "payload": {"message": {"text": messages}},
+        }
@@ -1,8 +1,10 @@
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from bridge.shard_pool import ShardedBot, get_shard_pool
 from common import const
 from common.log import logger
+from common.single_flight import SingleFlight
 from common.singleton import singleton
 from config import conf
 from my_translate.factory import create_translator
@@ -33,6 +35,8 @@ class Bridge(object):
             self.btype["chat"] = const.CLAUDEAI
         self.bots = {}
         self.chat_bots = {}
+        if not hasattr(self, "single_flight"):  # reset_bot时保留统计数据
+            self.single_flight = SingleFlight()
 
     def get_bot(self, typename):
         if self.bots.get(typename) is None:
@@ -42,7 +46,8 @@ class Bridge(object):
             elif typename == "voice_to_text":
                 self.bots[typename] = create_voice(self.btype[typename])
             elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
+                pool = get_shard_pool()
+                self.bots[typename] = ShardedBot(pool) if pool else create_bot(self.btype[typename])
             elif typename == "translate":
                 self.bots[typename] = create_translator(self.btype[typename])
         return self.bots[typename]
@@ -51,12 +56,69 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        bot = self.get_bot("chat")
+        key = self._single_flight_key(bot, query, context)
+        if key is None:
+            return bot.reply(query, context)
+        reply, shared = self.single_flight.do(key, bot.reply, query, context)
+        return self._share_reply(bot, query, context, reply, shared)
+
+    async def afetch_reply_content(self, query, context: Context) -> Reply:
+        bot = self.get_bot("chat")
+        key = self._single_flight_key(bot, query, context)
+        if key is None:
+            return await bot.areply(query, context)
+        reply, shared = await self.single_flight.ado(key, bot.areply, query, context)
+        return self._share_reply(bot, query, context, reply, shared)
+
+    def _single_flight_key(self, bot, query, context: Context):
+        """
+        开启single_flight后，没有上下文的文字请求按照(问题, 人设, 模型, api key)合并，返回None表示不合并
+        """
+        if not conf().get("single_flight", False) or context is None or context.type != ContextType.TEXT:
+            return None
+        if query.startswith("#") or getattr(bot, "sessions", None) is None:
+            return None
+        if isinstance(bot, ShardedBot):  # 多进程模式下在会话所在的工作进程中合并
+            return None
+        session_id = context.get("session_id")
+        session = bot.sessions.sessions.peek(session_id) if session_id is not None else None
+        if session is None:
+            system_prompt = conf().get("character_desc", "")
+        elif all(message["role"] == "system" for message in session.messages):
+            system_prompt = session.system_prompt
+        else:
+            return None  # 有历史消息的会话，回复与上下文有关
+        normalized_query = " ".join(query.split())
+        model = context.get("gpt_model") or conf().get("model")
+        return (self.btype["chat"], normalized_query, system_prompt, model, context.get("openai_api_key"), context.kwargs.get("app_code"))
+
+    def _share_reply(self, bot, query, context: Context, reply: Reply, shared) -> Reply:
+        """
+        多个请求共享同一个回复对象，每个请求返回一份拷贝，共享结果的请求补充记录自己的会话
+        """
+        if reply is None:
+            return reply
+        if shared:
+            logger.info("[Bridge] share in-flight reply, session_id={}, query={}".format(context.get("session_id"), query))
+            if reply.type == ReplyType.TEXT and context.get("session_id") is not None:
+                bot.sessions.session_query(query, context["session_id"])
+                bot.sessions.session_reply(reply.content, context["session_id"])
+        return Reply(reply.type, reply.content)
+
+    def get_single_flight_stats(self) -> dict:
+        return self.single_flight.get_stats()
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
+        pool = get_shard_pool()
+        if pool:
+            return pool.submit(None, "voice_to_text", voiceFile).result()
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
     def fetch_text_to_voice(self, text) -> Reply:
+        pool = get_shard_pool()
+        if pool:
+            return pool.submit(None, "text_to_voice", text).result()
         return self.get_bot("text_to_voice").textToVoice(text)
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
@@ -64,7 +126,8 @@ class Bridge(object):
 
     def find_chat_bot(self, bot_type: str):
         if self.chat_bots.get(bot_type) is None:
-            self.chat_bots[bot_type] = create_bot(bot_type)
+            pool = get_shard_pool()
+            self.chat_bots[bot_type] = ShardedBot(pool, bot_type) if pool else create_bot(bot_type)
         return self.chat_bots.get(bot_type)
 
     def reset_bot(self):
@@ -2,6 +2,8 @@
 
 from enum import Enum
 
+from bridge.reply import ReplyType
+
 
 class ContextType(Enum):
     TEXT = 1  # 文本消息
@@ -67,3 +69,85 @@ class Context:
 
     def __str__(self):
         return "Context(type={}, content={}, kwargs={})".format(self.type, self.content, self.kwargs)
+
+    def to_dict(self) -> dict:
+        """
+        转换为可以json序列化的dict，用于跨进程传递或持久化
+        msg只保留ChatMessage的基本字段，其他无法序列化的值会被忽略
+        """
+        kwargs = {}
+        for key, value in self.kwargs.items():
+            if key == "msg" and value is not None:
+                value = {name: _dump_value(getattr(value, name, None)) for name in _MSG_FIELDS}
+                value = {name: field for name, field in value.items() if field is not _SKIP}
+            else:
+                value = _dump_value(value)
+            if value is not _SKIP:
+                kwargs[key] = value
+        return {"type": self.type.name if self.type else None, "content": self.content, "kwargs": kwargs}
+
+    @staticmethod
+    def from_dict(data: dict) -> "Context":
+        from channel.chat_message import ChatMessage
+
+        kwargs = {}
+        for key, value in data["kwargs"].items():
+            if key == "msg" and value is not None:
+                msg = ChatMessage(None)
+                for name, field in value.items():
+                    setattr(msg, name, _load_value(field))
+                value = msg
+            kwargs[key] = _load_value(value)
+        return Context(ContextType[data["type"]] if data["type"] else None, data["content"], kwargs)
+
+
+_ENUMS = {"ContextType": ContextType, "ReplyType": ReplyType}
+_MSG_FIELDS = [
+    "msg_id",
+    "create_time",
+    "ctype",
+    "content",
+    "from_user_id",
+    "from_user_nickname",
+    "to_user_id",
+    "to_user_nickname",
+    "other_user_id",
+    "other_user_nickname",
+    "my_msg",
+    "self_display_name",
+    "is_group",
+    "is_at",
+    "actual_user_id",
+    "actual_user_nickname",
+    "at_list",
+]
+
+
+_SKIP = object()
+
+
+def _dump_value(value):
+    """
+    转换为可以json序列化的值，枚举转为dict，无法序列化时返回_SKIP
+    """
+    if isinstance(value, (ContextType, ReplyType)):
+        return {"__enum__": type(value).__name__, "name": value.name}
+    if _is_plain(value):
+        return value
+    return _SKIP
+
+
+def _load_value(value):
+    if isinstance(value, dict) and "__enum__" in value:
+        return _ENUMS[value["__enum__"]][value["name"]]
+    return value
+
+
+def _is_plain(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _is_plain(v) for k, v in value.items())
+    return False
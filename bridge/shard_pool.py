@@ -0,0 +1,306 @@
+"""
+多进程分片：消息通道留在主进程，bot调用和语音转换交给N个工作进程执行
+同一个session_id固定分配到同一个工作进程，每个工作进程维护自己那部分会话的SessionManager
+"""
+
+import asyncio
+import atexit
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from bot.bot import Bot
+from bridge.context import Context
+from common import tokenizer
+from common.log import logger
+from config import conf, load_config
+
+_pool = None
+_lock = threading.Lock()
+_in_worker = False  # 当前是否为工作进程，工作进程中不再创建分片池
+
+
+def get_shard_pool():
+    """
+    获取分片池，worker_processes大于0时在主进程中首次调用时创建，否则返回None
+    """
+    global _pool
+    if _in_worker or not conf().get("worker_processes", 0):
+        return None
+    with _lock:
+        if _pool is None:
+            _pool = ShardPool(conf().get("worker_processes"))
+        return _pool
+
+
+def shard_of(key, shards) -> int:
+    # 内置hash()在每个进程中的随机种子不同，这里使用稳定的crc32
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+class ShardPool:
+    CHECK_INTERVAL = 1  # 检查工作进程是否存活的间隔(秒)
+
+    def __init__(self, processes):
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.result_queue = self.mp_context.Queue()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.round_robin = itertools.count()
+        self.pending = [{} for _ in range(processes)]  # 每个工作进程中执行中的任务，task_id -> Future
+        self.task_queues = [None] * processes
+        self.workers = [None] * processes
+        for shard in range(processes):
+            self._start_worker(shard)
+        thread = threading.Thread(target=self._receive_results, name="shard-results")
+        thread.setDaemon(True)
+        thread.start()
+        atexit.register(self.shutdown)
+        logger.info("[ShardPool] started {} worker processes".format(processes))
+
+    def _start_worker(self, shard):
+        task_queue = self.mp_context.Queue()
+        worker = self.mp_context.Process(target=_worker_main, args=(shard, task_queue, self.result_queue), name="shard-{}".format(shard))
+        worker.daemon = True
+        worker.start()
+        self.task_queues[shard] = task_queue
+        self.workers[shard] = worker
+
+    def submit(self, shard_key, method, *args) -> Future:
+        """
+        在shard_key对应的工作进程中执行method，shard_key为None时轮流分配
+        """
+        if shard_key is None:
+            shard = next(self.round_robin) % len(self.workers)
+        else:
+            shard = shard_of(shard_key, len(self.workers))
+        return self._submit(shard, method, args)
+
+    def broadcast(self, method, *args) -> list:
+        """
+        在所有工作进程中执行method，如清空所有会话、重新加载配置
+        """
+        return [self._submit(shard, method, args) for shard in range(len(self.workers))]
+
+    def _submit(self, shard, method, args) -> Future:
+        future = Future()
+        task_id = next(self.counter)
+        with self.lock:
+            self.pending[shard][task_id] = future
+        self.task_queues[shard].put((task_id, method, args))
+        return future
+
+    def _receive_results(self):
+        last_check = time.monotonic()
+        while True:
+            # 其他工作进程持续返回结果时get不会超时，按固定间隔检查，不依赖超时
+            if time.monotonic() - last_check >= self.CHECK_INTERVAL:
+                self._check_workers()
+                last_check = time.monotonic()
+            try:
+                shard, task_id, ok, result = self.result_queue.get(timeout=self.CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            except Exception as e:
+                logger.exception("[ShardPool] receive result error: {}".format(e))
+                continue
+            with self.lock:
+                future = self.pending[shard].pop(task_id, None)
+            if future is None or future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    # 工作进程意外退出时，让它执行中的任务失败并重新启动它
+    def _check_workers(self):
+        for shard, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            logger.error("[ShardPool] worker {} exited with code {}, restart it".format(shard, worker.exitcode))
+            with self.lock:
+                futures, self.pending[shard] = self.pending[shard], {}
+            for future in futures.values():
+                future.set_exception(RuntimeError("worker process {} exited".format(shard)))
+            self._start_worker(shard)
+
+    def shutdown(self):
+        for task_queue in self.task_queues:
+            try:
+                task_queue.put(None)
+            except Exception:
+                pass
+
+
+class ShardedBot(Bot):
+    """
+    主进程中代替真正bot的代理，请求交给会话所在的工作进程处理
+    target为"chat"时对应Bridge().get_bot("chat")，否则对应Bridge().find_chat_bot(target)
+    """
+
+    def __init__(self, pool: ShardPool, target="chat"):
+        self.pool = pool
+        self.target = target
+        self.sessions = ShardedSessionManager(pool, target)
+
+    def reply(self, query, context: Context = None):
+        return self._submit(query, context).result()
+
+    async def areply(self, query, context: Context = None):
+        return await asyncio.wrap_future(self._submit(query, context))
+
+    def _submit(self, query, context: Context) -> Future:
+        session_id = context.get("session_id") if context else None
+        return self.pool.submit(session_id, "reply", self.target, query, context.to_dict() if context else None)
+
+
+class ShardedSessionManager:
+    """
+    主进程中代替SessionManager的代理，插件对会话的操作转发到会话所在的工作进程
+    """
+
+    def __init__(self, pool: ShardPool, target):
+        self.pool = pool
+        self.target = target
+
+    def _call(self, session_id, method, *args):
+        return self.pool.submit(session_id, "session", self.target, method, session_id, *args).result()
+
+    def build_session(self, session_id, system_prompt=None):
+        if session_id is None:
+            return RemoteSession(self, session_id, system_prompt, [])
+        system_prompt, messages = self._call(session_id, "build_session", system_prompt)
+        return RemoteSession(self, session_id, system_prompt, messages)
+
+    def session_query(self, query, session_id):
+        self._call(session_id, "session_query", query)
+        return self.build_session(session_id)
+
+    def session_reply(self, reply, session_id, total_tokens=None):
+        self._call(session_id, "session_reply", reply, total_tokens)
+        return self.build_session(session_id)
+
+    def clear_session(self, session_id):
+        self._call(session_id, "clear_session")
+
+    def clear_all_session(self):
+        for future in self.pool.broadcast("session", self.target, "clear_all_session", None):
+            future.result()
+
+
+class RemoteSession:
+    """
+    工作进程中会话的快照，修改人设和重置会同步到工作进程
+    """
+
+    def __init__(self, manager: ShardedSessionManager, session_id, system_prompt, messages):
+        self.manager = manager
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        self.messages = messages
+
+    def reset(self):
+        self.manager._call(self.session_id, "reset")
+        self.messages = [{"role": "system", "content": self.system_prompt}]
+
+    def set_system_prompt(self, system_prompt):
+        self.manager._call(self.session_id, "set_system_prompt", system_prompt)
+        self.system_prompt = system_prompt
+        self.messages = [{"role": "system", "content": system_prompt}]
+
+
+# 以下在工作进程中执行
+
+
+def _worker_main(shard, task_queue, result_queue):
+    global _in_worker
+    _in_worker = True
+    load_config()
+    tokenizer.warmup()
+    executor = ThreadPoolExecutor(max_workers=conf().get("worker_threads", 8), thread_name_prefix="shard-{}".format(shard))
+    logger.info("[ShardPool] worker {} started".format(shard))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        executor.submit(_run_task, shard, task, result_queue)
+    executor.shutdown(wait=False)
+
+
+def _run_task(shard, task, result_queue):
+    task_id, method, args = task
+    try:
+        result = (shard, task_id, True, _TASKS[method](*args))
+    except Exception as e:
+        logger.exception("[ShardPool] worker {} task {} error: {}".format(shard, method, e))
+        result = (shard, task_id, False, e)
+    try:
+        pickle.dumps(result)
+    except Exception as e:
+        result = (shard, task_id, False, RuntimeError("{} result can not be pickled: {}".format(method, e)))
+    result_queue.put(result)
+
+
+def _get_bot(target):
+    from bridge.bridge import Bridge
+
+    return Bridge().get_bot("chat") if target == "chat" else Bridge().find_chat_bot(target)
+
+
+def _task_reply(target, query, context_dict):
+    from bridge.bridge import Bridge
+
+    context = Context.from_dict(context_dict) if context_dict is not None else None
+    if target == "chat":
+        return Bridge().fetch_reply_content(query, context)
+    return _get_bot(target).reply(query, context)
+
+
+def _task_session(target, method, session_id, *args):
+    sessions = _get_bot(target).sessions
+    if method == "clear_all_session":
+        return sessions.clear_all_session()
+    if method == "clear_session":
+        return sessions.clear_session(session_id)
+    if method == "session_query":
+        sessions.session_query(args[0], session_id)
+    elif method == "session_reply":
+        sessions.session_reply(args[0], session_id, args[1])
+    elif method in ["reset", "set_system_prompt"]:
+        getattr(sessions.build_session(session_id), method)(*args)
+    elif method == "build_session":
+        session = sessions.build_session(session_id, *args)
+        return session.system_prompt, list(session.messages)
+    else:
+        raise ValueError("unknown session method: {}".format(method))
+
+
+def _task_voice_to_text(voice_file):
+    from bridge.bridge import Bridge
+
+    return Bridge().fetch_voice_to_text(voice_file)
+
+
+def _task_text_to_voice(text):
+    from bridge.bridge import Bridge
+
+    return Bridge().fetch_text_to_voice(text)
+
+
+def _task_load_config():
+    load_config()
+
+
+_TASKS = {
+    "reply": _task_reply,
+    "session": _task_session,
+    "voice_to_text": _task_voice_to_text,
+    "text_to_voice": _task_text_to_voice,
+    "load_config": _task_load_config,
+}
@@ -9,6 +9,8 @@ from bridge.reply import *
 
 class Channel(object):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE]
+    SUPPORT_STREAM = False  # 是否可以把一条回复拆成多条消息，边生成边发送
+    SUPPORT_REPLAY = False  # 登录后是否调用replay_pending重新处理上次未回复的消息，不支持的通道不写入持久化队列
 
     def startup(self):
         """
@@ -36,6 +38,9 @@ class Channel(object):
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def abuild_reply_content(self, query, context: Context = None) -> Reply:
+        return await Bridge().afetch_reply_content(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
@@ -1,15 +1,24 @@
+import asyncio
 import os
-import re
+import random
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import CancelledError, Future
 
+from bridge.bridge import Bridge
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.trigger_index import get_trigger_index, mention_pattern
+from common import metrics
+from common.async_loop import run_coroutine
+from common.delay_scheduler import DelayScheduler
+from common.durable_queue import get_durable_queue
 from common.dequeue import Dequeue
+from common.handler_lane import HandlerLane
 from common.log import logger
+from common.stream_chunker import SentenceChunker
 from config import conf
 from plugins import *
 
@@ -23,12 +32,27 @@ except Exception as e:
 class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
-    futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
-    sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
-    handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+    # 以下线程池和调度器在同一进程的所有channel之间共享
+    handler_lanes = {}  # 处理消息的线程池，按工作类型分为fast(插件指令)、slow(bot调用)、media(语音图片)三条通道，首次使用时创建
+    handler_initializer = None  # 处理线程的初始化函数
+    lanes_lock = threading.Lock()  # 用于控制handler_lanes的创建
+    retry_scheduler = DelayScheduler("send-retry")  # 发送失败后延迟重试，不占用处理线程
+    coalesce_scheduler = DelayScheduler("coalesce")  # 合并消息的等待窗口到期后重新调度session
+    instances = []  # 已创建的channel，用于统计所有channel的排队消息总数
 
     def __init__(self):
+        # 以下为每个channel自己的排队状态
+        self.futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
+        self.sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
+        self.lock = threading.RLock()  # 用于控制对sessions的访问，future的回调可能在持有锁的线程中同步执行，因此使用可重入锁
+        self.ready_cond = threading.Condition(self.lock)  # 有session就绪时唤醒consume线程
+        self.ready_queue = deque()  # 就绪的session_id队列：有排队的context且有空闲的并发名额
+        self.ready_set = set()  # ready_queue中已有的session_id，避免重复入队
+        self.queue_stats = {"queued": 0, "session_full": 0, "global_full": 0, "expired": 0, "draining": 0}  # 排队中的消息总数，以及因各种原因被丢弃的消息数
+        self.send_stats = {"retried": 0, "failed": 0}  # 发送重试次数，以及重试后仍失败的消息数
+        self.draining = False  # 退出前等待处理中的消息完成，不再接收新消息
+        self.stopped = False  # 等待结束后不再调度排队中的消息
+        self.instances.append(self)
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -44,6 +68,9 @@ class ChatChannel(Channel):
             context["origin_ctype"] = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
+        if first_in:
+            context["receive_time"] = time.time()
+        trigger_index = get_trigger_index()
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
@@ -55,26 +82,12 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if trigger_index.is_group_allowed(group_name):
                     session_id = cmsg.actual_user_id
                     #如果为空，则使用group_id
                     if session_id is None or session_id == "":
                         session_id = group_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if trigger_index.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     return None
@@ -102,8 +115,7 @@ class ChatChannel(Channel):
 
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix, match_contain = trigger_index.match_group_trigger(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -114,23 +126,20 @@ class ChatChannel(Channel):
                         logger.info("[WX]receive group at")
                         if not conf().get("group_at_off", False):
                             flag = True
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = mention_pattern(self.name).sub(r"", content)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = mention_pattern(at).sub(r"", subtract_res)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
                         logger.info("[WX]receive group voice, but checkprefix didn't match")
                     return None
             else:  # 单聊
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = trigger_index.match_single_prefix(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -138,7 +147,7 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix"))
+            img_match_prefix = trigger_index.match_image_create_prefix(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
@@ -162,11 +171,51 @@ class ChatChannel(Channel):
 
         logger.debug("[WX] ready to decorate reply: {}".format(reply))
         # reply的包装步骤
+        start_time = time.time()
         reply = self._decorate_reply(context, reply)
+        self._observe("decorate", context, start_time)
 
         # reply的发送步骤
         self._send_reply(context, reply)
 
+    # 异步模式下的消息处理协程，bot请求在事件循环中执行，插件和发送等同步步骤交给处理线程池执行
+    async def _ahandle(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.debug("[WX] ready to handle context: {}".format(context))
+        lane = self._select_lane(context)
+        reply = await self._agenerate_reply(context, lane)
+
+        logger.debug("[WX] ready to decorate reply: {}".format(reply))
+        start_time = time.time()
+        reply = await self._run_in_lane(lane, self._decorate_reply, context, reply)
+        self._observe("decorate", context, start_time)
+
+        await self._run_in_lane(lane, self._send_reply, context, reply)
+
+    async def _agenerate_reply(self, context: Context, lane: str, reply: Reply = Reply()) -> Reply:
+        if context.type not in [ContextType.TEXT, ContextType.IMAGE_CREATE]:
+            return await self._run_in_lane(lane, self._generate_reply, context, reply)
+        e_context = await PluginManager().aemit_event(
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+            offload=lambda func, *args: self._run_in_lane(lane, func, *args),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[WX] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if e_context.is_break():
+                context["generate_breaked_by"] = e_context["breaked_by"]
+            start_time = time.time()
+            reply = await super().abuild_reply_content(context.content, context)
+            self._observe("bot", context, start_time)
+        return reply
+
+    async def _run_in_lane(self, lane: str, func, *args):
+        return await asyncio.wrap_future(self.get_handler_lane(lane).submit(func, *args))
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
             EventContext(
@@ -180,7 +229,11 @@ class ChatChannel(Channel):
             if e_context.is_break():
                 context["generate_breaked_by"] = e_context["breaked_by"]
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                start_time = time.time()
+                chunker = self._start_stream(context)
                 reply = super().build_reply_content(context.content, context)
+                self._observe("bot", context, start_time)
+                reply = self._finish_stream(context, chunker, reply)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
@@ -220,7 +273,48 @@ class ChatChannel(Channel):
                 return
         return reply
 
-    def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
+    def _start_stream(self, context: Context):
+        """
+        开启stream_reply且channel支持发送多条消息时，bot流式返回的内容按句子切分后立即发送
+        :return: 用于切分的SentenceChunker，不使用流式回复时返回None
+        """
+        if not conf().get("stream_reply") or not self.SUPPORT_STREAM or context.type != ContextType.TEXT:
+            return None
+        if context.get("desire_rtype") == ReplyType.VOICE:
+            return None
+        # 后缀只加在最后一段，配置了后缀时每段等到下一段切出后再发送，才能确定哪一段是最后一段
+        suffix = conf().get("group_chat_reply_suffix", "") if context.get("isgroup", False) else conf().get("single_chat_reply_suffix", "")
+        chunker = SentenceChunker(lambda chunk, first, last: self._send_stream_chunk(context, chunk, first, last), conf().get("stream_chunk_chars", 200), hold_last=bool(suffix))
+        context["stream_callback"] = chunker.feed  # 支持流式请求的bot收到内容后调用，其他bot忽略
+        context["streaming"] = True  # 分段在当前线程中按顺序发送，处理结束后再确认持久化队列中的消息
+        return chunker
+
+    def _finish_stream(self, context: Context, chunker, reply: Reply) -> Reply:
+        """
+        :return: 回复已经流式发送完成时返回None，否则返回需要正常发送的回复
+        """
+        if chunker is None:
+            return reply
+        del context["stream_callback"]
+        try:
+            if not chunker.received:  # bot不支持流式请求，或者在返回内容之前就失败了
+                return reply
+            if reply and reply.type == ReplyType.TEXT:
+                chunker.finish(reply.content)
+                return None
+            return reply  # 中途失败，已发送的内容保留，再发送错误提示
+        finally:
+            del context["streaming"]  # 之后的回复按普通消息发送
+
+    def _send_stream_chunk(self, context: Context, chunk, first, last):
+        reply = self._decorate_reply(context, Reply(ReplyType.TEXT, chunk), first=first, last=last)
+        self._send_reply(context, reply)
+
+    def _decorate_reply(self, context: Context, reply: Reply, first=True, last=True) -> Reply:
+        """
+        :param first: 是否是回复的第一段，只有第一段加上@和前缀
+        :param last: 是否是回复的最后一段，只有最后一段加上后缀
+        """
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -242,10 +336,12 @@ class ChatChannel(Channel):
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
                     if context.get("isgroup", False):
-                        reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                        prefix, suffix = conf().get("group_chat_reply_prefix", ""), conf().get("group_chat_reply_suffix", "")
+                        if first:
+                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        prefix, suffix = conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", "")
+                    reply_text = (prefix if first else "") + reply_text + (suffix if last else "")
                     reply.content = reply_text
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
@@ -269,19 +365,46 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[WX] ready to send reply: {}, context: {}".format(reply, context))
+                start_time = time.time()
                 self._send(reply, context)
+                self._observe("send", context, start_time)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
             self.send(reply, context)
+            context["send_retrying"] = False
+            if not context.get("streaming"):  # 流式回复的分段发送后不确认，整个回复发送完成后由_thread_pool_callback确认
+                self._durable_ack(context)
         except Exception as e:
             logger.error("[WX] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            if retry_cnt < conf().get("send_retry_times", 2):
+                delay = conf().get("send_retry_delay", 3) * conf().get("send_retry_backoff", 2) ** retry_cnt
+                delay *= 1 + random.uniform(-1, 1) * conf().get("send_retry_jitter", 0.2)
+                logger.info("[WX] retry sending in {:.1f}s, retry_cnt={}".format(delay, retry_cnt + 1))
+                with self.lock:
+                    self.send_stats["retried"] += 1
+                if context.get("streaming"):
+                    # 流式回复的分段在当前线程中等待后重试，避免后面的分段先于它发送
+                    time.sleep(delay)
+                    self._send(reply, context, retry_cnt + 1)
+                    return
+                context["send_retrying"] = True  # 重试完成前不确认持久化队列中的消息
+                # 到期后提交到fast通道发送，当前处理线程立即释放
+                self.retry_scheduler.schedule(delay, self.get_handler_lane("fast").submit, self._send, reply, context, retry_cnt + 1)
+            else:
+                with self.lock:
+                    self.send_stats["failed"] += 1
+                logger.error("[WX] send failed after {} retries, reply={}".format(retry_cnt, reply))
+                context["send_retrying"] = False
+                if not context.get("streaming"):
+                    self._durable_ack(context)
+
+    # 记录从start_time到现在的耗时
+    def _observe(self, stage, context: Context, start_time):
+        metrics.observe(stage, time.time() - start_time, channel=type(self).__name__, ctype=context.type, bot=Bridge().get_bot_type("chat"))
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -289,6 +412,9 @@ class ChatChannel(Channel):
     def _fail_callback(self, session_id, exception, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("Worker return exception: {}".format(exception))
 
+    def _discard_callback(self, session_id, context, **kwargs):  # 消息没有处理就被丢弃(排队满、过期、退出中、取消)时的回调函数
+        logger.debug("Context discarded, session_id = {}".format(session_id))
+
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
             try:
@@ -299,15 +425,50 @@ class ChatChannel(Channel):
                     self._success_callback(session_id, **kwargs)
             except CancelledError as e:
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
+                self._discard_callback(session_id, **kwargs)
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
+            context = kwargs.get("context")
+            if context is not None and not context.get("send_retrying"):  # 处理结束，包括没有回复和处理失败的情况
+                self._durable_ack(context)
             with self.lock:
-                self.sessions[session_id][1].release()
+                if session_id not in self.sessions:
+                    return
+                context_queue, semaphore = self.sessions[session_id]
+                semaphore.release()
+                self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                if not context_queue.empty():
+                    self._mark_ready(session_id)
+                else:
+                    self._release_session_if_idle(session_id)
 
         return func
 
+    # 没有排队的消息，也没有处理中的任务时清理session，调用方需持有self.lock
+    def _release_session_if_idle(self, session_id):
+        context_queue, semaphore = self.sessions[session_id]
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.sessions[session_id]
+            del self.futures[session_id]
+
+    # 将session标记为就绪并唤醒consume线程，调用方需持有self.lock
+    def _mark_ready(self, session_id):
+        if session_id in self.ready_set:
+            return
+        self.ready_set.add(session_id)
+        self.ready_queue.append(session_id)
+        self.ready_cond.notify()
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        if self.draining:
+            self._reject_when_draining(context)
+            return
+        context["produce_time"] = time.time()
+        if "receive_time" in context and not context.get("replayed"):
+            self._observe("receive", context, context["receive_time"])
         with self.lock:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
@@ -315,54 +476,354 @@ class ChatChannel(Channel):
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
                 ]
             if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令，不受排队长度限制
             else:
+                shed_reason = self._check_queue_limit(session_id)
+                if shed_reason and not self._shed(context, shed_reason):
+                    self._release_session_if_idle(session_id)
+                    return
+                self._durable_append(context)
                 self.sessions[session_id][0].put(context)
+            self.queue_stats["queued"] += 1
+            if self.sessions[session_id][1]._value > 0:  # 有空闲的并发名额才需要调度，否则等任务完成的回调再调度
+                self._mark_ready(session_id)
+
+    # 检查排队长度是否超过限制，返回超限的原因，调用方需持有self.lock
+    def _check_queue_limit(self, session_id):
+        max_session_queue = conf().get("max_queue_size_per_session", 20)
+        max_total_queue = conf().get("max_queue_size", 2000)
+        if max_session_queue and self.sessions[session_id][0].qsize() >= max_session_queue:
+            return "session_full"
+        if max_total_queue and sum(channel.queue_stats["queued"] for channel in self.instances) >= max_total_queue:
+            return "global_full"
+        return None
+
+    # 按照配置的策略丢弃消息，返回新消息是否仍需入队，调用方需持有self.lock
+    def _shed(self, context: Context, reason):
+        self.queue_stats[reason] += 1
+        policy = conf().get("queue_shed_policy", "reply")
+        if policy == "drop_oldest":
+            if reason == "session_full":
+                dropped = self._pop_oldest(context["session_id"])
+            else:
+                dropped = self._pop_oldest(min(self.sessions, key=self._queue_head_time))
+            if dropped:
+                logger.warning("[WX] queue is full ({}), drop oldest message: {}".format(reason, dropped))
+                self._durable_ack(dropped)
+                self._discard_callback(dropped["session_id"], context=dropped)
+                if dropped["session_id"] != context["session_id"]:  # 新消息所在的session由produce负责清理
+                    self._release_session_if_idle(dropped["session_id"])
+                return True
+        logger.warning("[WX] queue is full ({}), drop message: {}".format(reason, context))
+        self._discard_callback(context["session_id"], context=context)
+        if policy == "reply":
+            self._reply_overloaded(context)
+        return False
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 移除session中最早入队的非管理命令消息，调用方需持有self.lock
+    def _pop_oldest(self, session_id):
+        context_queue = self.sessions[session_id][0]
+        for context in context_queue.queue:
+            if not (context.type == ContextType.TEXT and context.content.startswith("#")):
+                context_queue.queue.remove(context)
+                self.queue_stats["queued"] -= 1
+                return context
+        return None
+
+    def _queue_head_time(self, session_id):
+        context_queue = self.sessions[session_id][0]
+        if context_queue.empty():
+            return float("inf")
+        return context_queue.queue[0].get("produce_time", 0)
+
+    def _is_expired(self, context: Context):
+        max_queue_age = conf().get("max_queue_age", 0)
+        if not max_queue_age or (context.type == ContextType.TEXT and context.content.startswith("#")):
+            return False
+        return time.time() - context.get("produce_time", time.time()) > max_queue_age
+
+    # 回复繁忙提示，在fast通道中执行以免阻塞接收消息的线程
+    def _reply_overloaded(self, context: Context):
+        def func():
+            reply = Reply(ReplyType.INFO, conf().get("queue_overloaded_reply", "消息太多啦，请稍后再试"))
+            self._send_reply(context, self._decorate_reply(context, reply))
+
+        self.get_handler_lane("fast").submit(func)
+
+    def get_queue_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.queue_stats)
+            stats["sessions"] = len(self.sessions)
+            stats["send_retried"] = self.send_stats["retried"]
+            stats["send_failed"] = self.send_stats["failed"]
+        stats["send_retry_pending"] = self.retry_scheduler.pending()
+        return stats
+
+    # 消费者函数，单独线程，等待就绪的session并把其中的消息提交到线程池处理
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[WX] consume context: {}".format(context))
-                            future: Future = self.handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+            with self.ready_cond:
+                while not self.ready_queue or self.stopped:
+                    self.ready_cond.wait()
+                session_id = self.ready_queue.popleft()
+                self.ready_set.discard(session_id)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if context_queue.empty() or not semaphore.acquire(blocking=False):
+                    self._release_session_if_idle(session_id)  # 排队的消息可能已被其他session的drop_oldest移除
+                    continue
+                delay = self._coalesce_delay(session_id)
+                if delay > 0:  # 等待合并窗口内的后续消息，到期后再调度
+                    semaphore.release()
+                    self.coalesce_scheduler.schedule(delay, self._mark_ready_later, session_id)
+                    continue
+                context = self._get_context(session_id)
+                if context is None:  # 排队的消息都已过期
+                    semaphore.release()
+                    self._release_session_if_idle(session_id)
+                    continue
+                logger.debug("[WX] consume context: {}".format(context))
+                self._observe("queue", context, context["produce_time"])
+                if conf().get("async_mode", False):
+                    future: Future = run_coroutine(self._ahandle(context))
+                else:
+                    lane = self._select_lane(context)
+                    logger.debug("[WX] dispatch context to {} lane, session_id={}".format(lane, session_id))
+                    future: Future = self.get_handler_lane(lane).submit(self._handle, context)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+                future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+                if session_id in self.sessions and not context_queue.empty() and semaphore._value > 0:
+                    self._mark_ready(session_id)
+
+    # 从session队列中取出下一条未过期的消息，过期的消息按配置的策略丢弃，调用方需持有self.lock
+    def _get_context(self, session_id):
+        context_queue = self.sessions[session_id][0]
+        while not context_queue.empty():
+            context = context_queue.get()
+            self.queue_stats["queued"] -= 1
+            if not self._is_expired(context):
+                if self._can_coalesce(context):
+                    self._coalesce(context_queue, context)
+                return context
+            self.queue_stats["expired"] += 1
+            self._durable_ack(context)
+            self._discard_callback(session_id, context=context)
+            logger.warning("[WX] message expired in queue, drop it: {}".format(context))
+            if conf().get("queue_shed_policy", "reply") == "reply":
+                self._reply_overloaded(context)
+        return None
+
+    # 可以合并的消息：开启了合并，且为非指令的文字消息
+    def _can_coalesce(self, context: Context):
+        if not conf().get("coalesce_window_ms", 0) or context.type != ContextType.TEXT:
+            return False
+        content = context.content or ""
+        return not content.startswith("#") and not content.startswith(conf().get("plugin_trigger_prefix", "$"))
+
+    # 队首消息距离合并窗口结束还需等待的秒数，调用方需持有self.lock
+    def _coalesce_delay(self, session_id):
+        context = self.sessions[session_id][0].queue[0]
+        if not self._can_coalesce(context):
+            return 0
+        return context["produce_time"] + conf().get("coalesce_window_ms", 0) / 1000 - time.time()
+
+    def _mark_ready_later(self, session_id):
+        with self.lock:
+            if session_id in self.sessions and not self.sessions[session_id][0].empty():
+                self._mark_ready(session_id)
+
+    # 把队列头部与context同一发送者、在合并窗口内发送的连续文字消息合并到context中，调用方需持有self.lock
+    def _coalesce(self, context_queue: Dequeue, context: Context):
+        deadline = context["produce_time"] + conf().get("coalesce_window_ms", 0) / 1000
+        contents = [context.content]
+        while not context_queue.empty():
+            next_context = context_queue.queue[0]
+            if not self._can_coalesce(next_context) or next_context["produce_time"] > deadline:
+                break
+            if getattr(next_context.get("msg"), "actual_user_id", None) != getattr(context.get("msg"), "actual_user_id", None):
+                break
+            if next_context.get("desire_rtype") != context.get("desire_rtype"):
+                break
+            context_queue.get()
+            self.queue_stats["queued"] -= 1
+            contents.append(next_context.content)
+            if "durable_ids" in next_context:
+                context["durable_ids"] = context.get("durable_ids", []) + next_context["durable_ids"]
+        if len(contents) > 1:
+            logger.info("[WX] coalesce {} messages in session {}".format(len(contents), context["session_id"]))
+            context.content = "\n".join(contents)
+            context["coalesced"] = len(contents)
+
+    # 根据context的类型选择处理通道，避免管理指令被耗时的bot调用阻塞
+    def _select_lane(self, context: Context) -> str:
+        if context.get("lane") in ["fast", "slow", "media"]:  # ON_RECEIVE_MESSAGE的插件可以直接指定
+            return context["lane"]
+        lane = PluginManager().classify_lane(context)  # 关键词回复、敏感词拦截等插件直接处理的消息
+        if lane in ["fast", "slow", "media"]:
+            return lane
+        if context.type == ContextType.TEXT:
+            content = context.content or ""
+            if content.startswith("#") or content.startswith(conf().get("plugin_trigger_prefix", "$")):
+                return "fast"
+            if context.get("desire_rtype") == ReplyType.VOICE:
+                return "media"
+            return "slow"
+        if context.type in [ContextType.VOICE, ContextType.IMAGE, ContextType.IMAGE_CREATE, ContextType.FILE, ContextType.VIDEO]:
+            return "media"
+        return "slow"
+
+    @classmethod
+    def get_handler_lane(cls, lane: str) -> HandlerLane:
+        with cls.lanes_lock:
+            if lane not in cls.handler_lanes:
+                default_workers = {"fast": 4, "slow": 8, "media": 4}
+                max_workers = conf().get("{}_lane_workers".format(lane), default_workers[lane])
+                cls.handler_lanes[lane] = HandlerLane(lane, max_workers, initializer=cls.handler_initializer)
+            return cls.handler_lanes[lane]
+
+    @classmethod
+    def set_handler_initializer(cls, initializer):
+        with cls.lanes_lock:
+            cls.handler_initializer = initializer
+            for lane in cls.handler_lanes.values():
+                lane.set_initializer(initializer)
+
+    @classmethod
+    def get_lane_stats(cls) -> list:
+        with cls.lanes_lock:
+            lanes = list(cls.handler_lanes.values())
+        return [lane.stats() for lane in lanes]
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:  # 取消任务后回调已清理了该session
+                    return
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queue_stats["queued"] -= cnt
+                for context in self.sessions[session_id][0].queue:
+                    self._durable_ack(context)
+                    self._discard_callback(session_id, context=context)
                 self.sessions[session_id][0] = Dequeue()
+                self._release_session_if_idle(session_id)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
+            for session_id in list(self.sessions.keys()):
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:  # 取消任务后回调已清理了该session
+                    continue
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queue_stats["queued"] -= cnt
+                for context in self.sessions[session_id][0].queue:
+                    self._durable_ack(context)
+                    self._discard_callback(session_id, context=context)
                 self.sessions[session_id][0] = Dequeue()
+                self._release_session_if_idle(session_id)
+
+    # 退出过程中收到的消息不再处理，开启durable_queue时保存下来，重启后处理
+    def _reject_when_draining(self, context: Context):
+        with self.lock:
+            self.queue_stats["draining"] += 1
+        self._durable_append(context)
+        self._discard_callback(context["session_id"], context=context)
+        logger.warning("[WX] channel is draining, reject message: {}".format(context))
+
+    def drain(self, timeout):
+        """
+        退出前调用：停止接收新消息，在timeout秒内等待排队和处理中的消息完成，并立即执行待重试的发送
+        :return: 处理结果统计
+        """
+        self.draining = True
+        deadline = time.time() + timeout
+        self.coalesce_scheduler.flush()  # 不再等待合并窗口
+        start = self._drain_remaining()
+        logger.info("[WX] draining: {queued} queued, {running} running, {retrying} send retries".format(**start))
+        self._wait_drained(deadline, lambda remaining: remaining["queued"] + remaining["running"] == 0)
+        self.retry_scheduler.flush()  # 提交到fast通道立即发送
+        self._wait_drained(deadline, lambda remaining: sum(remaining.values()) == 0)
+        with self.lock:
+            self.stopped = True
+        remaining = self._drain_remaining()
+        durable_queue = get_durable_queue()
+        if durable_queue:
+            durable_queue.flush()
+        return {
+            "completed": max(sum(start.values()) - sum(remaining.values()), 0),
+            "abandoned_queued": remaining["queued"],
+            "abandoned_running": remaining["running"],
+            "abandoned_retries": remaining["retrying"],
+            "rejected": self.queue_stats["draining"],
+            "durable": durable_queue is not None and self.SUPPORT_REPLAY,
+        }
+
+    def _wait_drained(self, deadline, drained):
+        while time.time() < deadline and not drained(self._drain_remaining()):
+            time.sleep(0.1)
+
+    def _drain_remaining(self):
+        with self.lock:
+            queued = self.queue_stats["queued"]
+            running = sum(1 for futures in self.futures.values() for future in futures if not future.done())
+        lanes = self.get_lane_stats()
+        # 发送重试提交到fast通道后不再属于任何session，通过线程池的任务数统计
+        retrying = self.retry_scheduler.pending() + max(sum(lane["pending"] + lane["running"] for lane in lanes) - running, 0)
+        return {"queued": queued, "running": running, "retrying": retrying}
+
+    # 开启durable_queue时把待处理的文字消息写入持久化队列，管理命令和不会重新处理消息的通道不写入
+    def _durable_append(self, context: Context):
+        durable_queue = get_durable_queue() if self.SUPPORT_REPLAY else None
+        if durable_queue is None or "durable_ids" in context:
+            return
+        if context.type not in [ContextType.TEXT, ContextType.IMAGE_CREATE] or context.content.startswith("#"):
+            return
+        entry = {"channel": type(self).__name__, "context": context.to_dict()}
+        context["durable_ids"] = [durable_queue.append(entry)]
+
+    # 确认消息已处理完成，可重复调用
+    def _durable_ack(self, context: Context):
+        durable_ids = context.kwargs.pop("durable_ids", None)
+        durable_queue = get_durable_queue()
+        if durable_ids and durable_queue:
+            for entry_id in durable_ids:
+                durable_queue.ack(entry_id)
+
+    def replay_pending(self):
+        """
+        重新处理上次退出前未回复的消息，在通道登录完成后调用
+        """
+        durable_queue = get_durable_queue()
+        if durable_queue is None:
+            return
+        entries = [(entry_id, entry) for entry_id, entry in durable_queue.pending() if entry["channel"] == type(self).__name__]
+        if entries:
+            logger.info("[WX] replay {} pending messages".format(len(entries)))
+        max_queue_age = conf().get("max_queue_age", 0)
+        for entry_id, entry in entries:
+            try:
+                context = Context.from_dict(entry["context"])
+            except Exception as e:
+                logger.exception("[WX] load pending message failed: {}".format(e))
+                durable_queue.ack(entry_id)
+                continue
+            if max_queue_age and time.time() - context.get("receive_time", time.time()) > max_queue_age:
+                logger.warning("[WX] pending message expired, drop it: {}".format(context))
+                durable_queue.ack(entry_id)
+                continue
+            context["durable_ids"] = [entry_id]
+            context["replayed"] = True
+            self.produce(context)
 
 
 def check_prefix(content, prefix_list):
@@ -0,0 +1,171 @@
+"""
+消息触发规则的预编译索引，每次加载配置后构建一次，避免每条消息都线性扫描前缀、关键词和群名单
+"""
+
+import re
+import threading
+from collections import deque
+from functools import lru_cache
+
+from config import conf
+
+_END = None  # trie节点中记录前缀结束的key
+
+
+class PrefixTrie:
+    """
+    前缀树，返回列表中第一个匹配的前缀，与check_prefix的结果一致
+    """
+
+    def __init__(self, prefix_list):
+        self.root = {}
+        self.empty_index = None  # 空字符串前缀可以匹配任意内容
+        for index, prefix in enumerate(prefix_list or []):
+            if prefix == "":
+                if self.empty_index is None:
+                    self.empty_index = index
+                continue
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(_END, (index, prefix))
+
+    def match(self, content):
+        best = (self.empty_index, "") if self.empty_index is not None else None
+        node = self.root
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            end = node.get(_END)
+            if end is not None and (best is None or end[0] < best[0]):
+                best = end
+        return best[1] if best else None
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick自动机，一次扫描判断内容是否包含任一关键词，与check_contain的结果一致
+    """
+
+    def __init__(self, keyword_list):
+        self.match_all = False
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for keyword in keyword_list or []:
+            if keyword == "":
+                self.match_all = True
+                continue
+            state = 0
+            for ch in keyword:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][ch] = next_state
+                state = next_state
+            self.output[state] = True
+        self.empty = len(self.goto) == 1
+        # 按层次遍历构建失败指针
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(ch, 0)
+                if self.output[self.fail[next_state]]:
+                    self.output[next_state] = True
+
+    def contains_any(self, content):
+        if self.match_all:
+            return True
+        if self.empty:
+            return False
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return False
+
+
+class TriggerIndex:
+    def __init__(self, config):
+        group_name_white_list = config.get("group_name_white_list", []) or []
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_name_white_list = set(group_name_white_list)
+        self.group_name_keyword_white_list = KeywordAutomaton(config.get("group_name_keyword_white_list", []))
+        group_chat_in_one_session = config.get("group_chat_in_one_session", []) or []
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.group_chat_in_one_session = set(group_chat_in_one_session)
+        self.group_chat_prefix = PrefixTrie(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordAutomaton(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixTrie(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixTrie(config.get("image_create_prefix"))
+
+    def is_group_allowed(self, group_name):
+        return self.all_group or group_name in self.group_name_white_list or self.group_name_keyword_white_list.contains_any(group_name or "")
+
+    def is_group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+    def match_group_trigger(self, content):
+        """
+        :return: (匹配到的群聊前缀或None, 包含群聊关键词时为True否则为None)
+        """
+        match_prefix = self.group_chat_prefix.match(content)
+        match_contain = True if self.group_chat_keyword.contains_any(content) else None
+        return match_prefix, match_contain
+
+    def match_single_prefix(self, content):
+        return self.single_chat_prefix.match(content)
+
+    def match_image_create_prefix(self, content):
+        return self.image_create_prefix.match(content)
+
+
+_index = None
+_index_config = None
+_lock = threading.Lock()
+
+
+def get_trigger_index() -> TriggerIndex:
+    """
+    获取当前配置对应的触发规则索引，重新加载配置(如#更新配置、#reconf)后自动重建
+    """
+    global _index, _index_config
+    config = conf()
+    index = _index
+    if index is None or _index_config is not config:
+        with _lock:
+            if _index is None or _index_config is not config:
+                _index = TriggerIndex(config)
+                _index_config = config
+            index = _index
+    return index
+
+
+def reset_trigger_index():
+    """
+    配置被原地修改后调用，下次使用时重建索引
+    """
+    global _index
+    with _lock:
+        _index = None
+
+
+@lru_cache(maxsize=4096)
+def mention_pattern(name):
+    """
+    按昵称缓存编译后的@昵称正则
+    """
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
@@ -10,16 +10,15 @@ import os
 import threading
 import time
 
-import requests
-
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechat.wechat_message import *
-from common.expired_dict import ExpiredDict
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
+from common.ttl_cache import TTLCache
 from config import conf, get_appdata_dir
 from lib import itchat
 from lib.itchat.content import *
@@ -105,10 +104,12 @@ def qrCallback(uuid, status, qrcode):
 @singleton
 class WechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_STREAM = True
+    SUPPORT_REPLAY = True
 
     def __init__(self):
         super().__init__()
-        self.receivedMsgs = ExpiredDict(60 * 60)
+        self.receivedMsgs = TTLCache(ttl=60 * 60, max_size=100000)  # 用于消息去重
 
     def startup(self):
         itchat.instance.receivingRetryCount = 600  # 修改断线超时时间
@@ -124,6 +125,7 @@ class WechatChannel(ChatChannel):
         self.user_id = itchat.instance.storageClass.userName
         self.name = itchat.instance.storageClass.nickName
         logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
+        self.replay_pending()
         # start message listener
         itchat.run()
 
@@ -195,7 +197,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
@@ -221,7 +223,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
+            video_res = http_client.get(video_url, stream=True)
             video_storage = io.BytesIO()
             size = 0
             for block in video_res.iter_content(1024):
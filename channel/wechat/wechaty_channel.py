@@ -31,6 +31,7 @@ except Exception as e:
 @singleton
 class WechatyChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_REPLAY = True
 
     def __init__(self):
         super().__init__()
@@ -44,7 +45,7 @@ class WechatyChannel(ChatChannel):
     async def main(self):
         loop = asyncio.get_event_loop()
         # 将asyncio的loop传入处理线程
-        self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        self.set_handler_initializer(lambda: asyncio.set_event_loop(loop))
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
@@ -54,6 +55,7 @@ class WechatyChannel(ChatChannel):
         self.user_id = contact.contact_id
         self.name = contact.name
         logger.info("[WX] login user={}".format(contact))
+        self.replay_pending()
 
     # 统一的发送函数，每个Channel自行实现，根据reply的type字段发送不同类型的消息
     def send(self, reply: Reply, context: Context):
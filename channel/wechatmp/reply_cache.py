@@ -0,0 +1,114 @@
+"""
+公众号被动回复的状态：待发送的回复、正在处理的用户、微信服务器的重试次数
+多个实例部署同一个公众号时使用Redis共享，微信服务器的重试请求落到任意实例都能取到回复
+"""
+
+import json
+import threading
+from collections import defaultdict
+
+from config import conf
+
+
+class MemoryReplyCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache_dict = defaultdict(list)  # 用户 -> 待发送的回复 [(类型, 内容)]
+        self.running = set()  # 正在处理消息的用户
+        self.request_cnt = dict()  # 微信服务器按message_id重试的次数
+
+    def state(self, user, message_id):
+        """
+        :return: (是否有待发送的回复, 是否正在处理, message_id已收到的请求次数)
+        """
+        with self.lock:
+            return bool(self.cache_dict.get(user)), user in self.running, self.request_cnt.get(message_id, 0)
+
+    def push_reply(self, user, reply_type, content):
+        with self.lock:
+            self.cache_dict[user].append((reply_type, content))
+
+    def pop_reply(self, user):
+        """
+        :return: 最早的一条回复 (类型, 内容)，没有时返回None
+        """
+        with self.lock:
+            replies = self.cache_dict.get(user)
+            if not replies:
+                return None
+            reply = replies.pop(0)
+            if not replies:
+                del self.cache_dict[user]
+            return reply
+
+    def set_running(self, user):
+        with self.lock:
+            self.running.add(user)
+
+    def clear_running(self, user):
+        with self.lock:
+            self.running.discard(user)
+
+    def is_running(self, user):
+        return user in self.running
+
+    def incr_request(self, message_id):
+        with self.lock:
+            self.request_cnt[message_id] = self.request_cnt.get(message_id, 0) + 1
+            return self.request_cnt[message_id]
+
+    def clear_request(self, message_id):
+        with self.lock:
+            self.request_cnt.pop(message_id, None)
+
+
+class RedisReplyCache:
+    REPLY_TTL = 3600  # 待发送的回复保留时间(秒)
+    RUNNING_TTL = 600  # 处理中的标记保留时间，避免实例退出后用户一直处于处理中状态
+    REQUEST_TTL = 60  # 微信服务器的重试在15秒内完成
+
+    def __init__(self, client, prefix="cow:"):
+        self.client = client
+        self.prefix = prefix + "wechatmp:"
+
+    def _key(self, kind, name):
+        return "{}{}:{}".format(self.prefix, kind, name)
+
+    def state(self, user, message_id):
+        has_reply, running, request_cnt = self.client.execute_many(
+            [("EXISTS", self._key("replies", user)), ("EXISTS", self._key("running", user)), ("GET", self._key("requests", message_id))]
+        )
+        return bool(has_reply), bool(running), int(request_cnt or 0)
+
+    def push_reply(self, user, reply_type, content):
+        key = self._key("replies", user)
+        self.client.execute_many([("RPUSH", key, json.dumps([reply_type, content], ensure_ascii=False)), ("EXPIRE", key, self.REPLY_TTL)])
+
+    def pop_reply(self, user):
+        reply = self.client.execute("LPOP", self._key("replies", user))
+        return tuple(json.loads(reply)) if reply is not None else None
+
+    def set_running(self, user):
+        self.client.execute("SET", self._key("running", user), 1, "EX", self.RUNNING_TTL)
+
+    def clear_running(self, user):
+        self.client.execute("DEL", self._key("running", user))
+
+    def is_running(self, user):
+        return bool(self.client.execute("EXISTS", self._key("running", user)))
+
+    def incr_request(self, message_id):
+        key = self._key("requests", message_id)
+        request_cnt, _ = self.client.execute_many([("INCR", key), ("EXPIRE", key, self.REQUEST_TTL)])
+        return request_cnt
+
+    def clear_request(self, message_id):
+        self.client.execute("DEL", self._key("requests", message_id))
+
+
+def create_reply_cache():
+    if conf().get("wechatmp_reply_cache", "memory") == "redis":
+        from common.redis_client import get_redis_client
+
+        return RedisReplyCache(get_redis_client(), conf().get("redis_prefix", "cow:"))
+    return MemoryReplyCache()
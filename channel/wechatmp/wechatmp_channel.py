@@ -6,17 +6,17 @@ import os
 import threading
 import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
+from channel.wechatmp.reply_cache import create_reply_cache
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length
@@ -46,12 +46,9 @@ class WechatMPChannel(ChatChannel):
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
-            # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
-            # Record whether the current message is being processed
-            self.running = set()
-            # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            # Cache the reply to the user's first message, record whether the current message is being processed,
+            # and count the request from wechat official server by message_id
+            self.reply_cache = create_reply_cache()
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -83,7 +80,7 @@ class WechatMPChannel(ChatChannel):
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self.reply_cache.push_reply(receiver, "text", reply_text)
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -104,11 +101,11 @@ class WechatMPChannel(ChatChannel):
                         return
                     media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
+                    self.reply_cache.push_reply(receiver, "voice", media_id)
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -124,7 +121,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.reply_cache.push_reply(receiver, "image", media_id)
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
                 image_storage.seek(0)
@@ -139,7 +136,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.reply_cache.push_reply(receiver, "image", media_id)
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
@@ -192,7 +189,7 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -227,10 +224,14 @@ class WechatMPChannel(ChatChannel):
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            self.reply_cache.clear_running(session_id)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
-            assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self.reply_cache.clear_running(session_id)
+
+    def _discard_callback(self, session_id, context, **kwargs):  # 消息被丢弃时的回调函数
+        logger.info("[wechatmp] Context discarded without reply, msgId={}".format(context["msg"].msg_id))
+        if self.passive_reply:
+            self.reply_cache.clear_running(session_id)
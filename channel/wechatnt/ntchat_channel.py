@@ -3,12 +3,12 @@ import random
 import threading
 import uuid
 import xml.dom.minidom
-import requests
 import ntchat
 from PIL import Image
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from common import http_client
 from common.singleton import singleton
 from common.log import logger
 from common.time_check import time_checker
@@ -303,7 +303,7 @@ class NtchatChannel(object):
             os.makedirs(directory)
 
         # 下载图片
-        response = requests.get(url)
+        response = http_client.get(url)
         image = Image.open(io.BytesIO(response.content))
 
         # 压缩图片
@@ -321,7 +321,7 @@ class NtchatChannel(object):
             os.makedirs(directory)
 
         # 下载视频
-        response = requests.get(url, stream=True)
+        response = http_client.get(url, stream=True)
         total_size = 0
 
         video_path = os.path.join(directory, f"{filename}.mp4")
@@ -0,0 +1,156 @@
+"""
+第三方接口access token的缓存，按client_id保存token和过期时间
+过期前在后台刷新，同一个client_id的并发刷新只请求一次，可选保存到appdata_dir下，重启后继续使用
+"""
+
+import json
+import os
+import threading
+import time
+
+from common import http_client
+from common.log import logger
+from common.single_flight import SingleFlight
+from config import conf, get_appdata_dir
+
+
+class AccessTokenCache:
+    RETRY_INTERVAL = 60  # 后台刷新失败后的重试间隔(秒)
+
+    def __init__(self, name, fetch, refresh_before=86400, persist_file=None):
+        """
+        :param name: 名称，用于日志和持久化文件中区分不同的接口
+        :param fetch: fetch(client_id, secret) -> (token, 有效秒数)，获取失败时抛出异常
+        :param refresh_before: 距离过期还有多少秒时开始后台刷新
+        :param persist_file: 保存token的文件路径，为空时只保存在内存中
+        """
+        self.name = name
+        self.fetch = fetch
+        self.refresh_before = refresh_before
+        self.persist_file = persist_file
+        self.lock = threading.Lock()
+        self.tokens = {}  # client_id -> (token, 过期时间)
+        self.secrets = {}  # client_id -> secret，后台刷新时使用，不会持久化
+        self.timers = {}  # client_id -> 后台刷新的定时器
+        self.single_flight = SingleFlight()
+        self._load()
+
+    def get(self, client_id, secret) -> str:
+        """
+        :return: 有效的token，缓存中没有或已过期时同步获取
+        """
+        with self.lock:
+            self.secrets[client_id] = secret
+            token, expires_at = self.tokens.get(client_id, (None, 0))
+            timer = self.timers.get(client_id)
+        now = time.time()
+        if token and now < expires_at:
+            if timer is None:  # 从文件中加载的token，还没有安排刷新
+                self._schedule(client_id, expires_at - self.refresh_before - now)
+            return token
+        token, _ = self.single_flight.do(client_id, self._refresh, client_id)
+        return token
+
+    def invalidate(self, client_id, token=None):
+        """
+        接口返回token失效时调用，下次get时重新获取
+        :param token: 只有缓存中的token与之相同时才删除，避免删除其他线程刚刷新的token
+        """
+        with self.lock:
+            cached = self.tokens.get(client_id)
+            if cached and (token is None or cached[0] == token):
+                del self.tokens[client_id]
+                logger.info("[{}] access token of {} invalidated".format(self.name, client_id))
+
+    def _refresh(self, client_id):
+        with self.lock:
+            secret = self.secrets.get(client_id)
+        token, expires_in = self.fetch(client_id, secret)
+        expires_at = time.time() + expires_in
+        with self.lock:
+            self.tokens[client_id] = (token, expires_at)
+        logger.info("[{}] access token of {} refreshed, expires in {}s".format(self.name, client_id, expires_in))
+        self._schedule(client_id, expires_in - self.refresh_before)
+        self._save()
+        return token
+
+    def _refresh_quietly(self, client_id):
+        try:
+            self.single_flight.do(client_id, self._refresh, client_id)
+        except Exception as e:
+            logger.warn("[{}] refresh access token of {} failed: {}".format(self.name, client_id, e))
+            self._schedule(client_id, self.RETRY_INTERVAL)
+
+    def _schedule(self, client_id, delay):
+        timer = threading.Timer(max(delay, 0), self._refresh_quietly, args=(client_id,))
+        timer.daemon = True
+        with self.lock:
+            old = self.timers.get(client_id)
+            self.timers[client_id] = timer
+        if old is not None:
+            old.cancel()
+        timer.start()
+
+    def _load(self):
+        if not self.persist_file or not os.path.exists(self.persist_file):
+            return
+        try:
+            with open(self.persist_file, "r", encoding="utf-8") as f:
+                data = json.load(f).get(self.name, {})
+            now = time.time()
+            for client_id, item in data.items():
+                if item["expires_at"] > now:
+                    self.tokens[client_id] = (item["token"], item["expires_at"])
+            logger.info("[{}] loaded {} access tokens from {}".format(self.name, len(self.tokens), self.persist_file))
+        except Exception as e:
+            logger.warn("[{}] load access tokens failed: {}".format(self.name, e))
+
+    def _save(self):
+        if not self.persist_file:
+            return
+        with self.lock:
+            tokens = {client_id: {"token": token, "expires_at": expires_at} for client_id, (token, expires_at) in self.tokens.items()}
+        try:
+            data = {}
+            if os.path.exists(self.persist_file):
+                with open(self.persist_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            data[self.name] = tokens
+            tmp_file = self.persist_file + ".tmp"
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.persist_file)
+        except Exception as e:
+            logger.warn("[{}] save access tokens failed: {}".format(self.name, e))
+
+
+# 百度接口返回这些错误码时表示access token无效或已过期
+BAIDU_TOKEN_ERRORS = (110, 111)
+
+_baidu_cache = None
+_lock = threading.Lock()
+
+
+def _fetch_baidu_token(api_key, secret_key):
+    url = "https://aip.baidubce.com/oauth/2.0/token"
+    params = {"grant_type": "client_credentials", "client_id": api_key, "client_secret": secret_key}
+    response = http_client.post(url, params=params).json()
+    if not response.get("access_token"):
+        raise Exception("get baidu access token failed: {}".format(response.get("error_description") or response))
+    return response["access_token"], int(response.get("expires_in", 2592000))
+
+
+def get_baidu_token_cache() -> AccessTokenCache:
+    global _baidu_cache
+    with _lock:
+        if _baidu_cache is None:
+            persist_file = os.path.join(get_appdata_dir(), "access_tokens.json") if conf().get("persist_access_token") else None
+            _baidu_cache = AccessTokenCache("baidu", _fetch_baidu_token, persist_file=persist_file)
+        return _baidu_cache
+
+
+def baidu_access_token(api_key, secret_key) -> str:
+    """
+    获取百度开放平台的access token(有效期30天)，缓存中没有时请求 aip.baidubce.com
+    """
+    return get_baidu_token_cache().get(api_key, secret_key)
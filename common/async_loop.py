@@ -0,0 +1,56 @@
+"""
+全局共享的asyncio事件循环，运行在单独的后台线程中，供异步模式下的消息处理和bot请求使用
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from common.log import logger
+from config import conf
+
+_loop = None
+_lock = threading.Lock()
+_http_session = None
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    获取全局事件循环，首次调用时创建并启动事件循环线程
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,), name="async-loop")
+            thread.setDaemon(True)
+            thread.start()
+            _loop = loop
+            logger.info("[AsyncLoop] event loop started")
+        return _loop
+
+
+def run_coroutine(coro) -> Future:
+    """
+    在全局事件循环中执行协程，可在任意线程中调用
+    :return: concurrent.futures.Future，可用于添加回调或取消任务
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def get_http_session():
+    """
+    获取全局共享的aiohttp连接池，只能在全局事件循环中调用
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=conf().get("async_http_pool_size", 100))
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
@@ -0,0 +1,61 @@
+import heapq
+import itertools
+import threading
+import time
+
+from common.log import logger
+
+
+class DelayScheduler:
+    """
+    延迟任务调度器，用一个最小堆和一个线程执行到期的任务，任务应当很快返回，耗时的工作请在任务中提交到线程池
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.heap = []  # (到期时间, 序号, 任务函数, 参数)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, func, *args):
+        """
+        在delay秒后执行func(*args)
+        """
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="scheduler-{}".format(self.name))
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return len(self.heap)
+
+    def flush(self):
+        """
+        立即执行所有未到期的任务，用于退出前清空待执行的任务
+        :return: 执行的任务数
+        """
+        with self.cond:
+            tasks = [heapq.heappop(self.heap) for _ in range(len(self.heap))]
+        for _, _, func, args in tasks:
+            self._execute(func, args)
+        return len(tasks)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.cond.wait(timeout)
+                _, _, func, args = heapq.heappop(self.heap)
+            self._execute(func, args)
+
+    def _execute(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.exception("[Scheduler] {} task raise exception: {}".format(self.name, e))
@@ -0,0 +1,135 @@
+"""
+持久化的待处理消息队列，使用WAL模式的SQLite保存尚未回复的context，重启后重新处理
+写入和确认由后台线程批量提交，多条消息共用一次fsync
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class DurableQueue:
+    def __init__(self, path, flush_interval=0.05):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        self.ops = []  # 等待提交的操作：(id, 序列化后的context)表示写入，(id, None)表示确认
+        self.flushed_seq = 0  # 已提交到磁盘的操作序号
+        self.pending_seq = 0  # 最新的操作序号
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY, created REAL, context TEXT)")
+        conn.commit()
+        self.next_id = (conn.execute("SELECT MAX(id) FROM pending").fetchone()[0] or 0) + 1
+        conn.close()
+        self.id_lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name="durable-queue")
+        thread.setDaemon(True)
+        thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def append(self, context_dict) -> int:
+        """
+        写入一条待处理的context，返回记录id
+        """
+        with self.id_lock:
+            entry_id = self.next_id
+            self.next_id += 1
+        self._add_op((entry_id, json.dumps(context_dict, ensure_ascii=False)))
+        return entry_id
+
+    def ack(self, entry_id):
+        """
+        确认context已处理完成，删除记录
+        """
+        self._add_op((entry_id, None))
+
+    def _add_op(self, op):
+        with self.cond:
+            self.ops.append(op)
+            self.pending_seq += 1
+            self.cond.notify()
+
+    def pending(self) -> list:
+        """
+        :return: 上次退出时未确认的记录 [(id, context dict)]，按写入顺序排列
+        """
+        self.flush()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, context FROM pending ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        return [(entry_id, json.loads(context)) for entry_id, context in rows]
+
+    def flush(self, timeout=5):
+        """
+        等待已有的操作提交到磁盘
+        """
+        with self.cond:
+            seq = self.pending_seq
+            self.cond.notify()
+            return self.cond.wait_for(lambda: self.flushed_seq >= seq, timeout)
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            with self.cond:
+                while not self.ops:
+                    self.cond.wait()
+            time.sleep(self.flush_interval)  # 攒一批再提交
+            with self.cond:
+                ops, self.ops = self.ops, []
+                seq = self.pending_seq
+            try:
+                self._commit(conn, ops)
+            except Exception as e:
+                logger.exception("[DurableQueue] commit {} ops failed: {}".format(len(ops), e))
+            with self.cond:
+                self.flushed_seq = seq
+                self.cond.notify_all()
+
+    def _commit(self, conn, ops):
+        inserts = {}
+        deletes = []
+        for entry_id, context in ops:
+            if context is not None:
+                inserts[entry_id] = context
+            elif entry_id in inserts:  # 同一批次中写入后又确认的记录不需要落盘
+                del inserts[entry_id]
+            else:
+                deletes.append((entry_id,))
+        now = time.time()
+        with conn:
+            if inserts:
+                conn.executemany("INSERT OR REPLACE INTO pending (id, created, context) VALUES (?, ?, ?)", [(entry_id, now, context) for entry_id, context in inserts.items()])
+            if deletes:
+                conn.executemany("DELETE FROM pending WHERE id = ?", deletes)
+
+
+_queue = None
+_lock = threading.Lock()
+
+
+def get_durable_queue():
+    """
+    开启durable_queue时返回全局的持久化队列，否则返回None
+    """
+    global _queue
+    if not conf().get("durable_queue", False):
+        return None
+    with _lock:
+        if _queue is None:
+            path = os.path.join(get_appdata_dir(), "pending_contexts.db")
+            _queue = DurableQueue(path, conf().get("durable_queue_flush_ms", 50) / 1000)
+            logger.info("[DurableQueue] open {}".format(path))
+        return _queue
@@ -0,0 +1,73 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class HandlerLane:
+    """
+    带统计的处理线程池，记录排队中的任务数和任务在队列中的等待时间
+    """
+
+    def __init__(self, name, max_workers, initializer=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="handler-{}".format(name))
+        self.initializer = initializer
+        self.local = threading.local()  # 记录每个线程已执行过的初始化函数
+        self.lock = threading.Lock()
+        self.pending = 0  # 已提交但未开始执行的任务数
+        self.running = 0  # 正在执行的任务数
+        self.started = 0  # 已开始执行的任务总数
+        self.total_wait = 0.0  # 累计排队等待时间(秒)
+        self.max_wait = 0.0  # 最长排队等待时间(秒)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        submit_time = time.time()
+
+        def run():
+            wait = time.time() - submit_time
+            with self.lock:
+                self.pending -= 1
+                self.running += 1
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                initializer = self.initializer
+                if initializer is not None and getattr(self.local, "initializer", None) is not initializer:
+                    initializer()
+                    self.local.initializer = initializer
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        def on_done(future: Future):
+            if future.cancelled():  # 未执行就被取消的任务不会经过run
+                with self.lock:
+                    self.pending -= 1
+
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(run)
+        future.add_done_callback(on_done)
+        return future
+
+    def set_initializer(self, initializer):
+        # 已创建的线程在执行下一个任务前执行新的初始化函数
+        self.initializer = initializer
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "name": self.name,
+                "workers": self.max_workers,
+                "pending": self.pending,
+                "running": self.running,
+                "started": self.started,
+                "avg_wait": self.total_wait / self.started if self.started else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
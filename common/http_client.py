@@ -0,0 +1,204 @@
+"""
+全局共享的HTTP客户端，bot、插件和channel的HTTP请求都通过它发送
+每个host维护一个keep-alive连接池，避免每次请求都重新建立TCP+TLS连接
+用法与requests相同: http_client.get(url, ...)、http_client.post(url, ...)，返回requests.Response
+开启http2且安装了httpx[http2]时使用httpx发送，返回的响应对象兼容常用的requests接口
+"""
+
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from config import conf
+
+
+class HttpClient:
+    def __init__(self, pool_size=10, pool_hosts=32, timeout=(5, 120), proxy=None):
+        """
+        :param pool_size: 每个host保持的最大连接数
+        :param pool_hosts: 最多同时保留多少个host的连接池
+        :param timeout: 默认的(连接超时, 读取超时)，调用时传入timeout会覆盖
+        :param proxy: 代理地址，为空时使用环境变量中的代理
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self):
+        """
+        :return: {host: {"requests": 请求数, "connections": 新建连接数, "reused": 复用连接的请求数}}
+        """
+        result = defaultdict(lambda: {"requests": 0, "connections": 0})
+        managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                host = "{}:{}".format(pool.host, pool.port)
+                result[host]["requests"] += pool.num_requests
+                result[host]["connections"] += pool.num_connections
+        for item in result.values():
+            item["reused"] = max(item["requests"] - item["connections"], 0)
+        return dict(result)
+
+    def close(self):
+        self.session.close()
+
+
+class Http2Client:
+    """
+    基于httpx的HTTP/2客户端，同一个host的并发请求复用一条连接
+    """
+
+    def __init__(self, pool_size=10, pool_hosts=32, timeout=(5, 120), proxy=None):
+        import httpx
+
+        self.httpx = httpx
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.counters = defaultdict(lambda: {"requests": 0, "connections": 0})
+        limits = httpx.Limits(max_connections=pool_size * pool_hosts, max_keepalive_connections=pool_size * pool_hosts)
+        client_args = {"http2": True, "limits": limits, "follow_redirects": True}
+        if proxy:
+            client_args["proxy"] = proxy
+        self.client = httpx.Client(**client_args)
+
+    def request(self, method, url, params=None, data=None, headers=None, json=None, files=None, timeout=None, stream=False):
+        if timeout is None:
+            timeout = self.timeout
+        if isinstance(timeout, tuple):
+            timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+        content = None
+        if isinstance(data, (str, bytes)):  # httpx中原始请求体使用content参数
+            content, data = data, None
+        url_parts = urlparse(url)
+        host = "{}:{}".format(url_parts.hostname, url_parts.port or (443 if url_parts.scheme == "https" else 80))
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                with self.lock:
+                    self.counters[host]["connections"] += 1
+
+        with self.lock:
+            self.counters[host]["requests"] += 1
+        request = self.client.build_request(
+            method, url, params=params, content=content, data=data, headers=headers, json=json, files=files, timeout=timeout, extensions={"trace": trace}
+        )
+        response = self.client.send(request, stream=stream)
+        return Http2Response(response)
+
+    def stats(self):
+        with self.lock:
+            result = {host: dict(item) for host, item in self.counters.items()}
+        for item in result.values():
+            item["reused"] = max(item["requests"] - item["connections"], 0)
+        return result
+
+    def close(self):
+        self.client.close()
+
+
+class Http2Response:
+    """
+    把httpx.Response包装成requests.Response的常用接口
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    @property
+    def ok(self):
+        return self.response.status_code < 400
+
+    @property
+    def content(self):
+        return self.response.read()
+
+    @property
+    def text(self):
+        self.response.read()
+        return self.response.text
+
+    def json(self, **kwargs):
+        self.response.read()
+        return self.response.json(**kwargs)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if decode_unicode:
+            return self.response.iter_text(chunk_size)
+        return self.response.iter_bytes(chunk_size)
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self.response.iter_lines():
+            yield line if decode_unicode else line.encode("utf-8")
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def close(self):
+        self.response.close()
+
+
+_client = None
+_lock = threading.Lock()
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        import httpx  # noqa: F401
+
+        return True
+    except ImportError:
+        return False
+
+
+def get_http_client():
+    global _client
+    with _lock:
+        if _client is None:
+            args = {
+                "pool_size": conf().get("http_pool_size", 10),
+                "pool_hosts": conf().get("http_pool_hosts", 32),
+                "timeout": (conf().get("http_connect_timeout", 5), conf().get("http_read_timeout", 120)),
+                "proxy": conf().get("http_proxy"),
+            }
+            use_http2 = conf().get("http2", False)
+            if use_http2 and not _http2_available():
+                logger.warn("[HTTP] http2 requires httpx[http2], fallback to http/1.1")
+                use_http2 = False
+            _client = Http2Client(**args) if use_http2 else HttpClient(**args)
+            logger.info("[HTTP] use {}, pool_size={}, timeout={}".format(type(_client).__name__, args["pool_size"], args["timeout"]))
+        return _client
+
+
+def request(method, url, **kwargs):
+    return get_http_client().request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs):
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request("POST", url, data=data, json=json, **kwargs)
+
+
+def stats():
+    return get_http_client().stats()
@@ -0,0 +1,140 @@
+"""
+消息处理各阶段的耗时统计，按阶段和标签(channel、消息类型、bot类型等)分别记录直方图
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from common.log import logger
+
+# 直方图的桶上界(秒)，从1ms开始按1.25倍递增，覆盖到约30分钟
+BUCKETS = [0.001 * 1.25**i for i in range(64)]
+
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        """
+        根据桶计数估算分位数，返回所在桶的上界(不超过观测到的最大值)
+        """
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            cumulative = 0
+            for index, cnt in enumerate(self.counts):
+                cumulative += cnt
+                if cumulative >= rank:
+                    return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+            return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def observe(stage, seconds, **labels):
+    """
+    记录一次耗时
+    :param stage: 阶段名称，如 queue、bot、send
+    :param seconds: 耗时(秒)
+    :param labels: 标签，如 channel、ctype、bot
+    """
+    key = (stage, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(seconds)
+
+
+def snapshot():
+    """
+    :return: [(阶段, 标签dict, 统计结果dict)]，按阶段和标签排序
+    """
+    with _lock:
+        items = sorted(_histograms.items())
+    return [(stage, dict(labels), histogram.summary()) for (stage, labels), histogram in items]
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def render_text():
+    lines = []
+    for stage, labels, summary in snapshot():
+        label_text = ",".join("{}={}".format(k, v) for k, v in labels.items())
+        lines.append(
+            "{}{{{}}} count={} avg={:.0f}ms p50={:.0f}ms p95={:.0f}ms p99={:.0f}ms max={:.0f}ms".format(
+                stage,
+                label_text,
+                summary["count"],
+                summary["avg"] * 1000,
+                summary["p50"] * 1000,
+                summary["p95"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+            )
+        )
+    return "\n".join(lines)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ["", "/metrics"]:
+            self.send_error(404)
+            return
+        body = (render_text() + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """
+    启动本地的耗时统计http服务，GET /metrics 返回文本格式的统计结果
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.setDaemon(True)
+    thread.start()
+    logger.info("[Metrics] http server started at http://{}:{}/metrics".format(host, port))
+    return server
@@ -0,0 +1,177 @@
+"""
+最小的Redis客户端(RESP2协议)，支持连接池和pipeline，用于多实例部署时共享会话和回复缓存
+不依赖redis-py，兼容Redis协议的服务(如KeyDB、Dragonfly)都可以使用
+"""
+
+import socket
+import threading
+from urllib.parse import unquote, urlparse
+
+from common.log import logger
+from config import conf
+
+
+class RedisError(Exception):
+    pass
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+class RedisConnection:
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute_many([("AUTH", password)])
+        if db:
+            self.execute_many([("SELECT", db)])
+
+    def execute_many(self, commands):
+        """
+        一次发送所有命令再依次读取回复，命令出错时在读完所有回复后抛出第一个错误
+        """
+        self.sock.sendall(b"".join(encode_command(command) for command in commands))
+        replies = [self.read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionClosed("connection closed by redis server")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode("utf-8")
+        if prefix == b"-":
+            return RedisError(body.decode("utf-8"))
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RedisError("unknown reply: {}".format(line))
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def encode_command(command):
+    parts = [b"*%d\r\n" % len(command)]
+    for arg in command:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode("utf-8")
+        else:
+            data = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+class RedisClient:
+    def __init__(self, url="redis://127.0.0.1:6379/0", timeout=5, max_idle=8):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []  # 空闲连接
+        self.lock = threading.Lock()
+
+    def _get_connection(self):
+        """
+        :return: (连接, 是否是复用的空闲连接)
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return RedisConnection(self.host, self.port, self.password, self.db, self.timeout), False
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def execute_many(self, commands):
+        """
+        在同一个连接上以pipeline方式执行多条命令，返回各命令的回复
+        """
+        if not commands:
+            return []
+        while True:
+            connection, reused = self._get_connection()
+            try:
+                replies = connection.execute_many(commands)
+            except RedisError:
+                self._release(connection)  # 命令错误时连接仍然可用
+                raise
+            except (BrokenPipeError, ConnectionResetError, ConnectionClosed) as e:
+                connection.close()
+                # 空闲连接已被服务端关闭时命令不会被执行，可以安全地换一个连接重试；超时等其他错误不重试，避免命令重复执行
+                if not reused:
+                    raise
+                logger.debug("[Redis] idle connection closed, retry: {}".format(e))
+                continue
+            except Exception:
+                connection.close()
+                raise
+            self._release(connection)
+            return replies
+
+    def execute(self, *command):
+        return self.execute_many([command])[0]
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class Pipeline:
+    """
+    收集多条命令，execute时一次发送
+    """
+
+    def __init__(self, client: RedisClient):
+        self.client = client
+        self.commands = []
+
+    def command(self, *command):
+        self.commands.append(command)
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return self.client.execute_many(commands)
+
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_redis_client() -> RedisClient:
+    global _client
+    with _lock:
+        if _client is None:
+            _client = RedisClient(conf().get("redis_url", "redis://127.0.0.1:6379/0"))
+            logger.info("[Redis] use {}:{} db {}".format(_client.host, _client.port, _client.db))
+        return _client
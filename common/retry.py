@@ -0,0 +1,177 @@
+"""
+bot请求失败后的重试策略：按异常类型分别配置是否重试和退避时间，指数退避加随机抖动，
+优先使用服务端返回的Retry-After，所有重试的等待时间合计不超过deadline
+异步调用在等待期间让出事件循环，不占用线程；每次重试的等待时间记录到耗时统计的retry阶段
+"""
+
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from common import metrics
+from common.log import logger
+
+
+class RetryableError(Exception):
+    """
+    bot在服务端返回可重试的错误(如5xx)时抛出
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GiveUp(Exception):
+    """
+    在重试的函数中抛出GiveUp(原异常)表示不再重试，重试策略会直接抛出原异常
+    例如流式回复已经发出了部分内容，重试会导致重复发送
+    """
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+class RetryRule:
+    def __init__(self, exceptions, retry=True, base_delay=1.0, max_delay=30.0, multiplier=2.0):
+        """
+        :param exceptions: 适用的异常类型，可以是元组
+        :param retry: 是否重试
+        :param base_delay: 第一次重试前的等待时间(秒)，之后每次乘以multiplier
+        :param max_delay: 单次等待时间的上限(秒)
+        """
+        self.exceptions = exceptions
+        self.retry = retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def delay(self, retry_cnt):
+        return min(self.base_delay * self.multiplier**retry_cnt, self.max_delay)
+
+
+class RetryPolicy:
+    def __init__(self, name, rules, max_attempts=3, deadline=60, jitter=0.2):
+        """
+        :param name: 名称，用于日志和耗时统计
+        :param rules: [RetryRule]，按顺序匹配第一个适用的规则，没有匹配的异常不重试
+        :param max_attempts: 最多执行的次数，包括第一次
+        :param deadline: 所有重试等待时间的总和上限(秒)，下一次等待会超出时不再重试
+        :param jitter: 等待时间随机浮动的比例，避免大量请求在同一时刻重试
+        """
+        self.name = name
+        self.rules = rules
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def call(self, func, *args):
+        """
+        执行func(*args)，失败时按规则等待后重试，不再重试时抛出最后一次的异常
+        """
+        start_time = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except GiveUp as e:
+                raise e.error
+            except Exception as e:
+                attempt += 1
+                delay = self._next_delay(e, attempt, time.monotonic() - start_time)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def acall(self, coro_func, *args):
+        """
+        call的协程版本，等待期间不占用线程
+        """
+        start_time = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return await coro_func(*args)
+            except GiveUp as e:
+                raise e.error
+            except Exception as e:
+                attempt += 1
+                delay = self._next_delay(e, attempt, time.monotonic() - start_time)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def _next_delay(self, e, attempt, elapsed):
+        """
+        :return: 下次重试前的等待秒数，不再重试时返回None
+        """
+        rule = next((rule for rule in self.rules if isinstance(e, rule.exceptions)), None)
+        if rule is None or not rule.retry or attempt >= self.max_attempts:
+            return None
+        delay = rule.delay(attempt - 1) * (1 + random.uniform(-1, 1) * self.jitter)
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            delay = retry_after
+        if elapsed + delay > self.deadline:
+            logger.warn("[Retry] {} give up, {} retry after {:.1f}s exceeds deadline {}s".format(self.name, type(e).__name__, delay, self.deadline))
+            return None
+        logger.warn("[Retry] {} {}: {}, retry {} in {:.1f}s".format(self.name, type(e).__name__, e, attempt, delay))
+        metrics.observe("retry", delay, policy=self.name, error=type(e).__name__)
+        return delay
+
+
+def network_errors():
+    """
+    :return: 各http客户端的连接错误和超时异常类型，可作为RetryRule的exceptions
+    """
+    import requests
+
+    errors = (requests.ConnectionError, requests.Timeout, asyncio.TimeoutError)
+    try:
+        import aiohttp
+
+        errors += (aiohttp.ClientConnectionError,)
+    except ImportError:
+        pass
+    try:
+        import httpx
+
+        errors += (httpx.TransportError,)
+    except ImportError:
+        pass
+    return errors
+
+
+def get_retry_after(e):
+    """
+    从异常中读取服务端要求的重试等待时间
+    :return: 秒数，没有时返回None
+    """
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after is None:
+        headers = getattr(e, "headers", None)
+        if headers is None:
+            headers = getattr(getattr(e, "response", None), "headers", None)
+        try:
+            retry_after = headers.get("retry-after") or headers.get("Retry-After") if headers else None
+        except Exception:
+            return None
+    return parse_retry_after(retry_after)
+
+
+def parse_retry_after(value):
+    """
+    Retry-After可以是秒数或者HTTP日期
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,65 @@
+"""
+合并相同的并发请求：同一个key同时只有一个请求在执行，其他请求等待并共享它的结果
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # 同步调用中正在执行的请求，key -> Future
+        self.acalls = {}  # 异步调用中正在执行的请求，key -> asyncio.Future，只在事件循环中访问
+        self.stats = {"executed": 0, "shared": 0}  # 实际执行的请求数，共享结果而节省的请求数
+
+    def do(self, key, func, *args):
+        """
+        执行func(*args)，如果相同key的请求正在执行，等待并返回它的结果
+        :return: (结果, 是否为共享的结果)
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.stats["executed"] += 1
+            else:
+                self.stats["shared"] += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = func(*args)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def ado(self, key, coro_func, *args):
+        """
+        do的协程版本，必须在同一个事件循环中调用
+        """
+        future = self.acalls.get(key)
+        if future is not None:
+            self.stats["shared"] += 1
+            return await asyncio.shield(future), True
+        future = self.acalls[key] = asyncio.get_running_loop().create_future()
+        self.stats["executed"] += 1
+        try:
+            result = await coro_func(*args)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 没有等待者时避免"exception was never retrieved"警告
+            raise
+        finally:
+            del self.acalls[key]
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
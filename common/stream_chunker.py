@@ -0,0 +1,98 @@
+import re
+
+
+class SentenceChunker:
+    """
+    把模型流式返回的内容切分成适合单独发送的片段
+    第一段在第一个句子结束时立即发出，之后在段落结束、或累计超过chunk_chars后的句子结束处切分，代码块不会被切开
+    """
+
+    SENTENCE_END = re.compile(r"[。！？；!?;\n]|\.(?=\s)")
+    PARAGRAPH_END = re.compile(r"\n\s*\n")
+
+    def __init__(self, callback, chunk_chars=200, hold_last=False):
+        """
+        :param callback: 每发出一段调用一次 callback(片段, 是否第一段, 是否最后一段)
+        :param hold_last: 为True时切出的片段等到下一段切出或finish时才发出，保证最后一段回调时标记为最后一段；
+                          为False时切出后立即发出，只有finish时发出的片段标记为最后一段，剩余内容为空时没有片段被标记
+        """
+        self.callback = callback
+        self.chunk_chars = chunk_chars
+        self.hold_last = hold_last
+        self.buffer = ""
+        self.parts = []  # 收到的全部内容
+        self.cuts = 0  # 已切出的片段数
+        self.chunks = 0  # 已发出的片段数
+        self.pending = None  # hold_last时暂存的最近一段
+
+    @property
+    def received(self) -> bool:
+        return bool(self.parts)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def feed(self, delta):
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.buffer += delta
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunk, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            self._emit(chunk)
+
+    def finish(self, full_text=None):
+        """
+        发出剩余的内容
+        :param full_text: bot最终返回的完整回复，如果在流式内容之后追加了内容(如知识库提示)，追加的部分也会发出
+        """
+        if full_text and full_text != self.text and full_text.startswith(self.text):
+            self.buffer += full_text[len(self.text) :]
+        chunk, self.buffer = self.buffer, ""
+        self._emit(chunk, last=True)
+
+    def _find_cut(self):
+        buffer = self.buffer
+        if self.cuts == 0:
+            for match in self.SENTENCE_END.finditer(buffer):
+                if buffer[: match.end()].strip() and self._outside_code(match.end()):
+                    return match.end()
+            return None
+        for match in self.PARAGRAPH_END.finditer(buffer):
+            if buffer[: match.start()].strip() and self._outside_code(match.end()):
+                return match.end()
+        if len(buffer) >= self.chunk_chars:
+            ends = [match.end() for match in self.SENTENCE_END.finditer(buffer)]
+            for end in reversed(ends):
+                if self._outside_code(end):
+                    return end
+        return None
+
+    def _outside_code(self, end):
+        # 切分点之前的代码块标记成对出现，代码块不会被切开
+        return self.buffer.count("```", 0, end) % 2 == 0
+
+    def _emit(self, chunk, last=False):
+        chunk = chunk.strip()
+        if chunk:
+            self.cuts += 1
+        if not self.hold_last:
+            if chunk:
+                self._send(chunk, last)
+            return
+        if chunk:
+            if self.pending is not None:
+                self._send(self.pending, False)
+            self.pending = chunk
+        if last and self.pending is not None:
+            chunk, self.pending = self.pending, None
+            self._send(chunk, True)
+
+    def _send(self, chunk, last):
+        first = self.chunks == 0
+        self.chunks += 1
+        self.callback(chunk, first, last)
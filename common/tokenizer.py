@@ -0,0 +1,149 @@
+"""
+token计数，按编码缓存tiktoken的encoding，可在启动时后台预加载
+没有安装tiktoken或离线无法下载编码文件时，按字符粗略估算
+"""
+
+import threading
+import time
+
+from common.log import logger
+from config import conf
+
+# 模型 -> 编码，不在表中的模型先尝试tiktoken自带的映射，再使用cl100k_base
+MODEL_ENCODINGS = {
+    "gpt-3.5-turbo": "cl100k_base",
+    "gpt-3.5-turbo-0301": "cl100k_base",
+    "gpt-3.5-turbo-0613": "cl100k_base",
+    "gpt-3.5-turbo-16k": "cl100k_base",
+    "gpt-3.5-turbo-16k-0613": "cl100k_base",
+    "gpt-35-turbo": "cl100k_base",
+    "gpt-35-turbo-16k": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-4-0314": "cl100k_base",
+    "gpt-4-0613": "cl100k_base",
+    "gpt-4-32k": "cl100k_base",
+    "gpt-4-32k-0613": "cl100k_base",
+    "text-davinci-003": "p50k_base",
+    "text-davinci-002": "p50k_base",
+}
+DEFAULT_ENCODING = "cl100k_base"
+RETRY_INTERVAL = 600  # 编码加载失败后多久再重试(秒)，期间使用估算
+
+_encodings = {}  # 编码名称 -> encoding
+_failed = {}  # 编码名称 -> 加载失败的时间
+_lock = threading.Lock()
+_loading = set()  # 正在后台加载的编码名称
+_loading_lock = threading.Lock()
+
+
+def encoding_name(model) -> str:
+    name = MODEL_ENCODINGS.get(model)
+    if name is None:
+        try:
+            import tiktoken
+
+            name = tiktoken.encoding_name_for_model(model)
+        except Exception:
+            name = DEFAULT_ENCODING
+        MODEL_ENCODINGS[model] = name
+    return name
+
+
+def get_encoding(model, wait=False):
+    """
+    :param wait: 编码还没有加载时是否等待加载完成，不等待时在后台线程中加载并返回None，由调用方按字符估算
+    :return: 模型对应的encoding，不可用时返回None
+    """
+    name = encoding_name(model)
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+    if name in _failed and time.time() - _failed[name] < RETRY_INTERVAL:
+        return None
+    if wait:
+        return _load(name)
+    # 加载编码文件可能需要下载，消息处理线程不等待
+    with _loading_lock:
+        if name in _loading:
+            return None
+        _loading.add(name)
+    thread = threading.Thread(target=_load, args=(name,), name="tokenizer-load")
+    thread.setDaemon(True)
+    thread.start()
+    return None
+
+
+def _load(name):
+    try:
+        with _lock:  # 避免多个线程同时加载编码文件
+            if name in _encodings:
+                return _encodings[name]
+            if name in _failed and time.time() - _failed[name] < RETRY_INTERVAL:
+                return None
+            try:
+                import tiktoken
+
+                start = time.time()
+                _encodings[name] = tiktoken.get_encoding(name)
+                _failed.pop(name, None)
+                logger.debug("[Tokenizer] encoding {} loaded in {:.2f}s".format(name, time.time() - start))
+                return _encodings[name]
+            except Exception as e:
+                if name not in _failed:
+                    logger.warning("[Tokenizer] load encoding {} failed, estimate tokens by characters instead: {}".format(name, e))
+                _failed[name] = time.time()
+                return None
+    finally:
+        with _loading_lock:
+            _loading.discard(name)
+
+
+def is_exact(model) -> bool:
+    """
+    :return: 当前是否能精确计算该模型的token数
+    """
+    return get_encoding(model) is not None
+
+
+def count_tokens(texts, model=None) -> list:
+    """
+    批量计算多段文本的token数
+    """
+    encoding = get_encoding(model or conf().get("model") or "gpt-3.5-turbo")
+    if encoding is None:
+        return [estimate_tokens(text) for text in texts]
+    if len(texts) == 1:
+        return [len(encoding.encode(texts[0], disallowed_special=()))]
+    return [len(tokens) for tokens in encoding.encode_batch(texts, disallowed_special=())]
+
+
+def num_tokens(text, model=None) -> int:
+    return count_tokens([text], model)[0]
+
+
+def estimate_tokens(text) -> int:
+    """
+    粗略估算：中日韩字符每个约1个token，其他字符每4个约1个token
+    """
+    cjk = sum(1 for ch in text if ch >= "⺀")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def warmup(models=None):
+    """
+    在后台线程中预加载编码，避免第一条消息等待加载编码文件
+    """
+    if not conf().get("tokenizer_warmup", True):
+        return
+    models = models or [conf().get("model") or "gpt-3.5-turbo"]
+    models = [model for model in models if model in MODEL_ENCODINGS or model.startswith("gpt")]  # 其他模型不使用tiktoken计数
+    if not models:
+        return
+
+    def run():
+        for model in models:
+            get_encoding(model, wait=True)
+
+    thread = threading.Thread(target=run, name="tokenizer-warmup")
+    thread.setDaemon(True)
+    thread.start()
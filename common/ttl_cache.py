@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import OrderedDict
+
+from common.log import logger
+
+
+class TTLCache:
+    """
+    线程安全的过期+LRU缓存，可以限制条目数和总大小
+    条目按最近访问时间排列在OrderedDict中，所有条目的过期时间相同，最久未访问的条目也最先过期，
+    因此每次读写时只需从头部清理已过期的条目，均摊O(1)
+    """
+
+    EXPIRED = "expired"
+    CAPACITY = "capacity"
+
+    def __init__(self, ttl=None, max_size=None, max_bytes=None, sizeof=None, on_evict=None):
+        """
+        :param ttl: 无访问多少秒后过期，None表示不过期
+        :param max_size: 最多保留的条目数，None表示不限制
+        :param max_bytes: 所有条目的总大小上限，需要同时提供sizeof
+        :param sizeof: 计算条目大小的函数，条目被重新写入时重新计算
+        :param on_evict: 条目过期或被淘汰时的回调 on_evict(key, value, reason)，主动删除时不调用
+        """
+        self.ttl = ttl or None
+        self.max_size = max_size or None
+        self.max_bytes = max_bytes or None
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.data = OrderedDict()  # key -> [value, 过期时间, 大小]
+        self.total_bytes = 0
+        self.evictions = {self.EXPIRED: 0, self.CAPACITY: 0}
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        with self.lock:
+            evicted = self._sweep()
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            self.data[key] = [value, self._expiry(), size]
+            self.total_bytes += size
+            evicted += self._shrink()
+        self._notify(evicted)
+
+    def __getitem__(self, key):
+        with self.lock:
+            evicted = self._sweep()
+            entry = self.data.get(key)
+            if entry is not None:
+                entry[1] = self._expiry()
+                self.data.move_to_end(key)
+        self._notify(evicted)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key, default=None):
+        """
+        读取但不刷新过期时间和访问顺序
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or self._is_expired(entry, time.monotonic()):
+                return default
+            return entry[0]
+
+    def __contains__(self, key):
+        # 判断是否存在不刷新过期时间
+        with self.lock:
+            entry = self.data.get(key)
+            return entry is not None and not self._is_expired(entry, time.monotonic())
+
+    def __delitem__(self, key):
+        with self.lock:
+            entry = self.data.pop(key)
+            self.total_bytes -= entry[2]
+
+    def pop(self, key, *default):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            self.total_bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.total_bytes = 0
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        with self.lock:
+            now = time.monotonic()
+            return [(key, entry[0]) for key, entry in self.data.items() if not self._is_expired(entry, now)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self.lock:
+            evicted = self._sweep()
+            length = len(self.data)
+        self._notify(evicted)
+        return length
+
+    def sweep(self):
+        """
+        清理所有已过期的条目
+        """
+        with self.lock:
+            evicted = self._sweep()
+        self._notify(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "bytes": self.total_bytes,
+                "expired": self.evictions[self.EXPIRED],
+                "evicted": self.evictions[self.CAPACITY],
+            }
+
+    def _expiry(self):
+        return time.monotonic() + self.ttl if self.ttl else None
+
+    @staticmethod
+    def _is_expired(entry, now):
+        return entry[1] is not None and entry[1] <= now
+
+    def _sweep(self):
+        evicted = []
+        if not self.ttl:
+            return evicted
+        now = time.monotonic()
+        while self.data:
+            key, entry = next(iter(self.data.items()))
+            if not self._is_expired(entry, now):
+                break
+            evicted.append(self._evict(key, self.EXPIRED))
+        return evicted
+
+    def _shrink(self):
+        # 超出限制时淘汰最久未访问的条目，刚写入的条目即使单独超出大小限制也保留
+        evicted = []
+        while len(self.data) > 1 and ((self.max_size and len(self.data) > self.max_size) or (self.max_bytes and self.total_bytes > self.max_bytes)):
+            evicted.append(self._evict(next(iter(self.data)), self.CAPACITY))
+        return evicted
+
+    def _evict(self, key, reason):
+        value, _, size = self.data.pop(key)
+        self.total_bytes -= size
+        self.evictions[reason] += 1
+        return key, value, reason
+
+    def _notify(self, evicted):
+        # 在锁外调用回调，回调中可以再次访问缓存
+        if not self.on_evict:
+            return
+        for key, value, reason in evicted:
+            try:
+                self.on_evict(key, value, reason)
+            except Exception as e:
+                logger.warning("[TTLCache] on_evict for {} failed: {}".format(key, e))
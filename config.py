@@ -35,12 +35,49 @@ available_setting = {
     "trigger_by_self": False,  # 是否允许机器人触发
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "fast_lane_workers": 4,  # 处理管理员指令和插件指令的线程数
+    "slow_lane_workers": 8,  # 处理bot调用的线程数
+    "media_lane_workers": 4,  # 处理语音、图片等媒体消息的线程数
+    "max_queue_size_per_session": 20,  # 每个会话最多排队的消息数，0表示不限制，管理命令不受限制
+    "max_queue_size": 2000,  # 所有会话排队的消息总数上限，0表示不限制
+    "max_queue_age": 0,  # 消息排队的最长时间(秒)，超时的消息不再处理，0表示不限制
+    "queue_shed_policy": "reply",  # 排队超限时的处理策略，drop_oldest: 丢弃最早的消息，drop_newest: 丢弃新消息，reply: 丢弃新消息并回复繁忙提示
+    "queue_overloaded_reply": "消息太多啦，请稍后再试",  # 排队超限时的繁忙提示
+    "durable_queue": False,  # 是否把待回复的文字消息保存到appdata目录下的SQLite中，重启后重新处理未回复的消息
+    "durable_queue_flush_ms": 50,  # 持久化队列批量写入磁盘的间隔(毫秒)
+    "coalesce_window_ms": 0,  # 合并同一用户在该时间(毫秒)内连续发送的文字消息，只请求一次bot并回复一次，0表示不合并
+    "single_flight": False,  # 是否合并并发的相同请求，没有上下文的会话同时发送相同问题时只请求一次bot，共享回复
+    "drain_timeout": 30,  # 收到退出信号后等待处理中的消息完成的最长秒数，0表示立即退出
+    "send_retry_times": 2,  # 消息发送失败后的最大重试次数
+    "send_retry_delay": 3,  # 第一次重试前等待的秒数
+    "send_retry_backoff": 2,  # 每次重试等待时间的倍数
+    "send_retry_jitter": 0.2,  # 重试等待时间的随机抖动比例
+    "worker_processes": 0,  # bot调用和语音转换使用的工作进程数，同一会话固定在同一个进程中处理，0表示在主进程中处理
+    "worker_threads": 8,  # 每个工作进程中处理请求的线程数
+    "metrics_port": 0,  # 耗时统计的本地http端口，开启后可访问 http://127.0.0.1:端口/metrics 查看，0表示不开启
+    "async_mode": False,  # 是否开启异步模式，开启后bot请求在事件循环中执行，不再占用处理线程，需要安装aiohttp
+    "async_http_pool_size": 100,  # 异步模式下http连接池的最大连接数
+    "http_pool_size": 10,  # bot、插件、图片下载等http请求对每个host保持的最大连接数，连接在请求之间复用
+    "http_pool_hosts": 32,  # 最多同时保留多少个host的连接池
+    "http_connect_timeout": 5,  # http请求的连接超时时间(秒)
+    "http_read_timeout": 120,  # http请求的读取超时时间(秒)，调用方指定了超时时间时以调用方为准
+    "http_proxy": "",  # bot、插件、图片下载等http请求使用的代理，为空时使用环境变量中的代理
+    "http2": False,  # 是否使用HTTP/2发送http请求，需要安装httpx[http2]
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_max_count": 0,  # 最多保留的会话数，超出时淘汰最久未使用的会话，0表示不限制
+    "session_max_bytes": 0,  # 所有会话消息内容的总字节数上限，超出时淘汰最久未使用的会话，0表示不限制
+    "session_backend": "memory",  # 会话存储方式，memory: 只保存在内存中; sqlite: 保存到appdata_dir下的sessions.db，重启后保留; redis: 保存到redis_url，多个实例共享
+    "session_idle_seconds": 600,  # 使用sqlite存储时，会话无操作多久后从内存中移出(仍保留在磁盘中)
+    "redis_url": "redis://127.0.0.1:6379/0",  # 多实例部署时共享状态的Redis地址，格式 redis://:密码@主机:端口/库
+    "redis_prefix": "cow:",  # Redis中所有key的前缀
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "stream_reply": False,  # 是否流式回复，回复边生成边按句子分成多条消息发送，支持ChatGPT、Azure、LinkAI，以及wx、wechatcom_app、wework、terminal通道
+    "stream_chunk_chars": 200,  # 流式回复时，第一句之后每条消息在段落结束或超过该字数后的句子结束处切分
+    "tokenizer_warmup": True,  # 启动时在后台预加载token计数用的编码文件
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -50,15 +87,19 @@ available_setting = {
     "frequency_penalty": 0,
     "presence_penalty": 0,
     "request_timeout": 60,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+    "retry_deadline": 60,  # bot请求失败后重试的等待时间合计上限(秒)，超出后不再重试，直接回复错误提示
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
     "baidu_wenxin_secret_key": "",  # Baidu secret key
+    "persist_access_token": False,  # 是否把百度等接口的access token保存到appdata_dir下，重启后不用重新获取
     # 讯飞星火API
     "xunfei_app_id": "",  # 讯飞应用ID
     "xunfei_api_key": "",  # 讯飞 API key
     "xunfei_api_secret": "",  # 讯飞 API secret
+    "xunfei_pool_size": 2,  # 讯飞星火保持的空闲websocket连接数，请求时不用等待建立连接
+    "xunfei_request_timeout": 30,  # 讯飞星火单次请求的超时时间(秒)
     # claude 配置
     "claude_api_cookie": "",
     "claude_uuid": "",
@@ -102,6 +143,7 @@ available_setting = {
     "wechatmp_app_id": "",  # 微信公众平台的appID
     "wechatmp_app_secret": "",  # 微信公众平台的appsecret
     "wechatmp_aes_key": "",  # 微信公众平台的EncodingAESKey，加密模式需要
+    "wechatmp_reply_cache": "memory",  # 被动回复模式下待发送回复的保存方式，多个实例部署同一个公众号时设置为redis
     # wechatcom的通用配置
     "wechatcom_corp_id": "",  # 企业微信公司的corpID
     # wechatcomapp的配置
@@ -113,12 +155,13 @@ available_setting = {
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
     # channel配置
-    "channel_type": "wx",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app}
+    "channel_type": "wx",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app}，也可以是列表，如["wechatmp", "wechatcom_app"]，在同一进程中运行多个通道
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
     "appdata_dir": "",  # 数据目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
+    "plugin_state_max_count": 10000,  # 插件按用户保存的状态(文字冒险的游戏进度、LinkAI总结的文件等)最多保留的条数，超出时淘汰最久未使用的，0表示不限制
     # 是否使用全局插件配置
     "use_global_plugin_config": False,
     # 知识库平台配置
@@ -245,6 +288,16 @@ def get_appdata_dir():
     return data_path
 
 
+def get_channel_types():
+    """
+    channel_type可以是单个通道或通道列表，统一返回列表
+    """
+    channel_type = conf().get("channel_type", "wx")
+    if isinstance(channel_type, str):
+        return [channel_type]
+    return list(channel_type)
+
+
 def subscribe_msg():
     trigger_prefix = conf().get("single_chat_prefix", [""])[0]
     msg = conf().get("subscribe_msg", "")
@@ -54,6 +54,12 @@ class Banwords(Plugin):
             logger.warn("[Banwords] init failed, ignore or see https://github.com/zhayujie/chatgpt-on-wechat/tree/master/plugins/banwords .")
             raise e
 
+    def classify_lane(self, context):
+        # 包含敏感词的消息直接忽略或回复提示，不会调用bot
+        if context.type in [ContextType.TEXT, ContextType.IMAGE_CREATE] and self.searchr.ContainsAny(context.content):
+            return "fast"
+        return None
+
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type not in [
             ContextType.TEXT,
@@ -4,11 +4,11 @@ import os
 import uuid
 from uuid import getnode as get_mac
 
-import requests
-
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
+from common.access_token import baidu_access_token
 from common.log import logger
 from plugins import *
 
@@ -35,7 +35,7 @@ class BDunit(Plugin):
             self.service_id = conf["service_id"]
             self.api_key = conf["api_key"]
             self.secret_key = conf["secret_key"]
-            self.access_token = self.get_token()
+            self.get_token()
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             logger.info("[BDunit] inited")
         except Exception as e:
@@ -65,20 +65,13 @@ class BDunit(Plugin):
         return help_text
 
     def get_token(self):
-        """获取访问百度UUNIT 的access_token
+        """获取访问百度UUNIT 的access_token，token在缓存中过期前自动刷新
         #param api_key: UNIT apk_key
         #param secret_key: UNIT secret_key
         Returns:
             string: access_token
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token?client_id={}&client_secret={}&grant_type=client_credentials".format(self.api_key, self.secret_key)
-        payload = ""
-        headers = {"Content-Type": "application/json", "Accept": "application/json"}
-
-        response = requests.request("POST", url, headers=headers, data=payload)
-
-        # print(response.text)
-        return response.json()["access_token"]
+        return baidu_access_token(self.api_key, self.secret_key)
 
     def getUnit(self, query):
         """
@@ -87,7 +80,7 @@ class BDunit(Plugin):
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
 
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + self.access_token
+        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + self.get_token()
         request = {
             "query": query,
             "user_id": str(get_mac())[:32],
@@ -102,7 +95,7 @@ class BDunit(Plugin):
         }
         try:
             headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
+            response = http_client.post(url, json=body, headers=headers)
             return json.loads(response.text)
         except Exception:
             return None
@@ -114,7 +107,7 @@ class BDunit(Plugin):
         :param query: 用户的指令字符串
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/chat?access_token=" + self.access_token
+        url = "https://aip.baidubce.com/rpc/2.0/unit/service/chat?access_token=" + self.get_token()
         request = {"query": query, "user_id": str(get_mac())[:32]}
         body = {
             "log_id": str(uuid.uuid1()),
@@ -125,7 +118,7 @@ class BDunit(Plugin):
         }
         try:
             headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
+            response = http_client.post(url, json=body, headers=headers)
             return json.loads(response.text)
         except Exception:
             return None
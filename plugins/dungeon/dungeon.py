@@ -5,8 +5,8 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
-from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.ttl_cache import TTLCache
 from config import conf
 from plugins import *
 
@@ -54,11 +54,12 @@ class Dungeon(Plugin):
         super().__init__()
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         logger.info("[Dungeon] inited")
-        # 目前没有设计session过期事件，这里先暂时使用过期字典
-        if conf().get("expires_in_seconds"):
-            self.games = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            self.games = dict()
+        # 游戏过期或被淘汰时同时清除对应的会话
+        self.games = TTLCache(
+            ttl=conf().get("expires_in_seconds"),
+            max_size=conf().get("plugin_state_max_count", 10000),
+            on_evict=lambda sessionid, game, reason: game.reset(),
+        )
 
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type != ContextType.TEXT:
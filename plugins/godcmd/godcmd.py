@@ -12,8 +12,9 @@ import plugins
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from common import const
-from config import conf, load_config, global_config
+from bridge.shard_pool import get_shard_pool
+from common import const, http_client, metrics
+from config import conf, get_channel_types, load_config, global_config
 from plugins import *
 
 # 定义指令集
@@ -131,6 +132,19 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "lanes": {
+        "alias": ["lanes", "线程池"],
+        "desc": "查看消息处理线程池状态",
+    },
+    "queue": {
+        "alias": ["queue", "消息队列"],
+        "desc": "查看消息排队、丢弃和请求合并情况",
+    },
+    "stats": {
+        "alias": ["stats", "耗时统计"],
+        "args": ["[reset]"],
+        "desc": "查看或重置消息处理各阶段的耗时统计",
+    },
 }
 
 
@@ -140,7 +154,7 @@ def get_help_text(isadmin, isgroup):
     for cmd, info in COMMANDS.items():
         if cmd == "auth":  # 不提示认证指令
             continue
-        if cmd == "id" and conf().get("channel_type", "wx") not in ["wxy", "wechatmp"]:
+        if cmd == "id" and not any(channel_type in ["wxy", "wechatmp"] for channel_type in get_channel_types()):
             continue
         alias = ["#" + a for a in info["alias"][:1]]
         help_text += f"{','.join(alias)} "
@@ -334,6 +348,9 @@ class Godcmd(Plugin):
                             ok, result = True, "服务已恢复"
                         elif cmd == "reconf":
                             load_config()
+                            if get_shard_pool():
+                                for future in get_shard_pool().broadcast("load_config"):
+                                    future.result()
                             ok, result = True, "配置已重载"
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI,
@@ -350,6 +367,24 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "lanes":
+                            ok = True
+                            result = "线程池状态：\n"
+                            for lane in channel.get_lane_stats():
+                                result += "{name}: 线程{workers} 排队{pending} 执行中{running} 已执行{started} 平均等待{avg_wait:.2f}s 最长等待{max_wait:.2f}s\n".format(**lane)
+                        elif cmd == "queue":
+                            ok = True
+                            stats = channel.get_queue_stats()
+                            result = "会话数{sessions} 排队消息数{queued}\n丢弃消息数: 会话队列已满{session_full} 总队列已满{global_full} 排队超时{expired}\n发送重试: 等待重试{send_retry_pending} 累计重试{send_retried} 最终失败{send_failed}".format(**stats)
+                            result += "\n合并请求: 实际请求{executed} 共享回复{shared}".format(**Bridge().get_single_flight_stats())
+                            for host, item in sorted(http_client.stats().items()):
+                                result += "\nHTTP {}: 请求{requests} 新建连接{connections} 复用连接{reused}".format(host, **item)
+                        elif cmd == "stats":
+                            if len(args) == 1 and args[0] == "reset":
+                                metrics.reset()
+                                ok, result = True, "耗时统计已重置"
+                            else:
+                                ok, result = True, "耗时统计：\n" + (metrics.render_text() or "暂无数据")
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
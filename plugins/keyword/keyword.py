@@ -2,10 +2,10 @@
 
 import json
 import os
-import requests
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
 from plugins import *
 
@@ -44,6 +44,16 @@ class Keyword(Plugin):
             logger.warn("[keyword] init failed, ignore or see https://github.com/zhayujie/chatgpt-on-wechat/tree/master/plugins/keyword .")
             raise e
 
+    def classify_lane(self, context):
+        if context.type != ContextType.TEXT:
+            return None
+        reply_text = self.keyword.get(context.content.strip())
+        if reply_text is None:
+            return None
+        if reply_text.startswith("http://") or reply_text.startswith("https://"):
+            return "media"  # 图片、文件、视频需要下载
+        return "fast"
+
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type != ContextType.TEXT:
             return
@@ -68,7 +78,7 @@ class Keyword(Plugin):
                     os.makedirs(file_path)
                 file_name = reply_text.split("/")[-1]  # 获取文件名
                 file_path = os.path.join(file_path, file_name)
-                response = requests.get(reply_text)
+                response = http_client.get(reply_text)
                 with open(file_path, "wb") as f:
                     f.write(response.content)
                 #channel/wechat/wechat_channel.py和channel/wechat_channel.py中缺少ReplyType.FILE类型。
@@ -22,7 +22,7 @@ from plugins import *
 from .midjourney import MJBot
 from .summary import LinkSummary
 from bridge import bridge
-from common.expired_dict import ExpiredDict
+from common.ttl_cache import TTLCache
 from common import const
 import os
 
@@ -310,4 +310,4 @@ def _find_file_id(context):
     if user_id:
         return USER_FILE_MAP.get(user_id + "-file_id")
 
-USER_FILE_MAP = ExpiredDict(conf().get("expires_in_seconds") or 60 * 30)
+USER_FILE_MAP = TTLCache(ttl=conf().get("expires_in_seconds") or 60 * 30, max_size=conf().get("plugin_state_max_count", 10000))
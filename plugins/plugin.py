@@ -44,5 +44,12 @@ class Plugin:
         except Exception as e:
             logger.warn("save plugin config failed: {}".format(e))
 
+    def classify_lane(self, context) -> str:
+        """
+        调度消息前判断它的处理通道，插件会直接处理(不调用bot)的消息返回"fast"，其他情况返回None
+        在consume线程中调用，只能做字典查找、关键词匹配等简单判断，不能有网络请求等耗时操作
+        """
+        return None
+
     def get_help_text(self, **kwargs):
         return "暂无帮助信息"
@@ -1,11 +1,17 @@
 # encoding:utf-8
 
+import asyncio
+import functools
 import importlib
 import importlib.util
 import json
 import os
 import sys
+import time
 
+from bridge.bridge import Bridge
+from common import metrics
+from common.async_loop import run_coroutine
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -186,12 +192,76 @@ class PluginManager:
                 if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
                     logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
                     instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
+                    handler = instance.handlers[e_context.event]
+                    labels = self._metric_labels(name, e_context)
+                    start_time = time.time()
+                    if asyncio.iscoroutinefunction(handler):
+                        run_coroutine(handler(e_context, *args, **kwargs)).result()
+                    else:
+                        handler(e_context, *args, **kwargs)
+                    metrics.observe("plugin", time.time() - start_time, **labels)
                     if e_context.is_break():
                         e_context["breaked_by"] = name
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
         return e_context
 
+    async def aemit_event(self, e_context: EventContext, offload=None, *args, **kwargs):
+        """
+        异步模式下触发事件，async def定义的插件处理函数直接在事件循环中执行，同步的处理函数交给线程池执行
+        :param offload: 执行同步处理函数的协程函数，签名为 offload(func, *args)，默认使用事件循环的默认线程池
+        """
+        if offload is None:
+            loop = asyncio.get_running_loop()
+
+            async def offload(func, *func_args):
+                return await loop.run_in_executor(None, functools.partial(func, *func_args))
+
+        if e_context.event in self.listening_plugins:
+            for name in self.listening_plugins[e_context.event]:
+                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+                    instance = self.instances[name]
+                    handler = instance.handlers[e_context.event]
+                    labels = self._metric_labels(name, e_context)
+                    start_time = time.time()
+                    if asyncio.iscoroutinefunction(handler):
+                        await handler(e_context, *args, **kwargs)
+                    else:
+                        await offload(functools.partial(handler, e_context, *args, **kwargs))
+                    metrics.observe("plugin", time.time() - start_time, **labels)
+                    if e_context.is_break():
+                        e_context["breaked_by"] = name
+                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        return e_context
+
+    def classify_lane(self, context):
+        """
+        按优先级询问处理消息的插件，返回第一个给出的处理通道，都没有时返回None
+        """
+        for name in self.listening_plugins.get(Event.ON_HANDLE_CONTEXT, []):
+            if not self.plugins[name].enabled:
+                continue
+            try:
+                lane = self.instances[name].classify_lane(context)
+            except Exception as e:
+                logger.warning("Plugin %s classify lane failed: %s" % (name, e))
+                continue
+            if lane:
+                return lane
+        return None
+
+    # 插件耗时的标签，除插件和事件外与ChatChannel._observe相同，在处理前读取，插件可能替换context
+    def _metric_labels(self, name, e_context: EventContext):
+        channel = e_context.econtext.get("channel")
+        context = e_context.econtext.get("context")
+        return {
+            "plugin": name,
+            "event": e_context.event.name,
+            "channel": type(channel).__name__ if channel is not None else None,
+            "ctype": context.type if context is not None else None,
+            "bot": Bridge().get_bot_type("chat"),
+        }
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
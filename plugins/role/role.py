@@ -9,6 +9,7 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
 from common.log import logger
+from common.ttl_cache import TTLCache
 from config import conf
 from plugins import *
 
@@ -65,7 +66,12 @@ class Role(Plugin):
             if len(self.roles) == 0:
                 raise Exception("no role found")
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
-            self.roleplays = {}
+            # 与会话使用相同的过期时间和数量限制，角色过期或被淘汰时同时清除对应的会话
+            self.roleplays = TTLCache(
+                ttl=conf().get("expires_in_seconds"),
+                max_size=conf().get("session_max_count"),
+                on_evict=lambda sessionid, roleplay, reason: roleplay.reset(),
+            )
             logger.info("[Role] inited")
         except Exception as e:
             if isinstance(e, FileNotFoundError):
@@ -109,9 +115,9 @@ class Role(Plugin):
         sessionid = e_context["context"]["session_id"]
         trigger_prefix = conf().get("plugin_trigger_prefix", "$")
         if clist[0] == f"{trigger_prefix}停止扮演":
-            if sessionid in self.roleplays:
-                self.roleplays[sessionid].reset()
-                del self.roleplays[sessionid]
+            roleplay = self.roleplays.pop(sessionid, None)
+            if roleplay is not None:
+                roleplay.reset()
             reply = Reply(ReplyType.INFO, "角色扮演结束!")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -179,7 +185,10 @@ class Role(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
         else:
-            prompt = self.roleplays[sessionid].action(content)
+            roleplay = self.roleplays.get(sessionid)
+            if roleplay is None:  # 刚好过期
+                return
+            prompt = roleplay.action(content)
             e_context["context"].type = ContextType.TEXT
             e_context["context"].content = prompt
             e_context.action = EventAction.BREAK
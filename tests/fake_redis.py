@@ -0,0 +1,185 @@
+"""
+本地的Redis替身服务，实现RESP2协议和会话存储、公众号回复缓存用到的命令，数据只保存在内存中
+用于在没有Redis的环境中测试common.redis_client及基于它的存储
+"""
+
+import fnmatch
+import threading
+from socketserver import StreamRequestHandler, ThreadingMixIn, TCPServer
+
+
+class FakeRedisServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), _FakeRedisHandler)
+        self.password = password
+        self.data = {}  # key -> str / dict(hash) / dict(zset: 成员 -> 分数) / list
+        self.expires = {}  # key -> 设置的过期秒数，只记录不执行
+        self.lock = threading.Lock()
+        self.connections = 0  # 建立过的连接数
+
+    @property
+    def url(self):
+        auth = ":{}@".format(self.password) if self.password else ""
+        return "redis://{}127.0.0.1:{}/0".format(auth, self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,), name="fake-redis")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def execute(self, command, args, authed):
+        with self.lock:
+            handler = getattr(self, "cmd_" + command.lower(), None)
+            if handler is None:
+                return Exception("ERR unknown command '{}'".format(command))
+            if self.password and not authed and command.upper() != "AUTH":
+                return Exception("NOAUTH Authentication required.")
+            return handler(*args)
+
+    def cmd_auth(self, password):
+        if password != self.password:
+            return Exception("WRONGPASS invalid password")
+        return "OK"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_expire(self, key, seconds):
+        if key not in self.data:
+            return 0
+        self.expires[key] = int(seconds)
+        return 1
+
+    def cmd_get(self, key):
+        return self.data.get(key)
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        if len(options) == 2 and options[0].upper() == "EX":
+            self.expires[key] = int(options[1])
+        return "OK"
+
+    def cmd_incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = str(value)
+        return value
+
+    def cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                deleted += 1
+            self.expires.pop(key, None)
+        return deleted
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    def cmd_hset(self, key, *pairs):
+        fields = self.data.setdefault(key, {})
+        added = sum(1 for field in pairs[::2] if field not in fields)
+        fields.update(zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_hmget(self, key, *fields):
+        values = self.data.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def cmd_zadd(self, key, *pairs):
+        members = self.data.setdefault(key, {})
+        added = sum(1 for member in pairs[1::2] if member not in members)
+        members.update((member, float(score)) for score, member in zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_zrange(self, key, start, stop):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+        stop = int(stop)
+        return [member for member, _ in members[int(start) : None if stop == -1 else stop + 1]]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        members = self.data.get(key, {})
+        removed = [member for member, score in members.items() if _score_above(score, low) and _score_below(score, high)]
+        for member in removed:
+            del members[member]
+        if not members:
+            self.data.pop(key, None)
+        return len(removed)
+
+    def cmd_rpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        items.extend(values)
+        return len(items)
+
+    def cmd_lpop(self, key):
+        items = self.data.get(key)
+        if not items:
+            return None
+        value = items.pop(0)
+        if not items:
+            del self.data[key]
+        return value
+
+    def cmd_scan(self, cursor, *options):
+        pattern = "*"
+        for i in range(0, len(options) - 1, 2):
+            if options[i].upper() == "MATCH":
+                pattern = options[i + 1]
+        return ["0", [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]]
+
+
+def _score_above(score, low):
+    if low == "-inf":
+        return True
+    if low.startswith("("):
+        return score > float(low[1:])
+    return score >= float(low)
+
+
+def _score_below(score, high):
+    if high == "+inf":
+        return True
+    if high.startswith("("):
+        return score < float(high[1:])
+    return score <= float(high)
+
+
+class _FakeRedisHandler(StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        authed = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+            reply = self.server.execute(args[0], args[1:], authed)
+            if args[0].upper() == "AUTH" and reply == "OK":
+                authed = True
+            self.wfile.write(encode_reply(reply))
+
+
+def encode_reply(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, Exception):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+    if value == "OK":
+        return b"+OK\r\n"
+    data = value.encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
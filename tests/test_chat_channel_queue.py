@@ -0,0 +1,61 @@
+"""
+ChatChannel排队限制：drop_oldest移除其他session的消息后，空的session需要被清理
+"""
+
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import config
+from bridge.context import Context, ContextType
+from channel.chat_channel import ChatChannel
+from common.dequeue import Dequeue
+
+
+class QueueTestChannel(ChatChannel):
+    def send(self, reply, context):
+        pass
+
+
+class TestDropOldest(unittest.TestCase):
+    def setUp(self):
+        settings = {"max_queue_size_per_session": 0, "max_queue_size": 2, "queue_shed_policy": "drop_oldest", "max_queue_age": 0}
+        patcher = mock.patch.object(config, "config", config.Config(settings))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = QueueTestChannel()
+        self.channel.stopped = True  # 只测试排队，不调度处理
+        self.addCleanup(self.channel.cancel_all_session)
+        self.addCleanup(ChatChannel.instances.remove, self.channel)
+
+    def _produce(self, session_id):
+        context = Context(ContextType.TEXT, "hello", kwargs={"session_id": session_id, "receiver": session_id, "msg": SimpleNamespace()})
+        self.channel.produce(context)
+        time.sleep(0.01)  # 保证produce_time不同
+        return context
+
+    def test_evicted_session_released(self):
+        self._produce("user_a")
+        self._produce("user_b")
+        self._produce("user_c")  # 全局排队已满，移除user_a的消息
+        self.assertNotIn("user_a", self.channel.sessions)
+        self.assertNotIn("user_a", self.channel.futures)
+        self.assertEqual(sorted(self.channel.sessions), ["user_b", "user_c"])
+        self.assertEqual(self.channel.queue_stats["queued"], 2)
+
+    def test_consume_releases_empty_session(self):
+        self.channel.stopped = False
+        with self.channel.lock:
+            # 就绪后排队的消息被drop_oldest移除，session中只剩空队列
+            self.channel.sessions["user_d"] = [Dequeue(), threading.BoundedSemaphore(1)]
+            self.channel._mark_ready("user_d")
+        deadline = time.time() + 2
+        while "user_d" in self.channel.sessions and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotIn("user_d", self.channel.sessions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+多实例共享状态：Redis会话存储和公众号回复缓存，通过本地的Redis替身服务测试
+"""
+
+import json
+import unittest
+
+from bot.session_store import RedisSessionStore
+from common.redis_client import RedisClient, RedisError
+from tests.fake_redis import FakeRedisServer
+
+try:
+    from channel.wechatmp.reply_cache import RedisReplyCache
+except Exception:  # 缺少公众号通道的依赖
+    RedisReplyCache = None
+
+
+class RedisTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer(password="secret").start()
+        self.addCleanup(self.server.stop)
+
+    def new_client(self):
+        return RedisClient(self.server.url)
+
+
+class TestRedisClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer().start()
+        self.addCleanup(self.server.stop)
+        self.client = RedisClient(self.server.url)
+
+    def test_reply_types(self):
+        self.assertEqual(self.client.execute("SET", "text", "第一行\r\n第二行"), "OK")
+        self.assertEqual(self.client.execute("GET", "text"), "第一行\r\n第二行")  # 按长度读取，内容中可以有换行
+        self.assertIsNone(self.client.execute("GET", "missing"))
+        self.assertEqual(self.client.execute("INCR", "counter"), 1)
+        self.assertEqual(self.client.execute("HMGET", "missing", "a", "b"), [None, None])
+
+    def test_pipeline_on_one_connection(self):
+        pipe = self.client.pipeline()
+        pipe.command("SET", "a", 1).command("INCR", "a").command("GET", "a")
+        self.assertEqual(pipe.execute(), ["OK", 2, "2"])
+        self.assertEqual(pipe.execute(), [])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_error_keeps_connection(self):
+        with self.assertRaises(RedisError):
+            self.client.execute_many([("SET", "a", 1), ("BOGUS",), ("INCR", "a")])
+        self.assertEqual(self.client.execute("GET", "a"), "2")  # 出错前后的命令都已执行
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect_when_idle_connection_closed(self):
+        self.client.execute("SET", "a", 1)
+        for connection in self.client.idle:
+            connection.sock.shutdown(2)
+        self.assertEqual(self.client.execute("GET", "a"), "1")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_auth(self):
+        server = FakeRedisServer(password="secret").start()
+        self.addCleanup(server.stop)
+        self.assertEqual(RedisClient(server.url).execute("SET", "a", 1), "OK")
+        with self.assertRaises(RedisError):
+            RedisClient(server.url.replace("secret", "wrong")).execute("GET", "a")
+
+
+class TestRedisSessionStore(RedisTestCase):
+    def test_round_trip(self):
+        store = RedisSessionStore(self.new_client(), expires_in_seconds=3600)
+        self.assertIsNone(store.load("ChatGPTSession:u1"))
+        rows = [(0, "user", "你好"), (1, "assistant", "你好，有什么可以帮你？")]
+        store.append("ChatGPTSession:u1", "你是助手", 0, rows)
+        self.assertEqual(store.load("ChatGPTSession:u1"), ("你是助手", rows, 2))
+
+        head = self.server.data["cow:session:ChatGPTSession:u1"]
+        self.assertEqual(head, {"system_prompt": "你是助手", "start_seq": "0"})
+        messages = self.server.data["cow:messages:ChatGPTSession:u1"]
+        self.assertEqual(sorted(messages.values()), [0.0, 1.0])
+        self.assertEqual(json.loads(min(messages, key=messages.get)), [0, "user", "你好"])
+        self.assertEqual(self.server.expires["cow:session:ChatGPTSession:u1"], 3600)
+
+    def test_shared_between_instances(self):
+        store_a = RedisSessionStore(self.new_client())
+        store_b = RedisSessionStore(self.new_client())
+        store_a.append("s", "prompt", 0, [(0, "user", "q1"), (1, "assistant", "a1")])
+        store_b.append("s", "prompt", 0, [(2, "user", "q2")])
+        # 裁剪掉最早的一问一答
+        store_a.append("s", "prompt", 2, [(3, "assistant", "a2")])
+        self.assertEqual(store_b.load("s"), ("prompt", [(2, "user", "q2"), (3, "assistant", "a2")], 4))
+        # 重复追加是幂等的
+        store_b.append("s", "prompt", 2, [(3, "assistant", "a2")])
+        self.assertEqual(len(store_a.load("s")[1]), 2)
+
+    def test_delete_and_clear(self):
+        store = RedisSessionStore(self.new_client())
+        for session_id in ["ChatGPTSession:u1", "ChatGPTSession:u2", "BaiduWenxinSession:u1"]:
+            store.append(session_id, "", 0, [(0, "user", "q")])
+        store.delete("ChatGPTSession:u1")
+        self.assertIsNone(store.load("ChatGPTSession:u1"))
+        store.clear("ChatGPTSession:")
+        self.assertIsNone(store.load("ChatGPTSession:u2"))
+        self.assertIsNotNone(store.load("BaiduWenxinSession:u1"))  # 其他bot的会话不受影响
+
+
+@unittest.skipIf(RedisReplyCache is None, "wechatmp dependencies not installed")
+class TestRedisReplyCache(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        # 两个实例各自连接Redis，模拟微信服务器的重试请求落到不同实例
+        self.cache_a = RedisReplyCache(self.new_client())
+        self.cache_b = RedisReplyCache(self.new_client())
+
+    def test_running_state(self):
+        self.assertEqual(self.cache_b.state("user", "m1"), (False, False, 0))
+        self.cache_a.set_running("user")
+        self.assertTrue(self.cache_b.is_running("user"))
+        self.assertEqual(self.cache_b.state("user", "m1"), (False, True, 0))
+        self.cache_b.clear_running("user")
+        self.assertFalse(self.cache_a.is_running("user"))
+
+    def test_cached_replies(self):
+        self.cache_a.push_reply("user", "text", "你好")
+        self.cache_a.push_reply("user", "image", "media_id")
+        self.assertEqual(self.cache_b.state("user", "m1")[0], True)
+        self.assertEqual(self.cache_b.pop_reply("user"), ("text", "你好"))
+        self.assertEqual(self.cache_a.pop_reply("user"), ("image", "media_id"))
+        self.assertIsNone(self.cache_b.pop_reply("user"))
+        self.assertEqual(self.cache_a.state("user", "m1")[0], False)
+
+    def test_request_count(self):
+        self.assertEqual(self.cache_a.incr_request("m1"), 1)
+        self.assertEqual(self.cache_b.incr_request("m1"), 2)
+        self.assertEqual(self.cache_a.state("user", "m1")[2], 2)
+        self.cache_b.clear_request("m1")
+        self.assertEqual(self.cache_a.state("user", "m1")[2], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
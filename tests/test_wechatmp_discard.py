@@ -0,0 +1,58 @@
+"""
+公众号被动回复：消息没有处理就被丢弃时，用户的处理中状态需要清除，否则之后的消息都只会返回"正在思考中"
+"""
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import config
+from bridge.context import Context, ContextType
+
+try:
+    from channel.wechatmp.wechatmp_channel import WechatMPChannel
+except Exception:  # 缺少web.py、wechatpy等依赖
+    WechatMPChannel = None
+
+
+@unittest.skipIf(WechatMPChannel is None, "wechatmp dependencies not installed")
+class TestWechatmpDiscard(unittest.TestCase):
+    def setUp(self):
+        settings = {"max_queue_size_per_session": 1, "queue_shed_policy": "drop", "max_queue_age": 0}
+        patcher = mock.patch.object(config, "config", config.Config(settings))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = WechatMPChannel(passive_reply=True)
+        self.channel.stopped = True  # 只测试排队，不调度处理
+        self.addCleanup(self.channel.cancel_all_session)
+
+    def _produce(self, user, msg_id):
+        context = Context(ContextType.TEXT, "hello", kwargs={"session_id": user, "receiver": user, "msg": SimpleNamespace(msg_id=msg_id)})
+        self.channel.reply_cache.set_running(user)  # 与passive_reply.py中的调用顺序一致
+        self.channel.produce(context)
+        return context
+
+    def test_shed_clears_running(self):
+        shed_cnt = self.channel.queue_stats["session_full"]
+        self._produce("user_a", 1)
+        self.assertTrue(self.channel.reply_cache.is_running("user_a"))
+        self.channel.reply_cache.clear_running("user_a")
+        self._produce("user_a", 2)  # 超过session的排队长度，被丢弃
+        self.assertFalse(self.channel.reply_cache.is_running("user_a"))
+        self.assertEqual(self.channel.queue_stats["session_full"], shed_cnt + 1)
+
+    def test_draining_clears_running(self):
+        self.channel.draining = True
+        self.addCleanup(setattr, self.channel, "draining", False)
+        self._produce("user_b", 3)
+        self.assertFalse(self.channel.reply_cache.is_running("user_b"))
+
+    def test_cancel_clears_running(self):
+        self._produce("user_c", 4)
+        self.channel.cancel_session("user_c")
+        self.assertFalse(self.channel.reply_cache.is_running("user_c"))
+        self.assertNotIn("user_c", self.channel.sessions)
+
+
+if __name__ == "__main__":
+    unittest.main()